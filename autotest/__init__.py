@@ -0,0 +1,3 @@
+# Helpers for the Python AutoTests in CodeGrade (see autotesting-python.md).
+# Copy this folder into the `test` folder of a solution repository; the test scripts
+# add their own directory to sys.path before importing from here.
@@ -0,0 +1,240 @@
+# Assertions for the outputs of geo exercises: rasters, arrays, geometries and plots.
+# Rasters and arrays are compared a block of rows at a time with numpy, geometries in bulk with
+# shapely and images by a perceptual hash, so there are no Python loops over cells or features
+# and a large student output is never read into memory as a whole. They raise AssertionError
+# with a short message for the student, as try_function and run_tests expect.
+#
+#   from autotest import assertions
+#   def test_ndvi():
+#       assertions.assert_rasters_close(solution + '/output/ndvi.tif', student + '/output/ndvi.tif', atol=1e-4)
+#
+# numpy is needed for all of them, rasterio for raster files, shapely (2.0 or later, and
+# geopandas for files) for geometries and Pillow for images.
+
+import math
+import os
+
+import numpy as np
+
+# Cells of a raster band or array that are compared at a time, which bounds the memory use
+CHUNK_CELLS = 2 ** 20
+
+
+def chunk_rows(shape):
+    # Number of rows in a chunk of an array of `shape`
+    return max(1, CHUNK_CELLS // max(1, int(np.prod(shape[1:]))))
+
+
+class Diff:
+    # Summary of the differences between two arrays, added up a block of rows at a time
+    def __init__(self):
+        self.cells = 0
+        self.different = 0
+        self.nodata = 0
+        self.largest = 0.0
+        self.total = 0.0
+        self.squares = 0.0
+        self.first = None
+
+    def add(self, expected, actual, row, rtol, atol, expected_nodata=None, actual_nodata=None):
+        expected = np.asarray(expected, dtype='float64')
+        actual = np.asarray(actual, dtype='float64')
+        expected_missing = np.isnan(expected)
+        actual_missing = np.isnan(actual)
+        if expected_nodata is not None:
+            expected_missing |= expected == expected_nodata
+        if actual_nodata is not None:
+            actual_missing |= actual == actual_nodata
+        valid = ~expected_missing & ~actual_missing
+        difference = np.where(valid, np.abs(expected - actual), 0.0)
+        wrong = (expected_missing != actual_missing) | (valid & (difference > atol + rtol * np.abs(expected)))
+
+        self.cells += expected.size
+        self.different += int(np.count_nonzero(wrong))
+        self.nodata += int(np.count_nonzero(expected_missing != actual_missing))
+        self.total += float(difference.sum())
+        self.squares += float(np.square(difference).sum())
+        if difference.size:
+            self.largest = max(self.largest, float(difference.max()))
+        if self.first is None and wrong.any():
+            index = np.unravel_index(np.argmax(wrong), wrong.shape)
+            self.first = (row + int(index[0]),) + tuple(int(i) for i in index[1:])
+
+    @property
+    def fraction(self):
+        return self.different / self.cells if self.cells else 0.0
+
+    def summary(self):
+        return {
+            'cells': self.cells,
+            'different': self.different,
+            'nodata': self.nodata,
+            'largest': self.largest,
+            'mean': self.total / self.cells if self.cells else 0.0,
+            'rmse': math.sqrt(self.squares / self.cells) if self.cells else 0.0,
+            'first': self.first,
+        }
+
+    def message(self, label):
+        where = ', first at row {}'.format(self.first[0]) if self.first else ''
+        if self.first and len(self.first) > 1:
+            where += ', column {}'.format(self.first[1])
+        nodata = ', {} of them no data in only one of the two'.format(self.nodata) if self.nodata else ''
+        return '{}: {} of {} values ({:.2%}) differ from the expected result (largest difference {:g}, RMSE {:g}{}{})'.format(
+            label, self.different, self.cells, self.fraction, self.largest, self.summary()['rmse'], nodata, where)
+
+
+def array_diff(expected, actual, rtol=0.0, atol=0.0, expected_nodata=None, actual_nodata=None):
+    # Diff of two arrays of the same shape. Both only need a shape and row slicing, so they can be
+    # memory-mapped arrays or the bands of an open raster (see BandRows).
+    diff = Diff()
+    rows = chunk_rows(expected.shape)
+    for row in range(0, max(expected.shape[0], 1) if expected.shape else 1, rows):
+        if expected.shape:
+            diff.add(expected[row:row + rows], actual[row:row + rows], row, rtol, atol, expected_nodata, actual_nodata)
+        else:
+            diff.add(expected, actual, 0, rtol, atol, expected_nodata, actual_nodata)
+    return diff
+
+
+def assert_arrays_close(expected, actual, rtol=1e-5, atol=1e-8, nodata=None, max_fraction=0.0, label='The result'):
+    # Values within atol + rtol * |expected|; cells that are NaN or `nodata` must be so in both.
+    # Up to `max_fraction` of the cells may differ, e.g. at the edges after resampling.
+    if not hasattr(actual, 'shape'):
+        actual = np.asarray(actual)
+    assert tuple(actual.shape) == tuple(expected.shape), '{}: expected an array of shape {}, got {}'.format(
+        label, tuple(expected.shape), tuple(actual.shape))
+    diff = array_diff(expected, actual, rtol, atol, nodata, nodata)
+    assert diff.fraction <= max_fraction, diff.message(label)
+    return diff
+
+
+class BandRows:
+    # A band of an open rasterio dataset that reads the rows it is sliced with
+    def __init__(self, dataset, band):
+        self.dataset = dataset
+        self.band = band
+        self.shape = (dataset.height, dataset.width)
+        self.size = dataset.height * dataset.width
+
+    def __getitem__(self, rows):
+        import rasterio.windows
+        stop = min(rows.stop, self.dataset.height)
+        return self.dataset.read(self.band, window=rasterio.windows.Window(0, rows.start, self.dataset.width, stop - rows.start))
+
+
+def assert_same_grid(label, count, height, width, crs, transform, dataset):
+    # Same number of bands, size, coordinate reference system and cells as the open raster `dataset`
+    assert (dataset.count, dataset.height, dataset.width) == (count, height, width), \
+        '{}: expected {} band(s) of {} x {} cells, got {} band(s) of {} x {}'.format(
+            label, count, height, width, dataset.count, dataset.height, dataset.width)
+    if crs is not None:
+        assert dataset.crs is not None and dataset.crs == crs, \
+            '{}: the raster has a different coordinate reference system'.format(label)
+    resolution = max(abs(transform[0]), abs(transform[4])) or 1.0
+    assert all(math.isclose(a, b, rel_tol=1e-9, abs_tol=resolution * 1e-6) for a, b in zip(list(dataset.transform)[:6], list(transform)[:6])), \
+        '{}: the raster has a different extent or resolution'.format(label)
+
+
+def open_raster(path, label):
+    import rasterio
+    assert os.path.exists(path), '{}: the file {} does not exist'.format(label, os.path.basename(path))
+    try:
+        return rasterio.open(path)
+    except rasterio.errors.RasterioIOError:
+        raise AssertionError('{}: {} is not a raster that can be read'.format(label, os.path.basename(path)))
+
+
+def assert_rasters_close(expected, actual, rtol=1e-5, atol=1e-8, max_fraction=0.0, label=None):
+    # The raster file `actual` has the grid of the raster file `expected` and values within tolerance.
+    # The bands are compared a block of rows at a time; no data of each file counts as missing.
+    label = label or os.path.basename(actual)
+    with open_raster(expected, label) as exp, open_raster(actual, label) as act:
+        assert_same_grid(label, exp.count, exp.height, exp.width, exp.crs, exp.transform, act)
+        diffs = []
+        for band in range(1, exp.count + 1):
+            band_label = '{} (band {})'.format(label, band) if exp.count > 1 else label
+            diff = array_diff(BandRows(exp, band), BandRows(act, band), rtol, atol, exp.nodata, act.nodata)
+            assert diff.fraction <= max_fraction, diff.message(band_label)
+            diffs.append(diff)
+    return diffs
+
+
+def geometries(value, label):
+    # A numpy array of shapely geometries from a file, a GeoDataFrame, a GeoSeries or a list of geometries
+    if isinstance(value, (str, os.PathLike)):
+        import geopandas
+        assert os.path.exists(value), '{}: the file {} does not exist'.format(label, os.path.basename(value))
+        value = geopandas.read_file(value)
+    crs = getattr(value, 'crs', None)
+    if hasattr(value, 'geometry'):
+        value = value.geometry
+    return np.asarray(value, dtype=object), crs
+
+
+def sort_geometries(values):
+    # Order independent of the order of the features: by the (rounded) centroid and the area
+    import shapely
+    centroids = shapely.centroid(values)
+    keys = (np.round(shapely.area(values), 6), np.round(shapely.get_y(centroids), 6), np.round(shapely.get_x(centroids), 6))
+    return values[np.lexsort(keys)]
+
+
+def assert_geometries_close(expected, actual, tolerance=1e-6, ordered=True, label=None):
+    # Every geometry lies within `tolerance` (Hausdorff distance, in map units) of the expected one
+    # at the same position, or, with ordered=False, in any order. A different CRS is reprojected.
+    import shapely
+    label = label or (os.path.basename(actual) if isinstance(actual, (str, os.PathLike)) else 'The result')
+    expected, expected_crs = geometries(expected, label)
+    actual_values, actual_crs = geometries(actual, label)
+    if expected_crs is not None and actual_crs is not None and actual_crs != expected_crs:
+        import geopandas
+        actual_values = np.asarray(geopandas.GeoSeries(actual_values, crs=actual_crs).to_crs(expected_crs), dtype=object)
+    assert len(actual_values) == len(expected), '{}: expected {} feature(s), got {}'.format(label, len(expected), len(actual_values))
+    if not ordered:
+        expected = sort_geometries(expected)
+        actual_values = sort_geometries(actual_values)
+
+    types = shapely.get_type_id(expected) != shapely.get_type_id(actual_values)
+    distance = shapely.hausdorff_distance(expected, actual_values)
+    # Two empty geometries are equal, one empty geometry is not
+    empty = shapely.is_empty(expected) | shapely.is_empty(actual_values)
+    distance = np.where(empty, np.where(shapely.is_empty(expected) == shapely.is_empty(actual_values), 0.0, np.inf), distance)
+    wrong = types | (distance > tolerance)
+    if wrong.any():
+        largest = float(distance[np.isfinite(distance)].max()) if np.isfinite(distance).any() else float('inf')
+        kinds = '{} of a different type, '.format(int(types.sum())) if types.any() else ''
+        raise AssertionError('{}: {} of {} geometries differ from the expected result ({}largest distance {:g}, first at feature {})'.format(
+            label, int(wrong.sum()), len(expected), kinds, largest, int(np.argmax(wrong))))
+    return distance
+
+
+def image_hash(path, size=8):
+    # Perceptual difference hash: whether each pixel of a small greyscale version of the image is
+    # brighter than its right neighbour. Small changes (anti-aliasing, fonts, the PNG encoder) change
+    # few of its bits, a different plot changes many.
+    from PIL import Image
+    with Image.open(path) as image:
+        small = np.asarray(image.convert('L').resize((size + 1, size), Image.LANCZOS), dtype='int16')
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return '{:0{}x}'.format(int(''.join('1' if bit else '0' for bit in bits), 2), size * size // 4)
+
+
+def hash_distance(a, b):
+    # Number of bits in which two image hashes differ
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def assert_images_similar(expected, actual, max_distance=6, label=None):
+    # `expected` is an image file or its image_hash; at most `max_distance` of the 64 bits may differ
+    label = label or os.path.basename(actual)
+    assert os.path.exists(actual), '{}: the file {} does not exist'.format(label, os.path.basename(actual))
+    if os.path.exists(expected):
+        expected = image_hash(expected)
+    try:
+        distance = hash_distance(expected, image_hash(actual))
+    except OSError:
+        raise AssertionError('{}: {} is not an image that can be read'.format(label, os.path.basename(actual)))
+    assert distance <= max_distance, '{}: the image does not look like the expected image ({} of 64 hash bits differ, at most {} may)'.format(
+        label, distance, max_distance)
+    return distance
@@ -0,0 +1,208 @@
+# Recorded HTTP responses for tests of student code that goes online, such as a geocoder.
+# install() intercepts the requests made with `requests` (which geopy uses when it is installed)
+# and `urllib.request`. A request that was seen before is answered from the fixture cache, a
+# directory with one JSON file per request; a new one goes to the network and its response is
+# recorded. Tests then run without `Allow Internet`, at local speed and with the same answers
+# for every submission.
+#
+#   from autotest import netcache
+#   netcache.install(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'netcache'))
+#   import distanceCalculator
+#
+# Modes, from the `mode` argument or the AUTOTEST_NET environment variable:
+#   auto    replay what is recorded, record what is not (default)
+#   replay  never go online: a request that was not recorded fails like a network error
+#   record  always go online and record the response again
+
+import base64
+import email.message
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import urllib.response
+
+MODES = ('auto', 'replay', 'record')
+
+# Headers that describe the transfer rather than the content, which is stored decoded
+SKIP_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie')
+
+config = {'directory': None, 'mode': None}
+stats = {'replayed': 0, 'recorded': 0, 'misses': []}
+lock = threading.Lock()
+
+
+def request_key(method, url, body):
+    # The same request gives the same key: query parameters in any order, and the body by its hash
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    url = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+    if isinstance(body, str):
+        body = body.encode()
+    key = '{} {}\n{}'.format(method.upper(), url, hashlib.sha1(body or b'').hexdigest())
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def load(key):
+    try:
+        with open(os.path.join(config['directory'], key + '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save(key, method, url, status, reason, headers, body):
+    # One file per request, written atomically, so forked test workers can record at the same time
+    entry = {
+        'method': method.upper(),
+        'url': url,
+        'status': status,
+        'reason': reason,
+        'headers': [ [name, value] for name, value in headers if name.lower() not in SKIP_HEADERS ],
+    }
+    try:
+        entry['text'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        entry['base64'] = base64.b64encode(body).decode('ascii')
+    os.makedirs(config['directory'], exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=config['directory'], suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(tmp, os.path.join(config['directory'], key + '.json'))
+    with lock:
+        stats['recorded'] += 1
+    print('> Recorded', method.upper(), url, file=sys.stderr)
+    return entry
+
+
+def body_of(entry):
+    if 'base64' in entry:
+        return base64.b64decode(entry['base64'])
+    return entry['text'].encode('utf-8')
+
+
+def lookup(method, url, body):
+    # (key, recorded entry or None). None also means: go online, unless the mode forbids it
+    key = request_key(method, url, body)
+    entry = load(key) if config['mode'] != 'record' else None
+    if entry is not None:
+        with lock:
+            stats['replayed'] += 1
+    elif config['mode'] == 'replay':
+        with lock:
+            stats['misses'].append('{} {}'.format(method.upper(), url))
+        print('> No recorded response for', method.upper(), url, file=sys.stderr)
+    return key, entry
+
+
+def miss_message(method, url):
+    return 'No recorded response for {} {} (the tests run offline)'.format(method.upper(), url)
+
+
+def install_requests():
+    try:
+        import requests
+        import requests.adapters
+        import requests.structures
+        import requests.utils
+    except ImportError:
+        return
+    send = requests.adapters.HTTPAdapter.send
+
+    def response_of(request, entry):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        # Read as a whole already, but code that streams (stream=True, iter_content, raw) works as well
+        response._content = body_of(entry)
+        response._content_consumed = True
+        response.raw = io.BytesIO(response._content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def cached_send(self, request, *args, **kwargs):
+        key, entry = lookup(request.method, request.url, request.body)
+        if entry is None:
+            if config['mode'] == 'replay':
+                raise requests.ConnectionError(miss_message(request.method, request.url), request=request)
+            response = send(self, request, *args, **kwargs)
+            entry = save(key, request.method, request.url, response.status_code, response.reason,
+                         response.headers.items(), response.content)
+        return response_of(request, entry)
+
+    requests.adapters.HTTPAdapter.send = cached_send
+
+
+def install_urllib():
+    opener_open = urllib.request.OpenerDirector.open
+
+    def response_of(url, entry):
+        headers = email.message.Message()
+        for name, value in entry['headers']:
+            headers[name] = value
+        if entry['status'] >= 400:
+            raise urllib.error.HTTPError(url, entry['status'], entry['reason'], headers, io.BytesIO(body_of(entry)))
+        return urllib.response.addinfourl(io.BytesIO(body_of(entry)), headers, url, entry['status'])
+
+    def cached_open(self, fullurl, data=None, *args, **kwargs):
+        request = fullurl if isinstance(fullurl, urllib.request.Request) else urllib.request.Request(fullurl)
+        if data is not None:
+            request.data = data
+        method, url = request.get_method(), request.full_url
+        key, entry = lookup(method, url, request.data)
+        if entry is None:
+            if config['mode'] == 'replay':
+                raise urllib.error.URLError(miss_message(method, url))
+            try:
+                with opener_open(self, request, None, *args, **kwargs) as response:
+                    entry = save(key, method, url, response.status, response.reason, response.headers.items(), response.read())
+            except urllib.error.HTTPError as E:
+                entry = save(key, method, url, E.code, E.reason, E.headers.items(), E.read())
+        return response_of(url, entry)
+
+    urllib.request.OpenerDirector.open = cached_open
+
+
+def install(path, mode=None):
+    # Start answering HTTP requests from the fixture cache in `path`; call before importing the student's code
+    if config['directory'] is not None:
+        return
+    mode = mode or os.environ.get('AUTOTEST_NET') or 'auto'
+    if mode not in MODES:
+        raise ValueError('Unknown mode {!r}, expected one of {}'.format(mode, ', '.join(MODES)))
+    config.update(directory=path, mode=mode)
+    install_requests()
+    install_urllib()
+
+
+def take_stats():
+    # The counts since the last call, e.g. of one test in a forked worker of runner.py
+    with lock:
+        counts = {'replayed': stats['replayed'], 'recorded': stats['recorded'], 'misses': stats['misses']}
+        stats.update(replayed=0, recorded=0, misses=[])
+    return counts
+
+
+def add_stats(counts):
+    # Counts sent back by a worker
+    with lock:
+        stats['replayed'] += counts['replayed']
+        stats['recorded'] += counts['recorded']
+        stats['misses'].extend(counts['misses'])
+
+
+def report():
+    # Summary of this process, including the tests that runner.py ran in workers
+    print('> {} request(s) replayed, {} recorded, {} not recorded'.format(
+        stats['replayed'], stats['recorded'], len(stats['misses'])))
+    for miss in stats['misses']:
+        print('>  ', miss)
@@ -0,0 +1,272 @@
+# Reference outputs of the solution, computed once in the Setup of the AutoTest instead of in
+# every test run. The build step runs the solution and stores its outputs in the `reference`
+# folder next to the test scripts: arrays and raster bands as .npy files, which the tests
+# memory-map instead of reading, vector data as GeoJSON, images as hashes of their pixels and
+# small values as JSON, all listed in manifest.json. The tests compare the student's outputs
+# with the assert_* helpers, built on those of assertions.py.
+#
+#   python $UPLOADED_FILES/tmp/test/autotest/reference.py --solution $UPLOADED_FILES/tmp --run "python main.py" \
+#       output/ndvi.tif output/fields.geojson output/output_image.png
+#
+#   from autotest import reference
+#   ref = reference.load()
+#   def test_ndvi():
+#       reference.assert_raster_close(ref, 'output/ndvi.tif', args.student_path + '/output/ndvi.tif', atol=1e-4)
+#
+# numpy is needed for all outputs, rasterio for rasters, geopandas for vector data and Pillow for
+# images; those are only imported for outputs of that kind.
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from autotest import assertions
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'reference')
+
+RASTERS = ('.tif', '.tiff', '.img', '.vrt', '.nc', '.asc')
+VECTORS = ('.geojson', '.json', '.shp', '.gpkg', '.kml')
+IMAGES = ('.png', '.jpg', '.jpeg')
+
+
+def file_name(name):
+    # Name of an output as a file name in the reference folder
+    return re.sub(r'[^A-Za-z0-9._-]+', '__', name)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pixel_hash(path):
+    # Hash of the pixels, which unlike the file does not change with the PNG metadata (e.g. the matplotlib version)
+    from PIL import Image
+    with Image.open(path) as image:
+        image = image.convert('RGBA')
+        return hashlib.sha256(image.tobytes()).hexdigest(), list(image.size)
+
+
+class Reference:
+    # The reference folder: manifest.json with an entry per output, and the files of the arrays
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+        try:
+            with open(os.path.join(directory, 'manifest.json')) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def entry(self, name, kind):
+        if name not in self.entries:
+            raise KeyError('There is no reference output {!r} in {}'.format(name, self.directory))
+        if self.entries[name]['kind'] != kind:
+            raise KeyError('Reference output {!r} is a {}, not a {}'.format(name, self.entries[name]['kind'], kind))
+        return self.entries[name]
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = os.path.join(self.directory, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(self.directory, 'manifest.json'))
+
+    # Building
+
+    def add(self, name, value):
+        # An array or a JSON value
+        import numpy as np
+        os.makedirs(self.directory, exist_ok=True)
+        if isinstance(value, np.ndarray):
+            filename = file_name(name) + '.npy'
+            np.save(os.path.join(self.directory, filename), value)
+            self.entries[name] = {'kind': 'array', 'file': filename, 'shape': list(value.shape), 'dtype': str(value.dtype)}
+        else:
+            self.entries[name] = {'kind': 'value', 'value': value}
+
+    def add_file(self, name, path):
+        # An output file of the solution, stored according to its extension
+        extension = os.path.splitext(path)[1].lower()
+        os.makedirs(self.directory, exist_ok=True)
+        if extension in RASTERS:
+            self.add_raster(name, path)
+        elif extension in VECTORS:
+            self.add_vector(name, path)
+        elif extension in IMAGES:
+            digest, size = pixel_hash(path)
+            self.entries[name] = {'kind': 'image', 'sha256': digest, 'size': size, 'dhash': assertions.image_hash(path)}
+        elif extension == '.npy':
+            import numpy as np
+            self.add(name, np.load(path, mmap_mode='r'))
+        else:
+            self.entries[name] = {'kind': 'file', 'sha256': file_hash(path)}
+
+    def add_raster(self, name, path):
+        # Every band to its own .npy, read in chunks of rows so large rasters fit in memory
+        import numpy as np
+        import rasterio
+        import rasterio.windows
+        with rasterio.open(path) as src:
+            rows = assertions.chunk_rows((src.height, src.width))
+            bands = []
+            for band in range(1, src.count + 1):
+                filename = '{}.band{}.npy'.format(file_name(name), band)
+                out = np.lib.format.open_memmap(os.path.join(self.directory, filename), mode='w+',
+                                                dtype=src.dtypes[band - 1], shape=(src.height, src.width))
+                for row in range(0, src.height, rows):
+                    window = rasterio.windows.Window(0, row, src.width, min(rows, src.height - row))
+                    out[row:row + window.height] = src.read(band, window=window)
+                out.flush()
+                del out
+                bands.append(filename)
+            self.entries[name] = {
+                'kind': 'raster',
+                'bands': bands,
+                'shape': [src.count, src.height, src.width],
+                'dtype': src.dtypes[0],
+                'crs': src.crs.to_wkt() if src.crs else None,
+                'transform': list(src.transform)[:6],
+                'nodata': src.nodata,
+            }
+
+    def add_vector(self, name, path):
+        import geopandas
+        frame = geopandas.read_file(path)
+        filename = file_name(name) + '.geojson'
+        frame.to_file(os.path.join(self.directory, filename), driver='GeoJSON')
+        self.entries[name] = {
+            'kind': 'vector',
+            'file': filename,
+            'features': len(frame),
+            'crs': frame.crs.to_wkt() if frame.crs else None,
+        }
+
+    # Reading
+
+    def value(self, name):
+        return self.entry(name, 'value')['value']
+
+    def array(self, name):
+        # Memory-mapped, only the parts that are compared are read
+        import numpy as np
+        return np.load(os.path.join(self.directory, self.entry(name, 'array')['file']), mmap_mode='r')
+
+    def band(self, name, band=1):
+        import numpy as np
+        return np.load(os.path.join(self.directory, self.entry(name, 'raster')['bands'][band - 1]), mmap_mode='r')
+
+    def vector(self, name):
+        import geopandas
+        frame = geopandas.read_file(os.path.join(self.directory, self.entry(name, 'vector')['file']))
+        crs = self.entries[name]['crs']
+        # Back in the CRS of the solution, in case the GeoJSON driver wrote WGS84
+        return frame.to_crs(crs) if crs and frame.crs is not None else frame
+
+
+def load(directory=DEFAULT_DIR):
+    if not os.path.exists(os.path.join(directory, 'manifest.json')):
+        raise FileNotFoundError('No reference outputs in {}, run reference.py in the Setup first'.format(directory))
+    return Reference(directory)
+
+
+# Comparisons, raising AssertionError with a message that can be shown to the student
+
+def assert_value_close(ref, name, actual, rtol=1e-9, atol=0.0):
+    expected = ref.value(name)
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        assert math.isclose(actual, expected, rel_tol=rtol, abs_tol=atol), \
+            '{}: expected {:g}, got {:g}'.format(name, expected, actual)
+    else:
+        assert actual == expected, '{}: the result is not correct'.format(name)
+
+
+def assert_array_close(ref, name, actual, rtol=1e-5, atol=1e-8, nodata=None, max_fraction=0.0):
+    return assertions.assert_arrays_close(ref.array(name), actual, rtol, atol, nodata, max_fraction, label=name)
+
+
+def assert_raster_close(ref, name, path, rtol=1e-5, atol=1e-8, max_fraction=0.0):
+    # The raster at `path` has the grid of the reference and values within tolerance, read a band chunk at a time
+    import rasterio.crs
+    entry = ref.entry(name, 'raster')
+    count, height, width = entry['shape']
+    with assertions.open_raster(path, name) as src:
+        crs = rasterio.crs.CRS.from_wkt(entry['crs']) if entry['crs'] else None
+        assertions.assert_same_grid(name, count, height, width, crs, entry['transform'], src)
+        for band in range(1, count + 1):
+            label = '{} (band {})'.format(name, band) if count > 1 else name
+            diff = assertions.array_diff(ref.band(name, band), assertions.BandRows(src, band), rtol, atol,
+                                         entry['nodata'], src.nodata)
+            assert diff.fraction <= max_fraction, diff.message(label)
+
+
+def assert_vector_close(ref, name, actual, tolerance=1e-6, ordered=True):
+    # `actual` is a file or a GeoDataFrame with a geometry within `tolerance` (in units of the
+    # solution's CRS) of each expected one, at the same position or, with ordered=False, in any order
+    return assertions.assert_geometries_close(ref.vector(name), actual, tolerance, ordered, label=name)
+
+
+def assert_image_matches(ref, name, path):
+    entry = ref.entry(name, 'image')
+    assert os.path.exists(path), '{}: the file {} does not exist'.format(name, os.path.basename(path))
+    try:
+        digest, size = pixel_hash(path)
+    except OSError:
+        # PIL's UnidentifiedImageError, or a truncated image
+        raise AssertionError('{}: {} is not an image that can be read'.format(name, os.path.basename(path)))
+    assert size == entry['size'], '{}: expected an image of {} x {} pixels, got {} x {}'.format(name, *entry['size'], *size)
+    assert digest == entry['sha256'], '{}: the image differs from the expected image'.format(name)
+
+
+def assert_image_similar(ref, name, path, max_distance=6):
+    # Looks like the expected image, for plots that differ a little between versions of matplotlib
+    entry = ref.entry(name, 'image')
+    if 'dhash' not in entry:
+        raise KeyError('Reference output {!r} has no image hash, run reference.py again'.format(name))
+    return assertions.assert_images_similar(entry['dhash'], path, max_distance, label=name)
+
+
+def assert_file_matches(ref, name, path):
+    entry = ref.entry(name, 'file')
+    assert os.path.exists(path), '{}: the file {} does not exist'.format(name, os.path.basename(path))
+    assert file_hash(path) == entry['sha256'], '{}: the file differs from the expected file'.format(name)
+
+
+def build(solution, outputs, run=None, directory=DEFAULT_DIR):
+    # Run the solution (a shell command in its folder) and store the given output files
+    if run:
+        print('>', 'Running', run, 'in', solution)
+        completed = subprocess.run(run, shell=True, cwd=solution)
+        if completed.returncode != 0:
+            sys.exit('The solution failed with exit code {}'.format(completed.returncode))
+    ref = Reference(directory)
+    for name in outputs:
+        path = os.path.join(solution, name)
+        if not os.path.exists(path):
+            sys.exit('The solution did not write {}'.format(name))
+        ref.add_file(name, path)
+        print('>', name + ':', ref.entries[name]['kind'])
+    ref.save()
+    return ref
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Store the outputs of the solution as references for the AutoTests')
+    parser.add_argument('outputs', nargs='+', help='output files, relative to the solution folder')
+    parser.add_argument('--solution', required=True, help='folder of the solution repository')
+    parser.add_argument('--run', help='command that creates the outputs, run in the solution folder (e.g. "python main.py")')
+    parser.add_argument('--reference', default=DEFAULT_DIR, help='folder to store the references in (default: %(default)s)')
+    args = parser.parse_args()
+    build(args.solution, args.outputs, run=args.run, directory=args.reference)
+
+
+if __name__ == '__main__':
+    main()
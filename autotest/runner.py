@@ -0,0 +1,269 @@
+# Runs all tests of a test script in one process and caches their results.
+# Every rubric cell calls the test script with its own --test N. The first cell runs all tests
+# (one interpreter start, one import of the student's code and of GDAL, geopandas, ...) and
+# writes the results file; the other cells only read their result from that file, before the
+# script imports anything heavy. The results are thrown away when the student's files change.
+# Each test runs in a worker forked from the warm process, with a time and memory limit, so a
+# test that hangs or allocates too much fails on its own instead of taking the cell down.
+# Tests run in parallel over the available cores.
+#
+#   sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+#   from autotest import runner
+#   args = runner.parse_args()
+#   import distanceCalculator
+#   ...
+#   runner.run_tests({1: test_geolocator, 2: test_calc_distances}, args)
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from autotest import netcache
+
+try:
+    import resource
+except ImportError:
+    # Windows, where the tests run without a memory limit
+    resource = None
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'autotest')
+
+
+def results_file(script, student_path):
+    # One results file per test script and submission
+    key = os.path.abspath(script) + '\n' + os.path.abspath(student_path)
+    return os.path.join(CACHE_DIR, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+
+def fingerprint(student_path, script):
+    # Changes when a file of the student or the test script changes
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(student_path):
+        dirs[:] = sorted(d for d in dirs if d not in ('.git', '__pycache__'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            digest.update('{}\0{}\0{}\n'.format(os.path.relpath(path, student_path), stat.st_size, stat.st_mtime_ns).encode())
+    stat = os.stat(script)
+    digest.update('{}\0{}\0{}\n'.format(os.path.abspath(script), stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def load_results(filename, expected):
+    # {test number (str): result} of an earlier run on the same files, or None
+    try:
+        with open(filename) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('fingerprint') != expected:
+        return None
+    return cached.get('tests')
+
+
+def save_results(filename, key, results):
+    # Written to a temporary file first, so a cell never reads half a results file
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'fingerprint': key, 'tests': results}, f, indent=1)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def parse_args(description=None):
+    # The documented --student_path and --test, plus the results file. Exits at once with the cached
+    # result of --test when there is one, so call this before importing the student's module.
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--student_path', type=str, default='/home/codegrade/student',
+                        help='Path to student answer directory')
+    parser.add_argument('--test', type=int, help='Select the test to report (default: all tests)')
+    parser.add_argument('--results', help='results file shared by the rubric cells (default: one per script and '
+                        'student path in ' + CACHE_DIR + ')')
+    parser.add_argument('--rerun', action='store_true', help='ignore earlier results and run all tests again')
+    parser.add_argument('--timeout', type=float, help='seconds a test may take (default: see run_tests)')
+    parser.add_argument('--memory', type=int, help='MB a test may allocate (default: see run_tests)')
+    parser.add_argument('--workers', type=int, help='tests to run at the same time (default: one per core)')
+    args = parser.parse_args()
+
+    args.results = args.results or results_file(sys.argv[0], args.student_path)
+    args.fingerprint = fingerprint(args.student_path, sys.argv[0])
+    if args.test is not None and not args.rerun:
+        cached = load_results(args.results, args.fingerprint)
+        if cached is not None and str(args.test) in cached:
+            sys.exit(report(cached, args.test))
+    sys.path.append(args.student_path)
+    return args
+
+
+def result(passed, message, start):
+    return {'passed': passed, 'message': message, 'seconds': round(time.perf_counter() - start, 3)}
+
+
+def run_test(fun, memory=None):
+    # Like try_function, but returns the result instead of exiting
+    start = time.perf_counter()
+    try:
+        fun()
+    except AssertionError as E:
+        return result(False, str(E), start)
+    except MemoryError:
+        return result(False, 'The test ran out of memory{}'.format(
+            ' (it may use {} MB)'.format(memory) if memory else ''), start)
+    except SystemExit as E:
+        return result(False, 'The code stopped the test with exit({})'.format(E.code), start)
+    except Exception as E:
+        # A crash in the student's code instead of a failed check: no stack trace, which may give away the solution
+        return result(False, 'The test could not run: {}: {}'.format(type(E).__name__, E), start)
+    return result(True, '', start)
+
+
+def limit_memory(megabytes):
+    # The limit is on the address space, of which numpy, GDAL, ... already reserve a lot at import,
+    # so the test may map `megabytes` on top of what the process had when it was forked
+    try:
+        with open('/proc/self/statm') as f:
+            in_use = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = in_use + megabytes * 2 ** 20
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def worker(fun, memory, connection):
+    # Runs in the forked process
+    if memory and resource is not None:
+        limit_memory(memory)
+    if netcache.config['directory'] is not None:
+        # Counted here, sent back with the result, so the parent can report them
+        netcache.take_stats()
+        outcome = dict(run_test(fun, memory), net=netcache.take_stats())
+    else:
+        outcome = run_test(fun, memory)
+    connection.send(outcome)
+    connection.close()
+
+
+def start_worker(context, fun, memory):
+    receive, send = context.Pipe(duplex=False)
+    process = context.Process(target=worker, args=(fun, memory, send), daemon=True)
+    process.start()
+    send.close()
+    return process, receive
+
+
+def exit_reason(exitcode):
+    if exitcode is not None and exitcode < 0:
+        try:
+            return 'stopped by ' + signal.Signals(-exitcode).name
+        except ValueError:
+            pass
+    return 'exit code {}'.format(exitcode)
+
+
+def run_parallel(tests, timeout, memory, workers):
+    # {number: result} of running every test in its own forked process, at most `workers` at a time.
+    # A worker is forked per test rather than reused, so a test that is stopped or ran out of memory
+    # does not affect the next one, and every test starts from the state after the imports.
+    context = multiprocessing.get_context('fork')
+    # Or the workers print what is still buffered again
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pending = list(tests.items())
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            number, fun = pending.pop(0)
+            process, receive = start_worker(context, fun, memory)
+            running[receive] = (number, process, time.perf_counter())
+        wait = None
+        if timeout:
+            wait = max(0, min(start for number, process, start in running.values()) + timeout - time.perf_counter())
+        for receive in multiprocessing.connection.wait(list(running), timeout=wait):
+            number, process, start = running.pop(receive)
+            try:
+                results[number] = receive.recv()
+            except EOFError:
+                # Died without a result, e.g. killed by the system for its memory use or a crash in a C library
+                process.join()
+                results[number] = result(False, 'The test crashed ({})'.format(exit_reason(process.exitcode)), start)
+            receive.close()
+            process.join()
+        for receive, (number, process, start) in list(running.items()):
+            if timeout and time.perf_counter() - start >= timeout:
+                process.kill()
+                process.join()
+                receive.close()
+                del running[receive]
+                results[number] = result(False, 'The test took longer than {:g} seconds and was stopped'.format(timeout), start)
+    return results
+
+
+def run_tests(tests, args, timeout=60, memory=2048, workers=None):
+    # Runs all tests ({number: function}), stores their results for the other rubric cells and
+    # reports the selected test. Exits with 1 when it failed, like try_function.
+    # Every test may take `timeout` seconds and allocate `memory` MB (None for no limit); the
+    # --timeout, --memory and --workers of the command line take precedence.
+    if args.test is not None and args.test not in tests:
+        print('There is no test', args.test)
+        sys.exit(2)
+    timeout = args.timeout if args.timeout is not None else timeout
+    memory = args.memory if args.memory is not None else memory
+    workers = args.workers or workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        outcomes = run_parallel(tests, timeout, memory, workers)
+    else:
+        # No fork (Windows): in this process, without limits
+        outcomes = { number: run_test(fun) for number, fun in tests.items() }
+    for outcome in outcomes.values():
+        if 'net' in outcome:
+            netcache.add_stats(outcome.pop('net'))
+    results = { str(number): dict(outcomes[number], name=fun.__name__) for number, fun in tests.items() }
+    # Taken after the run: tests that make the student's code write its outputs (e.g. output/*.png)
+    # change the files, and the next cells have to match the files as the run left them
+    save_results(args.results, fingerprint(args.student_path, sys.argv[0]), results)
+    if args.test is None:
+        print('Ran {} test(s) in {:.2f}s'.format(len(results), time.perf_counter() - start))
+        if netcache.config['directory'] is not None:
+            netcache.report()
+    sys.exit(report(results, args.test))
+
+
+def report(results, test=None):
+    # Prints the message of the selected test (or of all tests), returns the exit code
+    selected = [str(test)] if test is not None else list(results)
+    failed = False
+    for number in selected:
+        if test is None:
+            print('> Test {} ({}): {} in {:.2f}s'.format(number, results[number].get('name', ''),
+                  'passed' if results[number]['passed'] else 'failed', results[number]['seconds']))
+        if results[number]['message']:
+            print(results[number]['message'])
+        failed = failed or not results[number]['passed']
+    return 1 if failed else 0
+
+
+def try_function(fun):
+    # The documented helper, for test scripts that do not use run_tests
+    outcome = run_test(fun)
+    if not outcome['passed']:
+        print(outcome['message'])
+        sys.exit(1)
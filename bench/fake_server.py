@@ -0,0 +1,594 @@
+# Fake GitLab (v4) and CodeGrade (v1) API for benchmarking the scripts offline.
+# Serves one course with `groups` groups of two students, one assignment with a GitLab
+# template, and only the endpoints that the scripts use. Every request can be slowed down
+# (latency) or refused with a 429 (throttle), and GitLab listings are paginated like the real thing.
+#
+#   python fake_server.py --groups 200 --latency 0.02 --throttle 0.01
+#
+# GET /_bench/stats returns the number of requests per endpoint, POST /_bench/reset clears them.
+
+import argparse
+import base64
+import collections
+import hashlib
+import http.server
+import itertools
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+
+TENANT = 'Bench University'
+COURSE_ID = 1000
+ASSIGNMENT_ID = 2000
+GROUP_SET_ID = 3000
+ROOT_GROUP = 'bench-2025'
+SUBGROUP = 'exercise-01'
+TEMPLATE = 'exercise-01-starter'
+
+
+def cg_username(i):
+    return 'student{:04d}@bench.example'.format(i)
+
+
+def gl_username(i):
+    return 'student{:04d}'.format(i)
+
+
+class NotFound(Exception):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class World:
+    # All state of the fake servers. One lock, the scripts' concurrency is what is measured, not ours.
+    def __init__(self, groups=50, page_size=20, fork_time=0.5):
+        self.page_size = page_size
+        self.fork_time = fork_time
+        self.lock = threading.Lock()
+        self.ids = itertools.count(10)
+
+        # CodeGrade
+        self.cg_users = [ {'id': next(self.ids), 'name': 'Student {}'.format(i), 'username': cg_username(i)}
+                          for i in range(2 * groups) ]
+        self.cg_groups = [ {'id': next(self.ids), 'name': 'Team {:04d}'.format(i), 'members': self.cg_users[2 * i:2 * i + 2]}
+                           for i in range(groups) ]
+        self.group_sets = {GROUP_SET_ID: {'id': GROUP_SET_ID, 'minimum_size': 1, 'maximum_size': 2, 'groups': self.cg_groups}}
+        self.webhooks = {}
+
+        # GitLab
+        self.users = [ {'id': 1, 'username': 'bench-admin', 'name': 'Bench Admin', 'state': 'active'} ]
+        self.users += [ {'id': next(self.ids), 'username': gl_username(i), 'name': 'Student {}'.format(i), 'state': 'active',
+                         'email': cg_username(i)}
+                        for i in range(2 * groups) ]
+        self.groups = {}
+        for path in (ROOT_GROUP, ROOT_GROUP + '/staff', ROOT_GROUP + '/students',
+                     ROOT_GROUP + '/staff/' + SUBGROUP, ROOT_GROUP + '/students/' + SUBGROUP):
+            group_id = next(self.ids)
+            self.groups[group_id] = {'id': group_id, 'full_path': path, 'path': path.split('/')[-1],
+                                     'name': path.split('/')[-1], 'parent_path': path.rpartition('/')[0]}
+        # The students that joined the course group, all but the last one
+        self.group_members = {self.group_by_path(ROOT_GROUP)['id']: self.users[1:-1]}
+        self.projects = {}
+        staff = self.group_by_path(ROOT_GROUP + '/staff/' + SUBGROUP)
+        self.template = self.new_project(staff, TEMPLATE, TEMPLATE, ready_at=0)
+
+    # --- GitLab helpers
+
+    def group_by_path(self, ref):
+        ref = unquote(str(ref))
+        for group in self.groups.values():
+            if str(group['id']) == ref or group['full_path'] == ref:
+                return group
+        raise NotFound('group ' + ref)
+
+    def project(self, ref):
+        ref = unquote(str(ref))
+        if ref.isdigit() and int(ref) in self.projects:
+            return self.projects[int(ref)]
+        for project in self.projects.values():
+            if self.full_path(project) == ref:
+                return project
+        raise NotFound('project ' + ref)
+
+    def full_path(self, project):
+        return self.groups[project['namespace_id']]['full_path'] + '/' + project['path']
+
+    def new_project(self, group, name, path, ready_at):
+        if any(p['namespace_id'] == group['id'] and p['path'] == path for p in self.projects.values()):
+            raise Conflict({'name': ['has already been taken'], 'path': ['has already been taken']})
+        project_id = next(self.ids)
+        self.projects[project_id] = {
+            'id': project_id, 'name': name, 'path': path, 'namespace_id': group['id'],
+            'protected': ['main'], 'members': {}, 'keys': [], 'hooks': [], 'shared_with': set(),
+            'ready_at': ready_at, 'forks_count': 0,
+        }
+        return self.projects[project_id]
+
+    def project_json(self, project, base):
+        group = self.groups[project['namespace_id']]
+        return {
+            'id': project['id'],
+            'name': project['name'],
+            'path': project['path'],
+            'path_with_namespace': self.full_path(project),
+            'web_url': base + '/' + self.full_path(project),
+            'namespace': {'id': group['id'], 'full_path': group['full_path'], 'path': group['path'], 'kind': 'group'},
+            'import_status': 'finished' if time.monotonic() >= project['ready_at'] else 'started',
+            'forks_count': project['forks_count'],
+            'default_branch': 'main',
+        }
+
+    def group_json(self, group, base):
+        return dict(group, web_url=base + '/groups/' + group['full_path'])
+
+    def subgroups(self, group):
+        return [ g for g in self.groups.values() if g['full_path'].startswith(group['full_path'] + '/') ]
+
+    # --- CodeGrade helpers
+
+    def webhook(self, author):
+        if author not in self.webhooks:
+            digest = hashlib.sha256(str(author).encode()).hexdigest()
+            self.webhooks[author] = {
+                'id': '{}-{}-{}-{}-{}'.format(digest[:8], digest[8:12], digest[12:16], digest[16:20], digest[20:32]),
+                'secret': digest[32:64],
+                'public_key': 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAA' + digest[:32] + ' codegrade',
+            }
+        return self.webhooks[author]
+
+
+def token(username):
+    # An unsigned JWT, the scripts only read its 'exp'
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+    return '.'.join([part({'alg': 'none'}), part({'sub': username, 'exp': int(time.time()) + 3600}), 'bench'])
+
+
+ROUTES = []
+
+def route(method, pattern):
+    # Register a handler for METHOD /path, `pattern` uses :name for path parameters
+    regex = re.compile('^' + re.sub(r':(\w+)', r'(?P<\1>[^/]+)', pattern) + '$')
+    def register(fn):
+        ROUTES.append((method, regex, pattern, fn))
+        return fn
+    return register
+
+
+# --- CodeGrade
+
+@route('GET', '/api/v1/tenants/')
+def cg_tenants(req):
+    return [ {'id': 'bench-tenant', 'name': TENANT} ]
+
+@route('POST', '/api/v1/login')
+def cg_login(req):
+    return {'access_token': token(req.params.get('username', 'bench')), 'user': {'id': 1, 'username': 'bench'}}
+
+@route('GET', '/api/v1/login')
+def cg_whoami(req):
+    return {'id': 1, 'username': 'bench', 'name': 'Bench Teacher'}
+
+@route('GET', '/api/v1/assignments/:id')
+def cg_assignment(req, id):
+    return {'id': int(id), 'name': 'Exercise 1', 'group_set': {'id': GROUP_SET_ID, 'minimum_size': 1, 'maximum_size': 2}}
+
+@route('GET', '/api/v1/group_sets/:id/groups/')
+def cg_groups(req, id):
+    if int(id) not in req.world.group_sets:
+        raise NotFound('group set ' + id)
+    return req.world.group_sets[int(id)]['groups']
+
+def group_set_json(group_set):
+    return { key: value for key, value in group_set.items() if key != 'groups' }
+
+@route('GET', '/api/v1/courses/:id/group_sets/')
+def cg_group_sets(req, id):
+    return [ group_set_json(group_set) for group_set in req.world.group_sets.values() ]
+
+@route('PUT', '/api/v1/courses/:id/group_sets/')
+def cg_put_group_set(req, id):
+    # Creates a group set, or updates the one with the given id
+    world = req.world
+    with world.lock:
+        if 'id' in req.params:
+            group_set = world.group_sets[int(req.params['id'])]
+        else:
+            group_set = {'id': next(world.ids), 'groups': []}
+            world.group_sets[group_set['id']] = group_set
+        group_set.update(minimum_size=int(req.params['minimum_size']), maximum_size=int(req.params['maximum_size']))
+        return group_set_json(group_set)
+
+@route('POST', '/api/v1/group_sets/:id/group')
+def cg_create_group(req, id):
+    world = req.world
+    with world.lock:
+        if int(id) not in world.group_sets:
+            raise NotFound('group set ' + id)
+        users = { user['id']: user for user in world.cg_users }
+        group = {'id': next(world.ids), 'name': req.params['name'],
+                 'members': [ users[int(i)] for i in req.params['member_ids'] ]}
+        world.group_sets[int(id)]['groups'].append(group)
+        return group
+
+@route('GET', '/api/v1/courses/:id/users/')
+def cg_course_users(req, id):
+    teacher = {'User': {'id': 1, 'name': 'Bench Teacher', 'username': 'bench'}, 'CourseRole': {'name': 'Teacher'}}
+    return [teacher] + [ {'User': user, 'CourseRole': {'name': 'Student'}} for user in req.world.cg_users ]
+
+@route('POST', '/api/v1/assignments/:id/webhook_settings')
+def cg_webhook_settings(req, id):
+    with req.world.lock:
+        return req.world.webhook(req.params.get('author_id'))
+
+
+# --- GitLab
+
+@route('GET', '/api/v4/user')
+def gl_current_user(req):
+    return req.world.users[0]
+
+@route('GET', '/api/v4/users')
+def gl_users(req):
+    users = req.world.users
+    if 'username' in req.params:
+        users = [ u for u in users if u['username'] == req.params['username'] ]
+    if 'search' in req.params:
+        # Username, name or (for admins) email address
+        term = req.params['search'].lower()
+        users = [ u for u in users if term in u['username'] or term in u['name'].lower() or term == u.get('email') ]
+    return req.paginate(users)
+
+@route('GET', '/api/v4/groups/:group')
+def gl_group(req, group):
+    return req.world.group_json(req.world.group_by_path(group), req.base)
+
+@route('GET', '/api/v4/groups/:group/members/all')
+def gl_group_members_all(req, group):
+    # Members of the group and of the groups above it
+    world = req.world
+    path = world.group_by_path(group)['full_path']
+    members = [ dict(world.users[0], access_level=50) ]
+    for g in world.groups.values():
+        if path == g['full_path'] or path.startswith(g['full_path'] + '/'):
+            members += [ dict(user, access_level=30) for user in world.group_members.get(g['id'], []) ]
+    return req.paginate(members)
+
+@route('GET', '/api/v4/groups/:group/descendant_groups')
+def gl_descendant_groups(req, group):
+    world = req.world
+    return req.paginate([ world.group_json(g, req.base) for g in world.subgroups(world.group_by_path(group)) ])
+
+@route('GET', '/api/v4/groups/:group/projects')
+def gl_group_projects(req, group):
+    world = req.world
+    group = world.group_by_path(group)
+    namespaces = {group['id']}
+    if req.flag('include_subgroups'):
+        namespaces |= { g['id'] for g in world.subgroups(group) }
+    with world.lock:
+        projects = [ p for p in world.projects.values()
+                     if p['namespace_id'] in namespaces or (req.flag('with_shared', True) and group['id'] in p['shared_with']) ]
+        return req.paginate([ world.project_json(p, req.base) for p in projects ])
+
+@route('GET', '/api/v4/projects/:project')
+def gl_project(req, project):
+    return req.world.project_json(req.world.project(project), req.base)
+
+@route('POST', '/api/v4/projects/:project/fork')
+def gl_fork(req, project):
+    world = req.world
+    with world.lock:
+        source = world.project(project)
+        group = world.group_by_path(req.params.get('namespace_path') or req.params.get('namespace_id') or req.params['namespace'])
+        fork = world.new_project(group, req.params.get('name', source['name']), req.params.get('path', source['path']),
+                                 ready_at=time.monotonic() + world.fork_time)
+        fork['protected'] = list(source['protected'])
+        source['forks_count'] += 1
+        return world.project_json(fork, req.base)
+
+@route('GET', '/api/v4/projects/:project/protected_branches')
+def gl_protected_branches(req, project):
+    project = req.world.project(project)
+    return req.paginate([ {'id': i, 'name': name} for i, name in enumerate(project['protected']) ])
+
+@route('DELETE', '/api/v4/projects/:project/protected_branches/:name')
+def gl_unprotect(req, project, name):
+    with req.world.lock:
+        project = req.world.project(project)
+        if unquote(name) not in project['protected']:
+            raise NotFound('protected branch ' + name)
+        project['protected'].remove(unquote(name))
+
+@route('GET', '/api/v4/projects/:project/members/all')
+def gl_members_all(req, project):
+    project = req.world.project(project)
+    admin = dict(req.world.users[0], access_level=50)
+    return req.paginate([admin] + list(project['members'].values()))
+
+@route('POST', '/api/v4/projects/:project/members')
+def gl_add_member(req, project):
+    world = req.world
+    with world.lock:
+        project = world.project(project)
+        user = next(( u for u in world.users if str(u['id']) == str(req.params['user_id']) ), None)
+        if user is None:
+            raise NotFound('user')
+        if user['username'] in project['members']:
+            raise Conflict('Member already exists')
+        member = dict(user, access_level=int(req.params.get('access_level', 30)))
+        project['members'][user['username']] = member
+        return member
+
+@route('POST', '/api/v4/projects/:project/share')
+def gl_share(req, project):
+    with req.world.lock:
+        project = req.world.project(project)
+        project['shared_with'].add(int(req.params['group_id']))
+        return {'id': project['id'], 'project_id': project['id'], 'group_id': int(req.params['group_id']),
+                'group_access': int(req.params.get('group_access', 20))}
+
+@route('DELETE', '/api/v4/projects/:project/share/:group')
+def gl_unshare(req, project, group):
+    with req.world.lock:
+        req.world.project(project)['shared_with'].discard(int(group))
+
+def public(items):
+    # GitLab never returns the secret token of a hook
+    return [ { key: value for key, value in item.items() if key != 'token' } for item in items ]
+
+def child(project, kind, ref):
+    for item in project[kind]:
+        if str(item['id']) == str(ref):
+            return item
+    raise NotFound(kind[:-1] + ' ' + str(ref))
+
+@route('GET', '/api/v4/projects/:project/deploy_keys')
+def gl_keys(req, project):
+    return req.paginate(public(req.world.project(project)['keys']))
+
+@route('POST', '/api/v4/projects/:project/deploy_keys')
+def gl_add_key(req, project):
+    with req.world.lock:
+        project = req.world.project(project)
+        key = {'id': next(req.world.ids), 'title': req.params.get('title'), 'key': req.params.get('key'),
+               'can_push': bool(req.params.get('can_push', False))}
+        project['keys'].append(key)
+        return key
+
+@route('DELETE', '/api/v4/projects/:project/deploy_keys/:key')
+def gl_delete_key(req, project, key):
+    with req.world.lock:
+        project = req.world.project(project)
+        project['keys'].remove(child(project, 'keys', key))
+
+@route('GET', '/api/v4/projects/:project/hooks')
+def gl_hooks(req, project):
+    return req.paginate(public(req.world.project(project)['hooks']))
+
+@route('POST', '/api/v4/projects/:project/hooks')
+def gl_add_hook(req, project):
+    with req.world.lock:
+        project = req.world.project(project)
+        hook = {'id': next(req.world.ids), 'url': req.params.get('url'), 'project_id': project['id'],
+                'push_events': req.flag('push_events', True), 'token': req.params.get('token')}
+        project['hooks'].append(hook)
+        return public([hook])[0]
+
+@route('PUT', '/api/v4/projects/:project/hooks/:hook')
+def gl_edit_hook(req, project, hook):
+    with req.world.lock:
+        hook = child(req.world.project(project), 'hooks', hook)
+        for key in ('url', 'token'):
+            if key in req.params:
+                hook[key] = req.params[key]
+        if 'push_events' in req.params:
+            hook['push_events'] = req.flag('push_events')
+        return public([hook])[0]
+
+@route('DELETE', '/api/v4/projects/:project/hooks/:hook')
+def gl_delete_hook(req, project, hook):
+    with req.world.lock:
+        project = req.world.project(project)
+        project['hooks'].remove(child(project, 'hooks', hook))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = collections.Counter()
+            self.throttled = 0
+            self.unknown = collections.Counter()
+
+    def add(self, label, throttled=False):
+        with self.lock:
+            self.requests[label] += 1
+            self.throttled += throttled
+
+    def json(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'total': sum(self.requests.values()),
+                'writes': sum(n for label, n in self.requests.items() if not label.startswith('GET ')),
+                'throttled': self.throttled,
+                'unknown': dict(self.unknown),
+            }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive, so the scripts' connection pools work like against the real servers
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    @property
+    def world(self):
+        return self.server.world
+
+    @property
+    def base(self):
+        return 'http://' + self.headers.get('Host', '{}:{}'.format(*self.server.server_address))
+
+    def flag(self, name, default=False):
+        value = self.params.get(name)
+        if value is None:
+            return default
+        return str(value).lower() in ('1', 'true', 'yes')
+
+    def read_params(self, query):
+        params = { key: values[-1] for key, values in parse_qs(query).items() }
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if body:
+            if 'json' in self.headers.get('Content-Type', ''):
+                params.update(json.loads(body))
+            else:
+                params.update({ key: values[-1] for key, values in parse_qs(body.decode()).items() })
+        return params
+
+    def paginate(self, items):
+        per_page = min(int(self.params.get('per_page', self.world.page_size)), 100)
+        page = max(1, int(self.params.get('page', 1)))
+        pages = max(1, math.ceil(len(items) / per_page))
+        self.extra_headers = {
+            'X-Page': str(page), 'X-Per-Page': str(per_page), 'X-Total': str(len(items)), 'X-Total-Pages': str(pages),
+        }
+        if page < pages:
+            query = dict(self.params, page=page + 1, per_page=per_page)
+            self.extra_headers['X-Next-Page'] = str(page + 1)
+            self.extra_headers['Link'] = '<{}{}?{}>; rel="next"'.format(self.base, self.path.split('?')[0], urlencode(query))
+        return items[(page - 1) * per_page:page * per_page]
+
+    def dispatch(self, method):
+        url = urlsplit(self.path)
+        self.params = self.read_params(url.query)
+        self.extra_headers = {}
+        config = self.server.config
+        if url.path.startswith('/_bench/'):
+            if url.path == '/_bench/reset':
+                self.server.stats.reset()
+            return self.send(200, self.server.stats.json())
+
+        for route_method, regex, pattern, fn in ROUTES:
+            match = regex.match(url.path)
+            if route_method == method and match:
+                break
+        else:
+            with self.server.stats.lock:
+                self.server.stats.unknown[method + ' ' + url.path] += 1
+            return self.send(404, {'message': '404 Not Found'})
+
+        label = method + ' ' + pattern
+        if config['latency']:
+            time.sleep(config['latency'])
+        with self.server.random_lock:
+            throttled = self.server.random.random() < config['throttle']
+        self.server.stats.add(label, throttled)
+        if throttled:
+            return self.send(429, {'message': 'Too Many Requests'}, {'Retry-After': str(config['retry_after'])})
+        if 'Authorization' not in self.headers and 'PRIVATE-TOKEN' not in self.headers and not pattern.endswith(('/login', '/tenants/')):
+            return self.send(401, {'message': '401 Unauthorized'})
+        try:
+            result = fn(self, **match.groupdict())
+        except NotFound as e:
+            return self.send(404, {'message': '404 {} Not Found'.format(e)})
+        except Conflict as e:
+            return self.send(409, {'message': e.args[0]})
+        except (KeyError, ValueError) as e:
+            return self.send(400, {'message': '400 Bad request: {}'.format(e)})
+        with self.server.stats.lock:
+            # Done, but answered as if a proxy in between timed out
+            failed = self.server.failures[label] > 0
+            self.server.failures[label] -= failed
+        if failed:
+            return self.send(503, {'message': '503 Service Unavailable'})
+        if result is None:
+            return self.send(204, None)
+        self.send(201 if method == 'POST' else 200, result, self.extra_headers)
+
+    def send(self, status, data, headers=None):
+        body = b'' if data is None else json.dumps(data).encode()
+        self.send_response(status)
+        if data is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for the connections of all workers of the scripts at once
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients that drop their keep-alive connections at the end of a run are not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def make_server(groups=50, port=0, latency=0.0, throttle=0.0, retry_after=0.2, page_size=20, fork_time=0.5, seed=1):
+    server = Server(('127.0.0.1', port), Handler)
+    server.world = World(groups, page_size=page_size, fork_time=fork_time)
+    server.stats = Stats()
+    # {label: n}: answer the next n requests of that endpoint with 503, after handling them
+    server.failures = collections.Counter()
+    server.config = {'latency': latency, 'throttle': throttle, 'retry_after': retry_after}
+    server.random = random.Random(seed)
+    server.random_lock = threading.Lock()
+    return server
+
+
+def serve(ready=None, **kwargs):
+    # Run a server until killed. `ready` (a multiprocessing queue) receives its base URL.
+    server = make_server(**kwargs)
+    if ready is not None:
+        ready.put('http://{}:{}'.format(*server.server_address))
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake GitLab and CodeGrade API for benchmarks')
+    parser.add_argument('--groups', type=int, default=50, help='number of groups in the course')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--throttle', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='Retry-After of the 429 answers, in seconds')
+    parser.add_argument('--page-size', type=int, default=20, help='default page size of the GitLab listings')
+    parser.add_argument('--fork-time', type=float, default=0.5, help='seconds until a fork has finished importing')
+    args = parser.parse_args()
+    server = make_server(args.groups, args.port, args.latency, args.throttle, args.retry_after, args.page_size, args.fork_time)
+    print('Serving {} groups on http://{}:{}'.format(args.groups, *server.server_address))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
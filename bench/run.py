@@ -0,0 +1,174 @@
+# Benchmark of the GitLab scripts against the fake servers of fake_server.py.
+# For every course size it runs 2_get_webhooks.init_roster and then 3_installKeysAndHooks.sync
+# three times: a first run that creates all repositories, a full verify of the now converged
+# course, and a normal rerun that skips converged groups. Per step it reports the number of
+# API calls, the wall-clock time and the peak memory of the scripts.
+#
+#   python run.py --groups 50 200 1000 --latency 0.02 --throttle 0.01
+
+import argparse
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import fake_server
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def load_script(filename):
+    # The numbered scripts cannot be imported by name
+    path = os.path.join(REPO, 'gitlab', filename)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].replace('_', '-'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_request(base_url, path):
+    request = urllib.request.Request(base_url + path, method='POST' if path.endswith('reset') else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def write_usernames(filename, groups):
+    # The roster that 1_get_usernames.py would have written for the fake course
+    with open(filename, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['cg_name', 'cg_user', 'gl_name', 'gl_user'])
+        for i in range(2 * groups):
+            writer.writerow(['Student {}'.format(i), fake_server.cg_username(i), 'Student {}'.format(i), fake_server.gl_username(i)])
+
+
+def measure(name, base_url, fn, memory=True, verbose=False):
+    # Run one step and return its numbers, the scripts' output is hidden unless verbose
+    bench_request(base_url, '/_bench/reset')
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if verbose else output):
+        fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if memory else None
+    if memory:
+        tracemalloc.stop()
+    stats = bench_request(base_url, '/_bench/stats')
+    if stats['unknown']:
+        print('Warning: requests the fake servers do not know:', stats['unknown'], file=sys.stderr)
+    return {
+        'step': name,
+        'seconds': round(seconds, 3),
+        'calls': stats['total'],
+        'codegrade': sum(n for label, n in stats['requests'].items() if '/api/v1/' in label),
+        'gitlab': sum(n for label, n in stats['requests'].items() if '/api/v4/' in label),
+        'writes': stats['writes'],
+        'throttled': stats['throttled'],
+        'peak_mib': round(peak / 2 ** 20, 1) if peak is not None else None,
+        'requests': stats['requests'],
+    }
+
+
+def run_course(groups, args):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=fake_server.serve, daemon=True, kwargs=dict(
+        ready=ready, groups=groups, latency=args.latency, throttle=args.throttle, retry_after=args.retry_after,
+        page_size=args.page_size, fork_time=args.fork_time))
+    server.start()
+    base_url = ready.get(timeout=30)
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+            # User cache, sync state and CSV files of this course only
+            os.chdir(workdir)
+            webhooks = load_script('2_get_webhooks.py')
+            provisioning = load_script('3_installKeysAndHooks.py')
+            write_usernames('usernames.csv', groups)
+
+            access = {
+                'codegrade': {'host': base_url, 'tenant': fake_server.TENANT, 'username': 'bench', 'password': 'bench'},
+                'gitlab': {'host': base_url, 'token': 'bench'},
+            }
+            organization = {
+                'assignment-id': fake_server.ASSIGNMENT_ID,
+                'codegrade-id': fake_server.COURSE_ID,
+                'gitlab-group': fake_server.ROOT_GROUP,
+                'subgroup-staff': 'staff',
+                'subgroup-students': 'students',
+            }
+            assignment = {
+                'codegrade-id': fake_server.ASSIGNMENT_ID,
+                'gitlab-name': fake_server.TEMPLATE,
+                'subgroup': fake_server.SUBGROUP,
+            }
+
+            def get_webhooks():
+                webhooks.init_roster(access, organization, 'usernames.csv', 'webhooks.csv',
+                                     workers=args.workers, rate=args.rate)
+
+            def sync(full_verify):
+                return lambda: provisioning.sync(access, organization, 'webhooks.csv', assignment, student_readable=True,
+                                                 workers=args.workers, full_verify=full_verify)
+
+            steps = [
+                ('webhooks', get_webhooks),
+                ('sync (new)', sync(False)),
+                ('sync (verify)', sync(True)),
+                ('sync (rerun)', sync(False)),
+            ]
+            results = []
+            for name, fn in steps:
+                result = measure(name, base_url, fn, memory=not args.no_memory, verbose=args.verbose)
+                results.append(dict(result, groups=groups))
+                print_result(results[-1])
+            return results
+    finally:
+        os.chdir(cwd)
+        server.terminate()
+        server.join()
+
+
+def print_result(result):
+    print('{:>5} groups  {:<14} {:8.2f}s  {:6} calls ({} CodeGrade, {} GitLab, {} writes, {} throttled)  peak {} MiB'.format(
+        result['groups'], result['step'], result['seconds'], result['calls'], result['codegrade'], result['gitlab'],
+        result['writes'], result['throttled'], result['peak_mib'] if result['peak_mib'] is not None else '-'), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GitLab scripts against fake GitLab and CodeGrade servers')
+    parser.add_argument('--groups', type=int, nargs='+', default=[50, 200, 1000], help='course sizes to run')
+    parser.add_argument('--workers', type=int, default=8, help='workers of the scripts')
+    parser.add_argument('--rate', type=float, default=100, help='maximum CodeGrade requests per second of 2_get_webhooks.py')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every request')
+    parser.add_argument('--throttle', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='Retry-After of the 429 answers, in seconds')
+    parser.add_argument('--page-size', type=int, default=20, help='default page size of the GitLab listings')
+    parser.add_argument('--fork-time', type=float, default=0.5, help='seconds until a fork has finished importing')
+    parser.add_argument('--no-memory', action='store_true', help='do not trace memory, which slows the scripts down')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the scripts')
+    parser.add_argument('--json', metavar='FILE', help='also write the results, with the calls per endpoint, to a JSON file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        # Keep the CodeGrade token cache of the benchmark out of the real one
+        os.environ['HOME'] = workdir
+        args.workdir = workdir
+        for groups in args.groups:
+            results.extend(run_course(groups, args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
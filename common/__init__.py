@@ -0,0 +1,3 @@
+# Helpers shared by the GitHub and GitLab scripts.
+# The scripts are run from their own directory, so they add the repository root to
+# sys.path before importing from here.
@@ -0,0 +1,244 @@
+# Shared CodeGrade client for all scripts: one pooled keep-alive session per run, with a login
+# token that is cached on disk until it expires, so consecutive scripts log in only once.
+#
+#   session = cgclient.login(host='https://wur.codegra.de', tenant='Wageningen University',
+#                            username=..., password=...)
+#   users = session.get('/api/v1/courses/{}/users/'.format(course_id))
+#
+# Failed requests raise CodeGradeError (or one of its subclasses) instead of exiting.
+
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.files import atomic_write
+from common.retry import RetryPolicy, TransientResponse, endpoint_label, mount_retries, retry_condition
+from common.retry import TRANSIENT_STATUS, is_safe_to_resend, is_transient
+
+TOKEN_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'codegrade-tools', 'tokens.json')
+
+# Seconds to connect and to wait for a response, so a stalled connection cannot block a worker forever
+TIMEOUT = (10, 120)
+
+# Calls whose method does not tell whether they can be sent again after a timeout or server error (see RetryAdapter)
+RETRY_OVERRIDES = [
+    # Gets the webhook of the author, creating it the first time
+    ('POST', r'/api/v1/assignments/\d+/webhook_settings$', is_transient),
+    ('POST', r'/api/v1/login$', is_transient),
+    # Without an id in the body this PUT creates another group set every time
+    ('PUT', r'/api/v1/courses/\d+/group_sets/$', is_safe_to_resend),
+]
+
+
+class CodeGradeError(Exception):
+    def __init__(self, status_code, message, url, response=None):
+        super().__init__('A CodeGrade request went wrong: {} ({}): {}'.format(url, status_code, message))
+        self.status_code = status_code
+        self.message = message
+        self.url = url
+        self.response = response
+
+
+class AuthenticationError(CodeGradeError):
+    pass
+
+
+class NotFoundError(CodeGradeError):
+    pass
+
+
+def raise_for_response(res):
+    # Raise the matching CodeGradeError for a failed response, otherwise return the decoded body
+    if res.status_code < 400:
+        return res.json() if res.content else None
+    try:
+        message = res.json()['message']
+    except (ValueError, KeyError, TypeError):
+        message = res.text
+    error = {401: AuthenticationError, 403: AuthenticationError, 404: NotFoundError}.get(res.status_code, CodeGradeError)
+    raise error(res.status_code, message, str(res.url), res)
+
+
+def token_expiry(token):
+    # Expiry time from the 'exp' claim of the JWT, or 0 if it cannot be read
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return 0.0
+
+
+class TokenCache:
+    # Login tokens per host and user, in a file only readable by the current user
+    lock = threading.Lock()
+
+    def __init__(self, path=TOKEN_CACHE, margin=300):
+        self.path = path
+        self.margin = margin
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, host, username):
+        token = self.load().get(host + '|' + username)
+        if token is not None and token_expiry(token) > time.time() + self.margin:
+            return token
+        return None
+
+    def put(self, host, username, token):
+        with self.lock:
+            tokens = self.load()
+            if token is None:
+                tokens.pop(host + '|' + username, None)
+            else:
+                tokens[host + '|' + username] = token
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with atomic_write(self.path) as f:
+                if hasattr(os, 'fchmod'):
+                    os.fchmod(f.fileno(), 0o600)
+                json.dump(tokens, f)
+
+
+def base_url_for(host=None, subdomain=None):
+    if host is None:
+        host = 'https://{}.codegra.de'.format(subdomain)
+    return host.rstrip('/')
+
+
+def login_request(session, base_url, username, password, tenant=None):
+    # Log in with a password, returns the access token
+    body = { 'username': username, 'password': password }
+    if tenant is not None:
+        tenants = raise_for_response(session.get(base_url + '/api/v1/tenants/', timeout=TIMEOUT))
+        matches = [ t['id'] for t in tenants if t['name'] == tenant ]
+        if not matches:
+            raise LookupError('CodeGrade tenant {} does not exist on {}'.format(tenant, base_url))
+        body['tenant_id'] = matches[0]
+    return raise_for_response(session.post(base_url + '/api/v1/login', json=body, timeout=TIMEOUT))['access_token']
+
+
+class CGSession(requests.Session):
+    # requests session against one CodeGrade instance. get/post/... return the decoded JSON body.
+    def __init__(self, base_url, access_token=None, policy=None, pool_size=10, timeout=TIMEOUT):
+        super().__init__()
+        self.base_url = base_url
+        self.timeout = timeout
+        self.policy = policy or RetryPolicy()
+        mount_retries(self, self.policy, pool_size=pool_size, overrides=RETRY_OVERRIDES)
+        if access_token is not None:
+            self.set_token(access_token)
+
+    def set_token(self, access_token):
+        self.access_token = access_token
+        self.headers.update({
+            'Authorization': 'Bearer {}'.format(access_token),
+        })
+
+    def request(self, method, url, *args, **kwargs):
+        url = urljoin(self.base_url, url)
+        kwargs.setdefault('timeout', self.timeout)
+        return raise_for_response(super().request(method, url, *args, **kwargs))
+
+
+def login(username, password, host=None, subdomain=None, tenant=None, policy=None, pool_size=10,
+          token_cache=TOKEN_CACHE):
+    # Logged-in CGSession, reusing a cached token when it is still valid.
+    # Give either host ('https://wur.codegra.de') or subdomain ('wur').
+    base_url = base_url_for(host, subdomain)
+    cache = TokenCache(token_cache) if token_cache else None
+    session = CGSession(base_url, policy=policy, pool_size=pool_size)
+    token = cache.get(base_url, username) if cache else None
+    if token is not None:
+        session.set_token(token)
+        try:
+            # Check the token is still accepted, e.g. it was not revoked by a logout
+            session.get('/api/v1/login')
+            return session
+        except AuthenticationError:
+            session.headers.pop('Authorization', None)
+    token = login_request(session_without_raise(session), base_url, username, password, tenant)
+    session.set_token(token)
+    if cache:
+        cache.put(base_url, username, token)
+    return session
+
+
+def session_without_raise(session):
+    # The plain requests interface of a CGSession, used for the login calls themselves
+    plain = requests.Session()
+    plain.adapters = session.adapters
+    return plain
+
+
+class AsyncCGSession:
+    # asyncio variant of CGSession on top of httpx (installed together with the codegrade package).
+    # Shares the token cache with the synchronous client, and takes the same RetryPolicy, so its
+    # retries, rate limit and statistics are shared with the threads of a run; use `await async_login(...)`.
+    def __init__(self, base_url, access_token, policy=None, max_connections=10, timeout=TIMEOUT):
+        import httpx
+        self.base_url = base_url
+        self.access_token = access_token
+        self.policy = policy or RetryPolicy()
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={'Authorization': 'Bearer {}'.format(access_token)},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            http2=False,
+        )
+
+    async def send_once(self, method, url, **kwargs):
+        response = await self.client.request(method, url, **kwargs)
+        if response.status_code in TRANSIENT_STATUS or response.status_code >= 500:
+            raise TransientResponse(response)
+        return response
+
+    async def request(self, method, url, **kwargs):
+        # Retried like the requests of a CGSession (see RETRY_OVERRIDES)
+        retry_if = retry_condition(method, url, overrides=RETRY_OVERRIDES)
+        try:
+            response = await self.policy.call_async(self.send_once, method, url, label=endpoint_label(method, url),
+                                                    retry_if=retry_if, **kwargs)
+        except TransientResponse as exc:
+            response = exc.response
+        return raise_for_response(response)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request('PUT', url, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+async def async_login(username, password, host=None, subdomain=None, tenant=None, policy=None, max_connections=10,
+                      token_cache=TOKEN_CACHE):
+    import asyncio
+    # The login itself is a single request, done by the synchronous client in a thread
+    session = await asyncio.to_thread(login, username, password, host=host, subdomain=subdomain,
+                                      tenant=tenant, policy=policy, token_cache=token_cache)
+    session.close()
+    return AsyncCGSession(session.base_url, session.access_token, policy=session.policy, max_connections=max_connections)
@@ -0,0 +1,20 @@
+# File helpers shared by the scripts.
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    # Write to a temporary file next to `path` and only replace `path` once writing succeeded,
+    # so an interrupted run never leaves a half-written file behind
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,85 @@
+# Forking GitLab projects and waiting for the forks to be ready.
+# Creating a fork returns at once, GitLab copies the repository in the background
+# (import_status scheduled -> started -> finished or failed). Until it is finished the
+# fork may be empty, and changing its settings can fail.
+
+import time
+
+# 'none' is the import_status of projects that were not imported or forked
+READY = ('finished', 'none')
+FAILED = 'failed'
+
+
+def create_fork(g, source_id, namespace, name=None, path=None):
+    # Fork project `source_id` into the group with full path `namespace`, without fetching the source first
+    attrs = { 'namespace': namespace }
+    if name is not None:
+        attrs['name'] = name
+    if path is not None:
+        attrs['path'] = path
+    source = g.projects.get(source_id, lazy=True)
+    return source.forks.create(attrs)
+
+
+def import_statuses(g, group, project_ids):
+    # import_status of the given projects, read from one (paginated) listing of `group` and its subgroups
+    statuses = {}
+    for proj in group.projects.list(include_subgroups=True, get_all=True):
+        if proj.id in project_ids:
+            statuses[proj.id] = proj.attributes.get('import_status')
+    # Projects that the listing does not show (yet), or shows without their status, are read one by one
+    for project_id in project_ids:
+        if statuses.get(project_id) is None:
+            statuses[project_id] = g.projects.get(project_id).import_status
+    return statuses
+
+
+def await_fork(g, project_id, start, timeout=900, interval=1, max_interval=20):
+    # Wait for a single fork by reading the project itself, for callers that fork one project at a
+    # time; listing the whole group for it (like await_forks) would cost a page per project of the group.
+    # Returns (status, seconds since `start`), status as for await_forks.
+    deadline = start + timeout
+    delay = interval
+    while True:
+        status = g.projects.get(project_id).import_status
+        now = time.monotonic()
+        if status in READY or status == FAILED:
+            return ('finished' if status in READY else 'failed'), now - start
+        if now >= deadline:
+            return 'timeout', now - start
+        time.sleep(min(delay, max(deadline - now, 0)))
+        delay = min(delay * 2, max_interval)
+
+
+def await_forks(g, group, started, timeout=900, interval=1, max_interval=20, on_done=None):
+    # Wait until the forks in `started` ({project id: time.monotonic() when it was forked}), which all
+    # live below `group`, are finished or failed. All pending forks are checked together in every round;
+    # rounds follow each other quickly while forks are finishing and slow down while nothing changes.
+    # Returns {project id: (status, seconds since the fork)}, status is 'finished', 'failed' or 'timeout'.
+    pending = dict(started)
+    results = {}
+    deadline = time.monotonic() + timeout
+    delay = interval
+    while pending:
+        statuses = import_statuses(g, group, set(pending))
+        now = time.monotonic()
+        progressed = False
+        for project_id, status in statuses.items():
+            if status in READY or status == FAILED:
+                results[project_id] = ('finished' if status in READY else 'failed', now - pending.pop(project_id))
+                progressed = True
+                if on_done is not None:
+                    on_done(project_id, *results[project_id])
+        if not pending:
+            break
+        if now >= deadline:
+            for project_id, start in pending.items():
+                results[project_id] = ('timeout', now - start)
+                if on_done is not None:
+                    on_done(project_id, *results[project_id])
+            break
+        if progressed:
+            delay = interval
+        time.sleep(min(delay, max(deadline - now, 0)))
+        delay = min(delay * 2, max_interval)
+    return results
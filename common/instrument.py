@@ -0,0 +1,159 @@
+# Run instrumentation: how long the API calls of a run took per endpoint, how often they were
+# retried or had to wait for the rate limit, and a live progress bar for the long loops.
+# The Metrics of a run live on its RetryPolicy, which sees every call (see common/retry.py).
+
+import collections
+import json
+import math
+import sys
+import threading
+import time
+
+from common.files import atomic_write
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class Metrics:
+    # Durations per endpoint label ('GET /api/v4/projects/:id/hooks', 'Repository.get_hooks', ...),
+    # shared by all threads of a run
+    def __init__(self):
+        self.durations = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.rate_limited = collections.Counter()
+        self.waits = collections.Counter()
+        self.waited = collections.Counter()
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, label, seconds, error=False, rate_limited=False):
+        # One attempt of a call
+        with self.lock:
+            self.durations[label].append(seconds)
+            if error:
+                self.errors[label] += 1
+            if rate_limited:
+                self.rate_limited[label] += 1
+
+    def wait(self, label, seconds):
+        # Time a call was held back by the rate limiter
+        with self.lock:
+            self.waits[label] += 1
+            self.waited[label] += seconds
+
+    def operations(self):
+        # {label: statistics}, slowest in total first
+        with self.lock:
+            durations = { label: sorted(values) for label, values in self.durations.items() }
+            stats = {}
+            for label, values in durations.items():
+                stats[label] = {
+                    'calls': len(values),
+                    'errors': self.errors[label],
+                    'rate_limited': self.rate_limited[label],
+                    'rate_limit_waits': self.waits[label],
+                    'rate_limit_waited': round(self.waited[label], 3),
+                    'total': round(sum(values), 3),
+                    'p50': round(percentile(values, 0.5), 3),
+                    'p95': round(percentile(values, 0.95), 3),
+                    'max': round(values[-1], 3),
+                }
+        return dict(sorted(stats.items(), key=lambda item: -item[1]['total']))
+
+    def summary(self, **extra):
+        operations = self.operations()
+        return dict({
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'duration': round(time.monotonic() - self.start, 3),
+            'calls': sum(op['calls'] for op in operations.values()),
+            'errors': sum(op['errors'] for op in operations.values()),
+            'rate_limited': sum(op['rate_limited'] for op in operations.values()),
+            'rate_limit_waited': round(sum(op['rate_limit_waited'] for op in operations.values()), 3),
+            'operations': operations,
+        }, **extra)
+
+    def report(self, top=8):
+        operations = self.operations()
+        if not operations:
+            return
+        print('Made', sum(op['calls'] for op in operations.values()), 'call(s) in {:.1f}s; slowest endpoints in total:'.format(
+            time.monotonic() - self.start))
+        for label, op in list(operations.items())[:top]:
+            print('>', label + ':', op['calls'], 'call(s), {:.1f}s in total, p50 {:.2f}s, p95 {:.2f}s'.format(
+                op['total'], op['p50'], op['p95']))
+
+    def write(self, path, **extra):
+        # JSON run report, `extra` is added at the top level (e.g. the retries)
+        with atomic_write(path) as f:
+            json.dump(self.summary(**extra), f, indent=1)
+
+
+class Progress:
+    # Live progress bar with an ETA on stderr. Only drawn when stderr is a terminal, so redirected
+    # output stays clean. Lines printed through write() appear above the bar.
+    def __init__(self, total, label='', stream=sys.stderr, width=30):
+        self.total = total
+        self.label = label
+        self.stream = stream
+        self.width = width
+        self.done = 0
+        self.start = time.monotonic()
+        self.enabled = total > 0 and getattr(stream, 'isatty', lambda: False)()
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.draw()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def track(self, fn):
+        # fn, advancing the bar after every call, e.g. for pool.map
+        def tracked(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.advance()
+        return tracked
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+            self.draw()
+
+    def write(self, text):
+        with self.lock:
+            self.clear()
+            print(text, flush=True)
+            self.draw()
+
+    def close(self):
+        with self.lock:
+            self.clear()
+            self.enabled = False
+
+    def clear(self):
+        if self.enabled:
+            self.stream.write('\r\033[K')
+            self.stream.flush()
+
+    def draw(self):
+        if not self.enabled:
+            return
+        elapsed = time.monotonic() - self.start
+        filled = self.width * self.done // self.total
+        if self.done:
+            eta = '{:.0f}s left'.format(elapsed / self.done * (self.total - self.done))
+        else:
+            eta = '...'
+        self.stream.write('\r{} [{}{}] {}/{} {}'.format(
+            self.label, '#' * filled, '-' * (self.width - filled), self.done, self.total, eta))
+        self.stream.flush()
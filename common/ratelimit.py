@@ -0,0 +1,95 @@
+# Shared request throttling: a token bucket that slows down when the server says so.
+
+import threading
+import time
+
+
+def response_status(exc):
+    # HTTP status code of a failed call, for the client libraries used in this repository:
+    # python-gitlab (response_code), codegrade/httpx/requests (status_code, response) and PyGithub (status)
+    for attr in ('response_code', 'status_code', 'status'):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, 'response', None)
+    value = getattr(response, 'status_code', None)
+    return value if isinstance(value, int) else None
+
+
+def retry_after(exc):
+    # Seconds to wait according to the Retry-After header of a failed call, if any
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or getattr(exc, 'headers', None) or {}
+    value = headers.get('Retry-After', headers.get('retry-after'))
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # Allows `rate` calls per second on average with bursts of up to `burst` calls.
+    # Shared between worker threads. When the server answers 429 the bucket stops handing
+    # out tokens for the Retry-After period and halves its rate; every successful call
+    # then slowly raises the rate again, up to the configured maximum.
+    def __init__(self, rate=10.0, burst=None, min_rate=0.5):
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.capacity = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Take a token if there is one: returns None, or the seconds to wait before trying again
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        # Block until a call may be made, returns the time spent waiting
+        waited = 0.0
+        while True:
+            delay = self.take()
+            if delay is None:
+                with self.lock:
+                    self.waited += waited
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self):
+        # acquire() for asyncio code, waits without blocking the event loop
+        import asyncio
+        waited = 0.0
+        while True:
+            delay = self.take()
+            if delay is None:
+                with self.lock:
+                    self.waited += waited
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def throttle(self, delay=None):
+        # The server rate limited us: pause everyone and slow down
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if delay is None:
+                delay = 1 / self.rate
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.tokens = 0.0
+
+    def relax(self):
+        # A call succeeded: creep back towards the maximum rate
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1 * self.min_rate + 0.01 * self.max_rate)
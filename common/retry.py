@@ -0,0 +1,207 @@
+# Shared retry policy for CodeGrade, GitLab and GitHub calls: jittered exponential backoff,
+# only for transient errors, with a retry budget for the whole run.
+# Requests that change something (POST, PATCH: forks, hooks, keys, members, groups) are only
+# sent again when the server surely did not act on them: a rate limit, or no connection at all.
+
+import collections
+import random
+import re
+import threading
+import time
+
+import requests
+import urllib3
+
+from common.instrument import Metrics
+from common.ratelimit import response_status, retry_after
+
+TRANSIENT_STATUS = (408, 429, 500, 502, 503, 504)
+TRANSIENT_NAMES = ('Timeout', 'ConnectionError', 'ConnectError', 'NetworkError', 'RemoteProtocolError')
+# httpx's exceptions for a connection that could not be made
+NOT_SENT_NAMES = ('ConnectError', 'ConnectTimeout')
+# Methods that can be sent twice with the same effect, as urllib3's Retry.DEFAULT_ALLOWED_METHODS
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'))
+
+
+def is_transient(exc):
+    # Timeouts, dropped connections, rate limits and server errors are worth retrying,
+    # anything else (bad request, not found, permission denied) will fail again
+    status = response_status(exc)
+    if status is not None:
+        return status in TRANSIENT_STATUS or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    # The HTTP libraries have their own exception hierarchies, match those by name
+    return any(name in cls.__name__ for cls in type(exc).__mro__ for name in TRANSIENT_NAMES)
+
+
+def not_sent(exc):
+    # The connection could not be made (refused, DNS, connect timeout), so the server never saw the request
+    if isinstance(exc, requests.exceptions.ConnectTimeout) or type(exc).__name__ in NOT_SENT_NAMES:
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if isinstance(exc, requests.exceptions.ConnectionError) and exc.args else None
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+def is_safe_to_resend(exc):
+    # Retry condition of the requests that are not idempotent
+    return response_status(exc) == 429 or not_sent(exc)
+
+
+def retry_condition(method, path, idempotent=IDEMPOTENT_METHODS, overrides=()):
+    # retry_if for a request: `overrides` are (method, path regex, retry_if) for the calls whose
+    # method does not tell, such as a POST that only gets or creates; the first match applies
+    path = path.split('?')[0]
+    for override_method, pattern, retry_if in overrides:
+        if method == override_method and re.search(pattern, path):
+            return retry_if
+    return is_transient if method in idempotent else is_safe_to_resend
+
+
+class RetryPolicy:
+    # One policy is shared by all calls (and threads) of a run, so the retry budget and
+    # the statistics cover the whole run. An optional TokenBucket is used to pace calls.
+    # Every attempt is timed in `metrics`, per label.
+    def __init__(self, attempts=5, base_delay=0.5, max_delay=30.0, budget=200, limiter=None, metrics=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.limiter = limiter
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.retried = collections.Counter()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def call(self, fn, *args, label=None, retry_if=is_transient, **kwargs):
+        # retry_if decides which errors are retried, by default all transient ones
+        label = label or getattr(fn, '__qualname__', repr(fn))
+        for attempt in range(1, self.attempts + 1):
+            if self.limiter is not None:
+                waited = self.limiter.acquire()
+                if waited:
+                    self.metrics.wait(label, waited)
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as exc:
+                self.metrics.record(label, time.monotonic() - start, error=True, rate_limited=response_status(exc) == 429)
+                if attempt == self.attempts or not retry_if(exc) or not self.spend(label):
+                    raise
+                self.wait(exc, attempt)
+            else:
+                self.metrics.record(label, time.monotonic() - start)
+                if self.limiter is not None:
+                    self.limiter.relax()
+                return result
+
+    async def call_async(self, fn, *args, label=None, retry_if=is_transient, **kwargs):
+        # call() for a coroutine function, e.g. of an httpx.AsyncClient; waits without blocking the event loop
+        import asyncio
+        label = label or getattr(fn, '__qualname__', repr(fn))
+        for attempt in range(1, self.attempts + 1):
+            if self.limiter is not None:
+                waited = await self.limiter.acquire_async()
+                if waited:
+                    self.metrics.wait(label, waited)
+            start = time.monotonic()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as exc:
+                self.metrics.record(label, time.monotonic() - start, error=True, rate_limited=response_status(exc) == 429)
+                if attempt == self.attempts or not retry_if(exc) or not self.spend(label):
+                    raise
+                await asyncio.sleep(self.backoff(exc, attempt))
+            else:
+                self.metrics.record(label, time.monotonic() - start)
+                if self.limiter is not None:
+                    self.limiter.relax()
+                return result
+
+    def spend(self, label):
+        with self.lock:
+            if sum(self.retried.values()) >= self.budget:
+                return False
+            self.retried[label] += 1
+            return True
+
+    def backoff(self, exc, attempt):
+        # Seconds to sleep before the next attempt. After a 429 the limiter pauses all workers
+        # instead, and their next acquire() waits for it.
+        delay = retry_after(exc)
+        if delay is None:
+            # Full jitter: a random delay up to the exponential backoff
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        with self.lock:
+            self.waited += delay
+        if self.limiter is not None and response_status(exc) == 429:
+            self.limiter.throttle(delay)
+            return 0.0
+        return delay
+
+    def wait(self, exc, attempt):
+        time.sleep(self.backoff(exc, attempt))
+
+    def report(self, timings=True):
+        if timings:
+            self.metrics.report()
+        if not self.retried:
+            print('No calls were retried.')
+            return
+        print('Retried', sum(self.retried.values()), 'call(s); waited {:.1f}s in total:'.format(self.waited))
+        for label, count in self.retried.most_common():
+            print('>', label + ':', 'retried', count, 'time(s)')
+        if sum(self.retried.values()) >= self.budget:
+            print('> Retry budget of', self.budget, 'was used up, later transient errors were not retried')
+
+    def write_report(self, path):
+        # JSON report of the run: per endpoint the number of calls and their p50/p95 durations,
+        # plus the retries and the time spent backing off
+        self.metrics.write(path, retried=dict(self.retried), retry_waited=round(self.waited, 3))
+        print('Run report written to', path)
+
+
+def endpoint_label(method, path):
+    # 'GET /api/v4/projects/123/hooks?page=2' -> 'GET /api/v4/projects/:id/hooks'
+    return '{} {}'.format(method, re.sub(r'/\d+(?=/|$)', '/:id', path.split('?')[0]))
+
+
+class TransientResponse(Exception):
+    def __init__(self, response):
+        super().__init__('HTTP {} from {}'.format(response.status_code, response.url))
+        self.response = response
+
+
+class RetryAdapter(requests.adapters.HTTPAdapter):
+    # Transport adapter that sends every request of a requests.Session through a RetryPolicy,
+    # used for the python-gitlab session and the CodeGrade sessions. When all attempts fail
+    # the last response is returned, so the client library reports the error as usual.
+    # Requests with other methods than `idempotent` are only retried when is_safe_to_resend,
+    # unless one of the `overrides` says otherwise (see retry_condition).
+    def __init__(self, policy, idempotent=IDEMPOTENT_METHODS, overrides=(), **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy
+        self.idempotent = idempotent
+        self.overrides = overrides
+
+    def send(self, request, **kwargs):
+        label = endpoint_label(request.method, request.path_url)
+        retry_if = retry_condition(request.method, request.path_url, self.idempotent, self.overrides)
+        try:
+            return self.policy.call(self.send_once, request, label=label, retry_if=retry_if, **kwargs)
+        except TransientResponse as exc:
+            return exc.response
+
+    def send_once(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if response.status_code in TRANSIENT_STATUS or response.status_code >= 500:
+            raise TransientResponse(response)
+        return response
+
+
+def mount_retries(session, policy, pool_size=10, idempotent=IDEMPOTENT_METHODS, overrides=()):
+    # Route all requests of a requests.Session through the policy, with a connection pool for pool_size threads
+    adapter = RetryAdapter(policy, idempotent=idempotent, overrides=overrides, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
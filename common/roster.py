@@ -0,0 +1,78 @@
+# Reading and writing the roster CSV files of the scripts (see README.md for their layouts).
+# Files are read lazily, row by row, and checked against the expected columns: bad rows are
+# reported with their line number and skipped instead of stopping the whole run.
+# Files are written through a temporary file, so a failed run never leaves half a roster.
+
+import collections
+import csv
+import sys
+
+from common.files import atomic_write
+
+# columns: all columns in file order, required: columns that may not be empty
+Schema = collections.namedtuple('Schema', ['name', 'columns', 'required'])
+
+GITLAB_USERNAMES = Schema('GitLab usernames', ['cg_name', 'cg_user', 'gl_name', 'gl_user'], ['cg_user'])
+GITLAB_WEBHOOKS = Schema('GitLab webhooks', ['name', 'git_ids', 'payload_url', 'secret', 'public_key'],
+                         ['name', 'git_ids', 'payload_url', 'secret', 'public_key'])
+GITHUB_IDS = Schema('GitHub ids', ['CGUsername', 'GHUsername'], ['CGUsername'])
+GITHUB_WEBHOOKS = Schema('GitHub webhooks', ['group_name', 'github_ids', 'payload_url', 'secret', 'public_key'],
+                         ['group_name', 'github_ids', 'payload_url', 'secret', 'public_key'])
+GITHUB_ROSTER = Schema('GitHub roster', ['name', 'email', 'codegrade-user', 'github-user'], ['name'])
+
+
+class RosterError(ValueError):
+    pass
+
+
+def report(filename, line, message):
+    print('file {}, line {}: {}'.format(filename, line, message), file=sys.stderr)
+
+
+def read_roster(filename, schema, on_error=report):
+    # Yield the rows of a roster file as dicts with the schema's columns, one at a time.
+    # Raises RosterError when the header does not match the schema.
+    # utf-8-sig: Excel starts the CSV files it saves with a byte order mark, which would end up in the first column name
+    with open(filename, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        missing = [ column for column in schema.columns if column not in header ]
+        if missing:
+            raise RosterError('file {} is not a {} file, it misses the column(s) {}'.format(
+                filename, schema.name, ', '.join(missing)))
+        positions = [ header.index(column) for column in schema.columns ]
+        try:
+            for row in reader:
+                if not any(field.strip() for field in row):
+                    continue
+                if len(row) != len(header):
+                    on_error(filename, reader.line_num, 'expected {} fields, found {}'.format(len(header), len(row)))
+                    continue
+                record = { column: row[position].strip() for column, position in zip(schema.columns, positions) }
+                empty = [ column for column in schema.required if not record[column] ]
+                if empty:
+                    on_error(filename, reader.line_num, 'empty {}'.format(', '.join(empty)))
+                    continue
+                yield record
+        except csv.Error as e:
+            # The rest of the file cannot be trusted after a parse error
+            on_error(filename, reader.line_num, e)
+
+
+def read_id_map(filename, schema, key, value):
+    # {key column: value column} for all rows with a value, e.g. CodeGrade user -> GitLab user
+    return { record[key]: record[value] for record in read_roster(filename, schema) if record[value] }
+
+
+def write_roster(filename, schema, records):
+    # Write an iterable of dicts (or sequences in column order), streaming, replacing `filename` at the end
+    with atomic_write(filename, newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(schema.columns)
+        for record in records:
+            if isinstance(record, dict):
+                record = [ record.get(column, '') for column in schema.columns ]
+            writer.writerow(record)
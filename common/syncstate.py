@@ -0,0 +1,55 @@
+# Per-group record of the last successful sync, so that reruns can skip groups whose
+# inputs have not changed since.
+
+import hashlib
+import json
+import threading
+
+from common.files import atomic_write
+
+DEFAULT_PATH = 'sync_state.json'
+
+
+def fingerprint(*parts):
+    # Stable hash of the inputs of a group (roster row, settings)
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SyncState:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        self.dirty = False
+
+    def is_converged(self, key, inputs, repo_id):
+        # Same inputs as the last successful sync, and the repository is still the same one
+        entry = self.entries.get(key)
+        return entry is not None and entry['inputs'] == inputs and entry['repo_id'] == repo_id
+
+    def recorded(self, key, inputs):
+        # The ids recorded by the last successful sync with the same inputs, or None
+        entry = self.entries.get(key)
+        return entry if entry is not None and entry['inputs'] == inputs else None
+
+    def record(self, key, inputs, **ids):
+        with self.lock:
+            self.entries[key] = dict(inputs=inputs, **ids)
+            self.dirty = True
+
+    def forget(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            self.dirty = False
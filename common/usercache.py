@@ -0,0 +1,129 @@
+# Persistent cache of GitLab user lookups (username -> user id), shared by all GitLab scripts.
+# The same students take part in every assignment of a course, so after the first run
+# (or after 1_get_usernames.py) adding collaborators needs close to no user lookups.
+# 1_get_usernames.py also remembers which GitLab user it matched to a CodeGrade username,
+# so known students are not searched for again.
+#
+# Invalidate entries from the command line when a student changed account:
+#   python ../common/usercache.py --host https://git.wur.nl username1 username2
+# or drop the whole cache:
+#   python ../common/usercache.py --all
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.files import atomic_write
+
+DEFAULT_PATH = 'gitlab_users.json'
+DEFAULT_TTL = 90 * 24 * 3600  # seconds
+
+
+class UserCache:
+    def __init__(self, host, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        self.host = host.rstrip('/')
+        self.path = path
+        self.ttl = ttl
+        self.lookups = 0
+        self.lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        self.dirty = False
+
+    def key(self, username):
+        # GitLab usernames are case insensitive
+        return self.host + '|' + username.lower()
+
+    def get(self, username):
+        entry = self.entries.get(self.key(username))
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return entry
+
+    def match_key(self, cg_username):
+        # GitLab usernames cannot contain a colon, so these never clash with the user entries
+        return self.host + '|cg:' + cg_username.lower()
+
+    def get_match(self, cg_username):
+        # The cached GitLab user matched to a CodeGrade username by an earlier run, or None
+        entry = self.entries.get(self.match_key(cg_username))
+        if entry is None or time.time() - entry['fetched'] > self.ttl:
+            return None
+        return self.get(entry['username'])
+
+    def put_match(self, cg_username, user):
+        self.put(user)
+        with self.lock:
+            self.entries[self.match_key(cg_username)] = {'username': user.username, 'fetched': time.time()}
+            self.dirty = True
+
+    def put(self, user):
+        # Accepts python-gitlab User objects
+        with self.lock:
+            self.entries[self.key(user.username)] = {
+                'id': user.id,
+                'username': user.username,
+                'name': user.name,
+                'fetched': time.time(),
+            }
+            self.dirty = True
+
+    def lookup(self, g, username):
+        # User id of a GitLab username, from the cache or from the server
+        entry = self.get(username)
+        if entry is not None:
+            return entry['id']
+        users = g.users.list(username=username)
+        with self.lock:
+            self.lookups += 1
+        if not users:
+            raise LookupError('GitLab user {} does not exist'.format(username))
+        self.put(users[0])
+        return users[0].id
+
+    def invalidate(self, usernames=None):
+        # Forget the given usernames, or everything of this host
+        with self.lock:
+            if usernames is None:
+                keys = [ key for key in self.entries if key.startswith(self.host + '|') ]
+            else:
+                keys = [ self.key(username) for username in usernames ]
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.dirty = True
+
+    def save(self):
+        # Write to a temporary file first, so an interrupted run cannot corrupt the cache
+        with self.lock:
+            if not self.dirty:
+                return
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            self.dirty = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Invalidate cached GitLab user lookups')
+    parser.add_argument('usernames', nargs='*', help='usernames to forget')
+    parser.add_argument('--host', default='https://git.wur.nl', help='GitLab host the usernames belong to')
+    parser.add_argument('--cache', default=DEFAULT_PATH, help='cache file')
+    parser.add_argument('--all', action='store_true', help='forget all users of the host')
+    args = parser.parse_args()
+    if not args.usernames and not args.all:
+        parser.error('give usernames to forget, or --all')
+
+    cache = UserCache(args.host, args.cache)
+    cache.invalidate(None if args.all else args.usernames)
+    cache.save()
+    print('done')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
+import argparse
+import concurrent.futures
 import gitlab
+import json
 import os
+import sys
+import time
 
-with open("../gitlab/secrets.txt", "r") as secretfile:
-    secrets = secretfile.read().splitlines()
-
-token = secrets[2]
-gl = gitlab.Gitlab(url='https://git.wur.nl/', private_token=token)
-gl.auth()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.files import atomic_write
+from common.forks import await_forks, create_fork
+from common.retry import RetryPolicy, mount_retries
 
 id_old = "geoscripting-2023-september"
 id_new = "geoscripting-2024"
@@ -14,24 +17,125 @@ id_new = "geoscripting-2024"
 def update_namespace(old_namespace):
     return old_namespace.replace(id_old, id_new)
 
-# Main Group has subgroups staff and student
-for group in gl.groups.get(id_old).subgroups.list(iterator=True):
+def is_relevant(project):
+    # Main Group has subgroups staff and student, those have groups excercises, assignments etc.
+    # Each assignment has projects (=repos). Student group projects from last year
+    # and Assignment/Solutions. These last onces are of interest.
+    if project.namespace["full_path"].count("/") != 2:
+        return False
+    # relevant assignments etc have been forked by each student team.
+    return project.forks_count > 30 or " solution" in project.name.lower()
+
+def find_projects(gl, old_group, new_group):
+    # The whole tree in one paginated listing each, instead of a request per (sub)group and project
+    projects = [ p for p in old_group.projects.list(include_subgroups=True, get_all=True) if is_relevant(p) ]
+    namespaces = { g.full_path for g in new_group.descendant_groups.list(get_all=True) }
+    for project in projects:
+        if update_namespace(project.namespace["full_path"]) not in namespaces:
+            print(">", "Skipping", project.name + ":", "group", update_namespace(project.namespace["full_path"]),
+                  "does not exist, copy the group structure first")
+    return [ p for p in projects if update_namespace(p.namespace["full_path"]) in namespaces ]
+
+def load_progress(filename):
+    # {source project id: {'name', 'fork_id', 'status', 'seconds'}} of earlier runs
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_progress(filename, progress):
+    with atomic_write(filename) as f:
+        json.dump(progress, f, indent=1, sort_keys=True)
+
+def fork_project(gl, project, entry):
+    # Fork one project, returns the id of the fork. A fork that an earlier run started is not forked again.
+    if entry.get("fork_id") is not None and entry.get("status") not in ("failed", None):
+        return entry["fork_id"]
+    ns = update_namespace(project.namespace["full_path"])
+    try:
+        # Delete fork relation?
+        # gl.projects.get(project.id).delete_fork_relation()
+        return create_fork(gl, project.id, ns).id
+    except gitlab.exceptions.GitlabCreateError as E:
+        # The fork may exist already, e.g. when the previous run stopped before saving its progress
+        try:
+            return gl.projects.get(ns + "/" + project.path).id
+        except gitlab.exceptions.GitlabGetError:
+            raise E
+
+def copy_group(gl, progress_file="copy_progress.json", workers=8, dry_run=False):
+    old_group = gl.groups.get(id_old)
+    new_group = gl.groups.get(id_new)
+    projects = find_projects(gl, old_group, new_group)
+
+    begin = time.monotonic()
+    progress = load_progress(progress_file)
+    todo = [ p for p in projects if progress.get(str(p.id), {}).get("status") != "finished" ]
+    print(len(projects), "project(s) to copy,", len(projects) - len(todo), "already copied by an earlier run")
+    if dry_run:
+        for project in todo:
+            print(f"fork: {project.name} -> {update_namespace(project.namespace['full_path'])}")
+        return 0
+
+    started = {}
+    forks = {}
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for project in todo:
+            entry = progress.setdefault(str(project.id), {"name": project.name})
+            futures[executor.submit(fork_project, gl, project, entry)] = (project, entry, time.monotonic())
+        for future in concurrent.futures.as_completed(futures):
+            project, entry, start = futures[future]
+            try:
+                fork_id = future.result()
+            except gitlab.exceptions.GitlabError as E:
+                print(">", "Error: could not fork", project.name + ":", E)
+                entry["status"] = "failed"
+                errors += 1
+                continue
+            entry.update(fork_id=fork_id, status="started")
+            started[fork_id] = start
+            forks[fork_id] = entry
+    save_progress(progress_file, progress)
+
+    def done(fork_id, status, seconds):
+        forks[fork_id].update(status=status, seconds=round(seconds, 1))
+        print(">", forks[fork_id]["name"] + ":", status, "after {:.1f}s".format(seconds))
+
+    try:
+        results = await_forks(gl, new_group, started, on_done=done)
+    finally:
+        save_progress(progress_file, progress)
+    errors += sum(1 for status, seconds in results.values() if status != "finished")
+    if results:
+        print("Forked", len(results), "project(s) in {:.1f}s (slowest fork {:.1f}s)".format(
+            time.monotonic() - begin, max(seconds for status, seconds in results.values())))
+    if errors:
+        print(errors, "fork(s) did not finish, run again to retry them (delete failed forks in GitLab first)")
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser(description='Fork the assignments and solutions of last year into the new group')
+    parser.add_argument('--workers', type=int, default=8, help='number of projects to fork at the same time')
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be forked')
+    parser.add_argument('--progress', default='copy_progress.json', help='file that remembers the finished forks between runs')
+    args = parser.parse_args()
 
-    # Staff and students have groups excercises, assignments etc
-    for subgroup in gl.groups.get(group.id).subgroups.list(iterator=True):
+    with open("../gitlab/secrets.txt", "r") as secretfile:
+        secrets = secretfile.read().splitlines()
 
-        # Each assignment has projects (=repos). Student group projects from last year
-        # and Assignment/Solutions. These last onces are of interest.
-        for project in gl.groups.get(subgroup.id).projects.list(iterator=True):
+    token = secrets[2]
+    gl = gitlab.Gitlab(url='https://git.wur.nl/', private_token=token)
+    policy = RetryPolicy()
+    mount_retries(gl.session, policy, pool_size=args.workers)
+    gl.auth()
 
-            # relevant assignments etc have been forked by each student team.
-            if project.forks_count > 30 or " solution" in project.name.lower():
-                print(f"fork: {project.name} ?")
-                ns = update_namespace(project.namespace["full_path"])
-                try:
-                    fork = gl.projects.get(project.id).forks.create({"namespace": ns})
-                except gitlab.exceptions.GitlabCreateError as E:
-                    print(E)
+    errors = copy_group(gl, progress_file=args.progress, workers=args.workers, dry_run=args.dry_run)
+    policy.report()
+    if errors:
+        sys.exit(1)
 
-                # Delete fork relation?
-                # gl.projects.get(project.id).delete_fork_relation()
+if __name__ == '__main__':
+    main()
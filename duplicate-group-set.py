@@ -1,34 +1,147 @@
-import codegrade
+# Copy the groups of one CodeGrade group set into another group set of the same course.
+# Groups that are already in the target set (same name and same members) are skipped, so a
+# run that stopped halfway can be finished by running it again with --target.
+
+import argparse
+import concurrent.futures
+import sys
+
+import requests
+
+from common import cgclient
+from common.ratelimit import TokenBucket
+from common.retry import RetryPolicy
 
 secrets_file = "gitlab/secrets.txt"
 codegrade_tenant = "Wageningen University"
 codegrade_host = "https://wur.codegra.de"
 codegrade_course = 5027
 
-with open(secrets_file, "r") as secretfile:
-    secrets = secretfile.read().splitlines()
+def find_group_set(group_sets, group_set_id):
+    for group_set in group_sets:
+        if group_set['id'] == group_set_id:
+            return group_set
+    raise LookupError('Group set {} does not exist in this course'.format(group_set_id))
+
+def member_ids(group):
+    return frozenset(member['id'] for member in group['members'])
+
+def plan_copy(source_groups, target_groups, minimum_size, maximum_size):
+    # Split the source groups into (to create, already copied, problems)
+    existing = { group['name']: member_ids(group) for group in target_groups }
+    taken = set().union(*existing.values()) if existing else set()
+    create, done, problems = [], [], []
+    for group in source_groups:
+        members = member_ids(group)
+        if group['name'] in existing:
+            if existing[group['name']] == members:
+                done.append(group)
+            else:
+                problems.append((group, 'a group with this name but other members is already in the target set'))
+        elif members and not minimum_size <= len(members) <= maximum_size:
+            problems.append((group, '{} member(s), the target set allows {} to {}'.format(
+                len(members), minimum_size, maximum_size)))
+        elif members & taken:
+            problems.append((group, 'some members are already in another group of the target set'))
+        else:
+            create.append(group)
+    return create, done, problems
+
+def create_group(session, group_set_id, group):
+    return session.post('/api/v1/group_sets/{}/group'.format(group_set_id), json={
+        'member_ids': sorted(member_ids(group)),
+        'name': group['name'],
+    })
+
+def create_group_set(session, course_id, group_sets, minimum_size, maximum_size):
+    # CodeGrade creates a group set with PUT (without an id, with one it updates that set).
+    # The session does not send it again after a server error (see cgclient.RETRY_OVERRIDES), as
+    # that could create a second set; instead look whether the set was created after all.
+    try:
+        return session.put('/api/v1/courses/{}/group_sets/'.format(course_id), json={
+            'minimum_size': minimum_size,
+            'maximum_size': maximum_size,
+        })
+    except (cgclient.CodeGradeError, requests.RequestException) as error:
+        known = { group_set['id'] for group_set in group_sets }
+        new = [ group_set for group_set in session.get('/api/v1/courses/{}/group_sets/'.format(course_id))
+                if group_set['id'] not in known and (group_set['minimum_size'], group_set['maximum_size']) == (minimum_size, maximum_size) ]
+        if len(new) != 1:
+            raise
+        print('>', 'Creating the group set failed ({}), but it was created'.format(error))
+        return new[0]
+
+def duplicate(session, course_id, source_id=None, target_id=None, minimum_size=1, maximum_size=2,
+              workers=4, dry_run=False):
+    group_sets = session.get('/api/v1/courses/{}/group_sets/'.format(course_id))
+    # By default copy the first group set of the course
+    source = group_sets[0] if source_id is None else find_group_set(group_sets, source_id)
+    source_groups = session.get('/api/v1/group_sets/{}/groups/'.format(source['id']))
+
+    target, target_groups = None, []
+    if target_id is not None:
+        # Continue an earlier run, the sizes of the existing set apply
+        target = find_group_set(group_sets, target_id)
+        target_groups = session.get('/api/v1/group_sets/{}/groups/'.format(target['id']))
+        minimum_size, maximum_size = target['minimum_size'], target['maximum_size']
+
+    create, done, problems = plan_copy(source_groups, target_groups, minimum_size, maximum_size)
+    for group, problem in problems:
+        print('>', 'Skipping', group['name'] + ':', problem)
+    print(len(source_groups), 'group(s) in group set', source['id'], '-', len(done), 'already copied,',
+          len(problems), 'skipped,', len(create), 'to create')
+    if dry_run or not create:
+        return len(problems)
 
-with codegrade.login(
-        username=secrets[0],
-        password=secrets[1],
-        tenant=codegrade_tenant,
-        host=codegrade_host
-) as client:
-    pass
+    if target is None:
+        target = create_group_set(session, course_id, group_sets, minimum_size, maximum_size)
+        print('Created group set', target['id'])
 
-groupsets = client.course.get_group_sets(course_id=codegrade_course)
-groupsets
+    errors = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(create_group, session, target['id'], group): group for group in create }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except cgclient.CodeGradeError as error:
+                print('>', 'Error: could not create', futures[future]['name'] + ':', error)
+                errors += 1
+    print('Created', len(create) - errors, 'group(s) in group set', target['id'])
+    if errors:
+        print('Run again with --target', target['id'], 'to retry the', errors, 'failed group(s)')
+    return errors + len(problems)
 
-# Define source groupset
-source_groupset = groupsets[0]
+def main():
+    parser = argparse.ArgumentParser(description='Copy the groups of a CodeGrade group set into another group set')
+    parser.add_argument('--source', type=int, help='group set to copy (default: the first group set of the course)')
+    parser.add_argument('--target', type=int, help='existing group set to copy into, e.g. to finish an earlier run (default: create a new one)')
+    parser.add_argument('--min', type=int, default=1, help='minimum group size of a new target group set')
+    parser.add_argument('--max', type=int, default=2, help='maximum group size of a new target group set')
+    parser.add_argument('--workers', type=int, default=4, help='number of groups to create at the same time')
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be copied, do not change anything')
+    args = parser.parse_args()
 
-# Create a new target one, or select an existing target group
-target_groupset = client.course.create_group_set({"minimum_size": 1, "maximum_size": 2}, course_id=codegrade_course)
-#target_groupset = groupsets[2]
+    with open(secrets_file, "r") as secretfile:
+        secrets = secretfile.read().splitlines()
 
-# Groups in the target groupset
-source_groups = client.group_set.get_all_groups(group_set_id=source_groupset.id)
+    policy = RetryPolicy(limiter=TokenBucket(rate=10))
+    try:
+        session = cgclient.login(
+            username=secrets[0],
+            password=secrets[1],
+            tenant=codegrade_tenant,
+            host=codegrade_host,
+            policy=policy,
+            pool_size=args.workers
+        )
+        failed = duplicate(session, codegrade_course, source_id=args.source, target_id=args.target,
+                           minimum_size=args.min, maximum_size=args.max, workers=args.workers,
+                           dry_run=args.dry_run)
+    except (cgclient.CodeGradeError, LookupError) as error:
+        sys.exit(str(error))
+    policy.report()
+    if failed:
+        sys.exit(1)
 
-for source_group in source_groups:
-    member_ids = [member.id for member in source_group.members]
-    client.group_set.create_group({"member_ids":member_ids, "name":source_group.name}, group_set_id=target_groupset.id)
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,9 @@
-import csv
+import os
 import sys
-from urllib.parse import urljoin
-
-import requests
-
-class CGSession(requests.Session):
-    def __init__(self, base_url, access_token, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.base_url = base_url
-
-        self.headers.update({
-            'Authorization': 'Bearer {}'.format(access_token),
-        })
-
-    def request(self, method, url, *args, **kwargs):
-        url = urljoin(self.base_url, url)
-        return self.handle_response(super().request(method, url, *args, **kwargs))
-
-    @classmethod
-    def login(cls, subdomain, username, password):
-        base_url = 'https://{}.codegra.de'.format(subdomain)
-        r = cls.handle_response(
-            requests.post(
-                base_url + '/api/v1/login',
-                json={ 'username': username, 'password': password },
-            ),
-        )
-        return cls(base_url, r['access_token'])
-
-    @staticmethod
-    def handle_response(res):
-        if res.status_code >= 400:
-            msg = res.json()['message']
-            print(
-                'A CodeGrade request went wrong: {}\n{}'.format(
-                    res.url,
-                    msg,
-                ),
-                file=sys.stderr,
-            )
-            exit(1)
-        return res.json()
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cgclient
+from common.roster import GITHUB_IDS, GITHUB_WEBHOOKS, RosterError, read_id_map, write_roster
 
 def get_webhook(session, assignment_id, user):
     return session.post(
@@ -83,11 +45,7 @@ def get_users(session, assignment_id, github_ids, course_id):
     ]
 
 def read_github_ids(in_file):
-    github_ids = {}
-    with open(in_file, 'r') as f:
-        for row in csv.reader(f, delimiter=','):
-            github_ids[row[0]] = row[1]
-    return github_ids
+    return read_id_map(in_file, GITHUB_IDS, 'CGUsername', 'GHUsername')
 
 
 def get_user(groups, username):
@@ -98,7 +56,7 @@ def get_user(groups, username):
     return None
 
 
-def init_roster(access, organization, in_file, out_file, individual=False):
+def init_roster(access, organization, in_file, out_file, individual=False, report=None):
     print('Reading roster ...', end=' ', flush=True)
 
     github_ids = read_github_ids(in_file)
@@ -106,7 +64,7 @@ def init_roster(access, organization, in_file, out_file, individual=False):
 
     print('Retrieving CodeGrade data ...', end=' ', flush=True)
 
-    session = CGSession.login(
+    session = cgclient.login(
         subdomain=access['codegrade']['subdomain'],
         username=access['codegrade']['username'],
         password=access['codegrade']['password'],
@@ -128,22 +86,21 @@ def init_roster(access, organization, in_file, out_file, individual=False):
 
     print('Writing', out_file, '...', end=' ', flush=True)
 
-    with open(out_file, mode='w', newline='') as out:
-        writer = csv.writer(out)
-        writer.writerow(['group_name', 'github_ids', 'payload_url', 'secret', 'public_key'])
-        for group_data in groups:
-            webhook = group_data['webhook']
-            ids = group_data['github_ids']
-
-            writer.writerow([
-                group_data['group']['name'],
-                ' '.join(group_data['github_ids']),
-                '{}/api/v1/webhooks/{}'.format(session.base_url, webhook['id']),
-                webhook['secret'],
-                webhook['public_key'],
-            ])
+    write_roster(out_file, GITHUB_WEBHOOKS, (
+        [
+            group_data['group']['name'],
+            ' '.join(group_data['github_ids']),
+            '{}/api/v1/webhooks/{}'.format(session.base_url, group_data['webhook']['id']),
+            group_data['webhook']['secret'],
+            group_data['webhook']['public_key'],
+        ]
+        for group_data in groups
+    ))
 
     print('done')
+    session.policy.report()
+    if report:
+        session.policy.write_report(report)
 
 
 def main():
@@ -151,22 +108,26 @@ def main():
     with open("secrets.txt", "r") as secretfile:
         secrets = secretfile.read().splitlines()
         
-    init_roster(
-        access={
-            'codegrade': {
-                'subdomain': 'wur',
-                'username': secrets[0],
-                'password': secrets[1],
+    try:
+        init_roster(
+            access={
+                'codegrade': {
+                    'subdomain': 'wur',
+                    'username': secrets[0],
+                    'password': secrets[1],
+                },
             },
-        },
-        organization={
-            'assignment-id': '75',
-            'codegrade-id': 14,
-        },
-        in_file='github_ids.csv',
-        out_file='github_webhooks.csv',
-        individual=True
-    )
+            organization={
+                'assignment-id': '75',
+                'codegrade-id': 14,
+            },
+            in_file='github_ids.csv',
+            out_file='github_webhooks.csv',
+            individual=True,
+            report=None  # e.g. 'webhooks_report.json' for the timings of the CodeGrade calls
+        )
+    except (cgclient.CodeGradeError, RosterError) as error:
+        sys.exit(str(error))
 
 
 if __name__ == '__main__':
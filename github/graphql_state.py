@@ -0,0 +1,122 @@
+# Read the state of all repositories of an assignment with a few paginated GraphQL queries,
+# instead of several REST calls per repository: one listing of the names in the organisation,
+# then the collaborators and deploy keys of the assignment's repositories in batches.
+# Webhooks are not available in the GraphQL API, so those are still read over REST by
+# installKeysAndHooks.py.
+
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.retry import IDEMPOTENT_METHODS, mount_retries
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# The names of all repositories of the organisation. Not the search API: that one is eventually
+# consistent, stops at 1000 results and matches words, so it can miss repositories that exist.
+NAMES_QUERY = '''
+query($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name }
+    }
+  }
+}
+'''
+
+# Collaborators and deploy keys of a batch of repositories, one aliased field per repository
+DETAILS_FIELDS = '''
+fragment details on Repository {
+  name
+  collaborators(first: 100) { pageInfo { hasNextPage } nodes { login } }
+  deployKeys(first: 100) { pageInfo { hasNextPage } nodes { title } }
+}
+'''
+
+TEAM_QUERY = '''
+query($org: String!, $team: String!, $cursor: String) {
+  organization(login: $org) {
+    team(slug: $team) {
+      repositories(first: 100, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        edges { permission node { name } }
+      }
+    }
+  }
+}
+'''
+
+# Repositories per details query
+BATCH = 50
+
+
+def details_query(names):
+    # Names are string literals in the query, JSON strings are valid GraphQL strings
+    fields = ' '.join('r{}: repository(owner: $org, name: {}) {{ ...details }}'.format(i, json.dumps(name))
+                      for i, name in enumerate(names))
+    return 'query($org: String!) {{ {} }}'.format(fields) + DETAILS_FIELDS
+
+
+class GraphQLClient:
+    def __init__(self, token, policy, url=GRAPHQL_URL):
+        self.url = url
+        # The queries are POSTed, but only read, so they are retried like a GET
+        self.session = mount_retries(requests.Session(), policy, idempotent=IDEMPOTENT_METHODS | {'POST'})
+        self.session.headers.update({'Authorization': 'bearer {}'.format(token)})
+
+    def query(self, query, **variables):
+        res = self.session.post(self.url, json={'query': query, 'variables': variables})
+        res.raise_for_status()
+        data = res.json()
+        if data.get('errors'):
+            raise RuntimeError('GitHub GraphQL query failed: {}'.format(
+                '; '.join(error['message'] for error in data['errors'])))
+        return data['data']
+
+    def paginate(self, query, path, **variables):
+        # Yield the nodes/edges of the connection at `path` page by page
+        cursor = None
+        while True:
+            data = self.query(query, cursor=cursor, **variables)
+            for key in path:
+                data = data[key] if data is not None else None
+            if data is None:
+                return
+            yield from data.get('nodes', data.get('edges', []))
+            if not data['pageInfo']['hasNextPage']:
+                return
+            cursor = data['pageInfo']['endCursor']
+
+
+def fetch_state(client, org, prefix, teams=('staff', 'students')):
+    # State of all repositories of the organisation whose name starts with `prefix`:
+    #   {'repos': {name: {'collaborators': set or None, 'keys': list or None}}, 'staff': set, 'students': set}
+    # Collaborators and keys are None when a repository has more than one page of them,
+    # the caller reads those over REST.
+    state = {'repos': {}}
+    names = [ node['name'] for node in client.paginate(NAMES_QUERY, ['organization', 'repositories'], org=org)
+              if node['name'].startswith(prefix) ]
+    for i in range(0, len(names), BATCH):
+        data = client.query(details_query(names[i:i + BATCH]), org=org)
+        for node in data.values():
+            if node is None:
+                # Deleted since it was listed
+                continue
+            collaborators = node['collaborators']
+            keys = node['deployKeys']
+            state['repos'][node['name']] = {
+                'collaborators': None if collaborators['pageInfo']['hasNextPage']
+                    else { user['login'].lower() for user in collaborators['nodes'] },
+                'keys': None if keys['pageInfo']['hasNextPage'] else [ key['title'] for key in keys['nodes'] ],
+            }
+    for team in teams:
+        state[team] = {
+            edge['node']['name']
+            for edge in client.paginate(TEAM_QUERY, ['organization', 'team', 'repositories'], org=org, team=team)
+            if edge['node']['name'].startswith(prefix)
+        }
+    return state
@@ -1,52 +1,18 @@
 import pprint
 
+import os
 import sys, ast
-import csv
 import json
 import getpass
-from urllib.parse import urljoin
 from github import Github
 
-import requests
-
-class CGSession(requests.Session):
-    def __init__(self, prefix_url, access_token, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.prefix_url = prefix_url
-
-        self.headers.update({
-            'Authorization': 'Bearer {}'.format(access_token),
-        })
-
-    def request(self, method, url, *args, **kwargs):
-        url = urljoin(self.prefix_url, url)
-        return super().request(method, url, *args, **kwargs)
-
-
-def handle_response(res):
-    if res.status_code >= 400:
-        print(
-            'A CodeGrade request went wrong: {}'.format(res.json()['message']),
-            file=sys.stderr)
-        exit(1)
-    return res.json()
-
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cgclient
+from common.roster import GITHUB_ROSTER, write_roster
 
 def get_users(subdomain, username, password, course_id):
-    base_url = 'https://{}.codegra.de'.format(subdomain)
-
-    r = handle_response(requests.post(
-        base_url + '/api/v1/login',
-        json = { 'username': username, 'password': password },
-    ))
-
-    ses = CGSession(base_url, r['access_token'])
-    
-    users = handle_response(
-        ses.get('/api/v1/courses/{}/users/'.format(course_id)),
-    )
-
-    return users
+    session = cgclient.login(subdomain=subdomain, username=username, password=password)
+    return session.get('/api/v1/courses/{}/users/'.format(course_id))
 
 
 def init_roster(access, organization, roster):
@@ -59,11 +25,9 @@ def init_roster(access, organization, roster):
     )
     print('done')
     print('Writing',roster,'...', end=' ', flush=True)
-    with open(roster, mode='w', newline='') as out:
-        w = csv.writer(out)
-        w.writerow(['name','email','codegrade-user','github-user'])
-        for u in users:
-            w.writerow([u['User']['name'], '?', u['User']['username'], '?'])
+    write_roster(roster, GITHUB_ROSTER, (
+        [u['User']['name'], '?', u['User']['username'], '?'] for u in users
+    ))
     print('done')
 
 
@@ -1,131 +1,258 @@
 import pprint
 
+import argparse
+import concurrent.futures
 import sys
-import csv
 import getpass
-from urllib.parse import urljoin
 from github import Github
 # Requires a version with template cloning support:
 # https://github.com/PyGithub/PyGithub/pull/1395
 # i.e. python -m pip install git+https://github.com/isouza-daitan/PyGithub@create-from-template
 
-import requests
 import re
+import os
 
-class CGSession(requests.Session):
-    def __init__(self, prefix_url, access_token, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.prefix_url = prefix_url
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.instrument import Progress
+from common.retry import RetryPolicy, is_safe_to_resend
+from common.roster import GITHUB_WEBHOOKS, RosterError, read_roster
+from graphql_state import GRAPHQL_URL, GraphQLClient, fetch_state
 
-        self.headers.update({
-            'Authorization': 'Bearer {}'.format(access_token),
-        })
+def load_user_data(filename='github_webhooks.csv'):
+    try:
+        return list(read_roster(filename, GITHUB_WEBHOOKS))
+    except RosterError as e:
+        sys.exit(e)
 
-    def request(self, method, url, *args, **kwargs):
-        url = urljoin(self.prefix_url, url)
-        return super().request(method, url, *args, **kwargs)
 
+def read_repo_state(ctx, reponame):
+    # Current state of one repository, repositories that do not exist yet get an empty state
+    call = ctx['policy'].call
+    index = ctx['index']
+    repo = index['repos'].get(reponame)
+    if repo is None:
+        return {'repo': None, 'collaborators': set(), 'staff': False, 'students': False, 'keys': [], 'hooks': []}
+    # Collaborators and keys may already be known from the GraphQL backend
+    prefetched = index.get('prefetched', {}).get(reponame, {})
+    collaborators = prefetched.get('collaborators')
+    if collaborators is None:
+        collaborators = call(lambda: { user.login.lower() for user in repo.get_collaborators() }, label='GitHub list collaborators')
+    keys = prefetched.get('keys')
+    if keys is None:
+        keys = call(lambda: [ key.title for key in repo.get_keys() ], label='GitHub list keys')
+    return {
+        'repo': repo,
+        'collaborators': collaborators,
+        'staff': reponame in index['staff'],
+        'students': reponame in index['students'],
+        'keys': keys,
+        'hooks': call(lambda: [ hook.config['url'] for hook in repo.get_hooks() ], label='GitHub list hooks'),
+    }
 
-def handle_response(res):
-    if res.status_code >= 400:
-        print(
-            'A CodeGrade request went wrong: {}'.format(res.json()['message']),
-            file=sys.stderr)
-        exit(1)
-    return res.json()
+def build_repo_index(ctx):
+    # List the repositories of the organisation and of both teams once per run,
+    # so that existence and team checks are lookups instead of API calls per repository
+    call = ctx['policy'].call
+    return {
+        'repos': call(lambda: { repo.name: repo for repo in ctx['org'].get_repos() }, label='GitHub list repositories'),
+        'staff': call(lambda: { repo.name for repo in ctx['staff_team'].get_repos() }, label='GitHub list team repositories'),
+        'students': call(lambda: { repo.name for repo in ctx['student_team'].get_repos() }, label='GitHub list team repositories'),
+    }
 
-def load_user_data(filename='github_webhooks.csv'):
-    with open(filename) as user_data:
-        reader = csv.DictReader(user_data)
-        try:
-            data = [ line for line in reader]
-        except csv.Error as e:
-            sys.exit('file {}, line {}: {}'.format(filename, reader.line_num, e))
-    return data
+def build_graphql_index(ctx, client):
+    # Same as build_repo_index, but also reads the collaborators and deploy keys of all
+    # repositories of the assignment in a few GraphQL queries. Only the repositories that
+    # need changes are fetched over REST, lazily.
+    org = ctx['org'].login
+    prefix = ctx['assignment']['github-name'] + '-'
+    state = fetch_state(client, org, prefix)
+    return {
+        'repos': { name: ctx['github'].get_repo(org + '/' + name, lazy=True) for name in state['repos'] },
+        'staff': state['staff'],
+        'students': state['students'],
+        'prefetched': state['repos'],
+    }
+
+def plan_group(state, group, student_readable):
+    # Changes needed to get from the current state to the desired state, as (action, argument) pairs
+    actions = []
+    if state['repo'] is None:
+        actions.append(('create', None))
+    for member in group["github_ids"].split():
+        if member.lower() not in state['collaborators']:
+            actions.append(('add_collaborator', member))
+    if not state['staff']:
+        actions.append(('add_staff', None))
+    if student_readable and not state['students']:
+        actions.append(('add_students', None))
+    if 'codegrade-key' not in state['keys']:
+        actions.append(('add_key', group['public_key']))
+    if group['payload_url'] not in state['hooks']:
+        actions.append(('add_hook', group['payload_url']))
+    return actions
+
+def describe(action):
+    kind, arg = action
+    return {
+        'create': '+ repository (from the template)',
+        'add_collaborator': '+ collaborator {}',
+        'add_staff': '+ admin access for staff',
+        'add_students': '+ read access for students',
+        'add_key': '+ deploy key codegrade-key',
+        'add_hook': '+ webhook {}',
+    }[kind].format(arg)
+
+def apply_action(ctx, reponame, repo, action, group):
+    call = ctx['policy'].call
+    kind, arg = action
+    if kind == 'create':
+        template = call(ctx['org'].get_repo, ctx['assignment']['github-name'], label='GitHub get repository')
+        # Creating (POST) is not retried after a server error: it may have been done already
+        repo = call(ctx['org'].create_repo_from_template, reponame, template, private=True,
+                    label='GitHub create repository', retry_if=is_safe_to_resend)
+        ctx['index']['repos'][reponame] = repo
+        return repo
+    if kind == 'add_collaborator':
+        call(repo.add_to_collaborators, arg, "maintain", label='GitHub add collaborator')
+    elif kind == 'add_staff':
+        call(ctx['staff_team'].add_to_repos, repo, label='GitHub add team')
+        call(ctx['staff_team'].set_repo_permission, repo, "admin", label='GitHub set team permission')
+        ctx['index']['staff'].add(reponame)
+    elif kind == 'add_students':
+        call(ctx['student_team'].add_to_repos, repo, label='GitHub add team')
+        ctx['index']['students'].add(reponame)
+    elif kind == 'add_key':
+        call(repo.create_key, title='codegrade-key', key=arg, label='GitHub create key', retry_if=is_safe_to_resend)
+    elif kind == 'add_hook':
+        call(repo.create_hook,
+            'web',
+            config={
+                'url': arg,
+                'content_type': 'json',
+                'secret': group['secret']
+            },
+            events=['push'],
+            active=True,
+            label='GitHub create hook',
+            retry_if=is_safe_to_resend
+        )
+    return repo
+
+def plan_sync_group(ctx, group):
+    # Phase 1: read the state of the group's repository and work out what has to change
+    groupname = re.sub(r'[^\w\-_]', '_', group['group_name'], flags=re.ASCII)
+    reponame = ctx['assignment']['github-name'] + '-' + groupname
+    try:
+        state = read_repo_state(ctx, reponame)
+        return reponame, state, plan_group(state, group, ctx['student_readable']), None
+    except Exception as exception:
+        return reponame, None, None, exception
+
+def sync_group(ctx, group, planned):
+    # Phase 2: apply the planned changes of a single group, collecting the output in a log
+    log = []
+    def say(*args):
+        log.append(' '.join(str(arg) for arg in args))
 
+    reponame, state, actions, exception = planned
+    no_errors = 0
+    say('Processing', reponame,'...')
+    try:
+        if exception is not None:
+            raise exception
+        repo = state['repo']
+        if not actions:
+            say('>', 'Repository is up to date')
+        for action in actions:
+            say('>', describe(action))
+            try:
+                repo = apply_action(ctx, reponame, repo, action, group)
+            except:
+                if action[0] != 'add_collaborator':
+                    raise
+                e = sys.exc_info()[0]
+                say('>','Error:', e)
+                no_errors += 1
+        return 1, no_errors, log
+    except:
+        e = sys.exc_info()[0]
+        say('>','Error:', e)
+        return 0, no_errors + 1, log
+
+def print_plan(plans):
+    # Show the difference between the current and the desired state, without changing anything
+    no_changes = 0
+    no_errors = 0
+    for reponame, state, actions, exception in plans:
+        if exception is not None:
+            print(reponame + ':', 'could not be read:', exception)
+            no_errors += 1
+        elif actions:
+            print(reponame + ':')
+            for action in actions:
+                print('   ', describe(action))
+            no_changes += 1
+    print('\nPlan:', no_changes, 'of', len(plans), 'group(s) need changes;', no_errors, 'error(s). Nothing was changed.')
 
-def sync(access, organization, roster, assignment, student_readable=False):
+def sync(access, organization, roster, assignment, student_readable=False, workers=1, plan=False, backend='rest', report=None):
     print('Connecting to the organization',organization['github-name'],'...', end=' ', flush=True)
     g = Github(access['github']['token'])
-    org = g.get_organization(organization['github-name'])
+    # Every GitHub call goes through the retry policy, transient errors are retried with backoff
+    policy = RetryPolicy()
+    call = policy.call
+    org = call(g.get_organization, organization['github-name'], label='GitHub organization')
     print('done')
     print('Loading the roster ...', end=' ', flush=True)
     group_info = load_user_data(roster)
     print('done')
-    staff_team = org.get_team_by_slug("staff")
-    student_team = org.get_team_by_slug("students")
+    ctx = {
+        'policy': policy,
+        'github': g,
+        'org': org,
+        'staff_team': call(org.get_team_by_slug, "staff", label='GitHub team'),
+        'student_team': call(org.get_team_by_slug, "students", label='GitHub team'),
+        'assignment': assignment,
+        'student_readable': student_readable,
+    }
+    print('Indexing repositories ...', end=' ', flush=True)
+    if backend == 'graphql':
+        client = GraphQLClient(access['github']['token'], policy, access['github'].get('graphql-url', GRAPHQL_URL))
+        ctx['index'] = build_graphql_index(ctx, client)
+    else:
+        ctx['index'] = build_repo_index(ctx)
+    print('done')
     no_groups = 0
     no_errors = 0
-    for group in group_info:
-        groupname = re.sub(r'[^\w\-_]', '_', group['group_name'], flags=re.ASCII)
-        reponame = assignment['github-name'] + '-' + groupname
-        group_members = group["github_ids"].split()
-        print('Processing', reponame,'...')
-        try:
-            if reponame not in [ repo.name for repo in org.get_repos() ]:
-                print(">", "Repository", reponame, "does not exist yet, cloning...")
-                template = org.get_repo(assignment['github-name'])
-                org.create_repo_from_template(reponame, template, private=True)
-                print(">", "Repository", reponame, "created successfully")
-            repo = org.get_repo(reponame)
-            
-            for member in group_members:
-                print(">", "Processing collaborators:", member)
-                if repo.has_in_collaborators(member):
-                    print('>', 'Collaborator', member, 'already present')
-                else:
-                    print('>', 'Adding collaborator', member)
-                    try:
-                        repo.add_to_collaborators(member, "maintain")
-                        print('>', 'Collaborator', member, 'added to the repository')
-                    except:
-                        e = sys.exc_info()[0]
-                        print('>','Error:', e)
-                        no_errors += 1
-            if staff_team.has_in_repos(repo):
-                print(">", "Staff already owns", reponame)
-            else:
-                print(">", "Adding staff permission to maintain", reponame)
-                staff_team.add_to_repos(repo)
-                staff_team.set_repo_permission(repo, "admin")
-                print(">", "Staff can now maintain", reponame)
-            if student_readable:
-                print(">","Checking if students can read the repo")
-                if student_team.has_in_repos(repo):
-                    print(">", "Students can already see", reponame)
-                else:
-                    print(">", "Adding students permission to read", reponame)
-                    student_team.add_to_repos(repo)
-                    print(">", "Students can now read", reponame)
-            
-            if 'codegrade-key' not in [ key.title for key in repo.get_keys() ]:
-                print('>','Adding deploy key for', group['group_name'])
-                repo.create_key(title='codegrade-key', key=group['public_key'])
-            else:
-                print('>','Deploy key found for', group['group_name'])
-            if group['payload_url'] not in [ hook.config['url'] for hook in repo.get_hooks() ]:
-                print('>','Adding webhook for', group['group_name'])
-                repo.create_hook(
-                    'web',
-                    config={
-                        'url': group['payload_url'],
-                        'content_type': 'json',
-                        'secret': group['secret']
-                    },
-                    events=['push'],
-                    active=True
-                )
-            else:
-                print('>','Webhook found for', group['group_name'])
-            no_groups += 1
-        except:
-            e = sys.exc_info()[0]
-            print('>','Error:', e)
-            no_errors += 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Read the state of all repositories first, and work out what has to change
+        print('Reading', len(group_info), 'repositories ...')
+        with Progress(len(group_info), 'Reading') as progress:
+            plans = list(pool.map(progress.track(lambda group: plan_sync_group(ctx, group)), group_info))
+        if plan:
+            print_plan(plans)
+            return
+
+        # Then apply only the changes, the logs are printed in roster order
+        with Progress(len(group_info), 'Applying') as progress:
+            results = pool.map(progress.track(lambda args: sync_group(ctx, *args)), zip(group_info, plans))
+            for processed, errors, log in results:
+                progress.write('\n'.join(log))
+                no_groups += processed
+                no_errors += errors
     print('\nProcessed',no_groups,'group(s);',no_errors,'error(s).')
+    policy.report()
+    if report:
+        policy.write_report(report)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Create and configure the GitHub repositories of an assignment')
+    parser.add_argument('--plan', action='store_true', help='only show what would change, do not change anything')
+    parser.add_argument('--workers', type=int, default=1, help='number of groups to process at the same time')
+    parser.add_argument('--graphql', action='store_true', help='read the state of all repositories with GraphQL queries')
+    parser.add_argument('--report', metavar='FILE', help='write a JSON report with the timings of all GitHub calls')
+    args = parser.parse_args()
+
     with open("secrets.txt", "r") as secretfile:
         secrets = secretfile.read().splitlines()
     sync(
@@ -148,7 +275,11 @@ def main():
             'codegrade-id': 75,
             'github-name': 'Resit_Exam_Starter'
         },
-        student_readable=False
+        student_readable=False,
+        workers=args.workers,
+        plan=args.plan,
+        backend='graphql' if args.graphql else 'rest',
+        report=args.report
     )
 
     
@@ -1,15 +1,15 @@
-import csv, sys
+import os, sys
 from github import Github
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.roster import GITHUB_ROSTER, RosterError, read_roster
+
 
 def load_user_data(filename='roster.csv'):
-    with open(filename) as user_data:
-        reader = csv.DictReader(user_data)
-        try:
-            data = [ line for line in reader]
-        except csv.Error as e:
-            sys.exit('file {}, line {}: {}'.format(filename, reader.line_num, e))
-    return data
+    try:
+        return list(read_roster(filename, GITHUB_ROSTER))
+    except RosterError as e:
+        sys.exit(e)
 
 
 def invite(token, organization, roster):
@@ -1,49 +1,146 @@
 # 1) Script for generating a roster table that maps CodeGrade and GitLab accounts.
 # This is a helper script, you can also create this yourself.
 
-import codegrade
 import gitlab
-import csv
+import difflib
+import os
+import sys
 from unidecode import unidecode
-import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cgclient, roster
+from common.retry import RetryPolicy, mount_retries
+from common.usercache import UserCache
 
 def init_roster(gitlab_host,
                 codegrade_tenant, codegrade_host, codegrade_course, codegrade_nonstudent_role = "Teacher",
-                secrets_file = "secrets.txt", output_file = "usernames.csv"):
+                secrets_file = "secrets.txt", output_file = "usernames.csv", user_cache = "gitlab_users.json",
+                match_mode = "bulk", gitlab_group = None, report = None):
     
     # Read secrets. First line is codegrade user, second is codegrade password, third is GitLab access token
     with open(secrets_file, "r") as secretfile:
         secrets = secretfile.read().splitlines()
     
-    students = get_cg_students(secrets, codegrade_tenant, codegrade_host, codegrade_course, codegrade_nonstudent_role)
-    students = add_gl_students(students, secrets, gitlab_host) # Try to automatically match students to GitLab users via username/name
+    policy = RetryPolicy()
+    students = get_cg_students(secrets, codegrade_tenant, codegrade_host, codegrade_course, codegrade_nonstudent_role, policy)
+    users = UserCache(gitlab_host, user_cache) # Matched users are remembered for the other scripts
+    # Try to automatically match students to GitLab users via username/name
+    if match_mode == "bulk":
+        if gitlab_group is None:
+            sys.exit('Set gitlab_group to the GitLab group of the course, or use match_mode = "all-users" '
+                     'to match against every user of the GitLab instance')
+        students = match_gl_students(students, secrets, gitlab_host, policy, users, gitlab_group)
+    elif match_mode == "all-users":
+        students = match_gl_students(students, secrets, gitlab_host, policy, users)
+    else:
+        students = add_gl_students(students, secrets, gitlab_host, policy, users)
+    users.save()
     write_roster(students, output_file)
+    policy.report()
+    if report:
+        policy.write_report(report)
 
-def get_cg_students(secrets, codegrade_tenant, codegrade_host, codegrade_course, codegrade_nonstudent_role):
+def get_cg_students(secrets, codegrade_tenant, codegrade_host, codegrade_course, codegrade_nonstudent_role, policy):
     # Log into Codegrade
-    with codegrade.login(
+    session = cgclient.login(
         username=secrets[0],
         password=secrets[1],
         tenant=codegrade_tenant,
-        host=codegrade_host
-    ) as client:
-        pass
+        host=codegrade_host,
+        policy=policy
+    )
 
     # Get users
-    cg_users = client.course.get_all_users(course_id=codegrade_course)
-    cg_students = []
-    for user in cg_users:
-        if user.course_role.name != codegrade_nonstudent_role:
-            cg_students.append([user.user.name, user.user.username])
-        print(cg_students)
-        time.sleep(0.1)
-    #cg_students = [[user.user.name, user.user.username] for user in cg_users if user.course_role.name != codegrade_nonstudent_role]
+    cg_users = session.get('/api/v1/courses/{}/users/'.format(codegrade_course))
+    cg_students = [[user['User']['name'], user['User']['username']] for user in cg_users if user['CourseRole']['name'] != codegrade_nonstudent_role]
+    print('Found', len(cg_students), 'student(s) in CodeGrade')
+    return cg_students
+
+def normalise(text):
+    # Compare names and usernames without accents, case and extra whitespace
+    return ' '.join(unidecode(text).casefold().split())
+
+def match_gl_students(cg_students, secrets, gitlab_host, policy, users, gitlab_group = None, cutoff = 0.8):
+    # Match all students locally against GitLab users fetched in bulk: the members of
+    # gitlab_group if given (the course group), otherwise all users of the instance.
+    # Students without an exact match in the group (e.g. not in it yet) are searched for one by one.
+    # Students matched in an earlier run need no matching, and when all are known no listing either
+    todo = []
+    for student in cg_students:
+        cached = users.get_match(student[1])
+        if cached is not None:
+            student.extend([cached['name'], cached['username']])
+        else:
+            todo.append(student)
+    print(len(cg_students) - len(todo), 'student(s) known from an earlier run')
+    if not todo:
+        return cg_students
+
+    gl = gitlab.Gitlab(gitlab_host, private_token=secrets[2])
+    mount_retries(gl.session, policy)
+    if gitlab_group is not None:
+        candidates = gl.groups.get(gitlab_group).members_all.list(get_all=True, per_page=100)
+    else:
+        candidates = gl.users.list(get_all=True, active=True, per_page=100)
+    print('Matching against', len(candidates), 'GitLab user(s)')
+
+    by_username = {}
+    by_name = {}
+    for user in candidates:
+        by_username[normalise(user.username)] = user
+        by_name.setdefault(normalise(user.name), []).append(user)
+    names = list(by_name)
+
+    unmatched = []
+    for student in todo:
+        cg_name = normalise(student[0])
+        cg_user = normalise(student[1])
+
+        # Exact username (or the part before the @ of an email address), then exact name, then closest names
+        exact = by_username.get(cg_user) or by_username.get(cg_user.split('@')[0])
+        if exact is not None:
+            matches = [(1.0, exact)]
+        elif cg_name in by_name:
+            matches = [(1.0, user) for user in by_name[cg_name]]
+        elif gitlab_group is not None:
+            # Most likely a student that did not join the group yet, rather than a member with another name
+            matches = []
+        else:
+            matches = [
+                (difflib.SequenceMatcher(None, cg_name, name).ratio(), user)
+                for name in difflib.get_close_matches(cg_name, names, n=3, cutoff=cutoff)
+                for user in by_name[name]
+            ]
+            matches.sort(key=lambda match: -match[0])
+
+        if not matches:
+            unmatched.append(student)
+            continue
+        score, user = matches[0]
+        student.extend([user.name, user.username])
+        if len(matches) > 1 and matches[1][0] >= score - 0.05:
+            print(f'WARNING! {student[0]} is ambiguous, using {user.username}. Candidates:',
+                  ', '.join('{} ({}, score {:.2f})'.format(u.username, u.name, sc) for sc, u in matches))
+        elif score < 1.0:
+            print(f'NOTE: {student[0]} matched to {user.name} ({user.username}) with score {score:.2f}, please check')
+        else:
+            # Only certain matches are remembered, for the next run and the other scripts
+            users.put_match(student[1], user)
+
+    if gitlab_group is not None and unmatched:
+        print('Searching for', len(unmatched), 'student(s) that are not in', gitlab_group)
+        add_gl_students(unmatched, secrets, gitlab_host, policy, users)
+    else:
+        for student in unmatched:
+            student.extend(["", ""])
+            print(f'WARNING! {student[0]} not found. Check what is going on!')
     return cg_students
 
 
-def add_gl_students(cg_students, secrets, gitlab_host):
+def add_gl_students(cg_students, secrets, gitlab_host, policy, users):
     # Log into GitLab
     gl = gitlab.Gitlab(gitlab_host, private_token=secrets[2])
+    mount_retries(gl.session, policy)
 
     # Get our group that has the students
     #groups = gl.groups.list(search=gitlab_student_group_name, order_by="similarity")
@@ -53,13 +150,20 @@ def add_gl_students(cg_students, secrets, gitlab_host):
     # Search for matching students
     # First search by username, then search by name
     for student in cg_students:
+        # A user matched in an earlier run needs no search
+        cached = users.get_match(student[1])
+        if cached is not None:
+            student.extend([cached['name'], cached['username']])
+            continue
         gl_user = gl.users.list(search=unidecode(student[1]))
         if len(gl_user) > 0:
             student.extend([gl_user[0].name, gl_user[0].username])
+            users.put_match(student[1], gl_user[0])
         else:
             gl_user = gl.users.list(search=unidecode(student[0]), get_all=True)
             if len(gl_user) > 0:
                 student.extend([gl_user[0].name, gl_user[0].username])
+                users.put_match(student[1], gl_user[0])
             else:
                 student.extend(["", ""])
                 print(f'WARNING! {student[0]} not found. Check what is going on!')
@@ -67,11 +171,7 @@ def add_gl_students(cg_students, secrets, gitlab_host):
 
 def write_roster(cg_students, output_file):
     # Write roster to file
-    with open(output_file, mode='w', newline='', encoding='utf-8') as out:
-        w = csv.writer(out)
-        w.writerow(['cg_name','cg_user','gl_name','gl_user'])
-        for student in cg_students:
-                w.writerow(student)
+    roster.write_roster(output_file, roster.GITLAB_USERNAMES, cg_students)
     print("File " + output_file + " written successfully! Please check the file and adjust as needed.")
 
 # Get all students in group
@@ -88,7 +188,9 @@ def main():
         codegrade_course = 13231,                     # <-------------------------------------- code
         codegrade_nonstudent_role = "Teacher",       # <-------------------------------------- 'Teacher'
         gitlab_host = 'https://git.wur.nl',
-        output_file = "usernames.csv"
+        output_file = "usernames.csv",
+        match_mode = "bulk",                           # <-------------------------------------- 'bulk', 'all-users' or 'search'
+        gitlab_group = 'geoscripting-2025'             # <-------------------------------------- the course group, for 'bulk'
     )
     
 if __name__ == '__main__':
@@ -1,59 +1,81 @@
-import codegrade
-import csv
+import concurrent.futures
 import json
-import requests
-import time
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cgclient, roster
+from common.instrument import Progress
+from common.ratelimit import TokenBucket
+from common.retry import RetryPolicy
 
 def get_webhook(session, assignment_id, user):
-    max_retries = 10
-    for i in range(max_retries):
-        try:
-            webhook = session.assignment.get_webhook_settings(assignment_id = assignment_id, webhook_type = "git", author_id = user)
-            break
-        except:
-            print("Timed out getting webhook for user "+ str(user) +", retrying... " + str(i) + "/" + str(max_retries))
-            pass
-    
-    return {'id': webhook.id, 'public_key': webhook.public_key, 'secret': webhook.secret}
+    return session.post(
+        '/api/v1/assignments/{}/webhook_settings'.format(assignment_id),
+        params={'webhook_type': 'git', 'author_id': user},
+    )
 
-def get_nonempty_groups(session, assignment_id, git_ids, access):
-    assignment = session.assignment.get(assignment_id = assignment_id)
-    group_set_id = assignment.group_set.id
-    groups = session.group_set.get_all_groups(group_set_id=group_set_id, page_size = 50)
+def get_webhooks(session, assignment_id, authors, workers):
+    # Fetch the webhook settings of all authors concurrently, results are in the order of `authors`
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool, Progress(len(authors), 'Webhooks') as progress:
+        return list(pool.map(progress.track(lambda author: get_webhook(session, assignment_id, author)), authors))
 
+def find_nonempty_groups(session, assignment_id, git_ids):
+    # Groups of the assignment whose members are all in the roster, with the author to request the webhook for
+    assignment = session.get('/api/v1/assignments/{}'.format(assignment_id))
+    group_set_id = assignment['group_set']['id']
+    groups = session.get('/api/v1/group_sets/{}/groups/'.format(group_set_id))
     return [
         {
-            'name': g.name,
-            'webhook': get_webhook(session, assignment_id, g.members[0].id),
+            'name': g['name'],
+            'author': g['members'][0]['id'],
             'git_ids': [
-                git_ids[m.username]
-                for m in g.members
+                git_ids[m['username']]
+                for m in g['members']
             ],
         }
-        for g in groups if g.members and all(u.username in git_ids for u in g.members)
+        for g in groups if g['members'] and all(u['username'] in git_ids for u in g['members'])
     ]
 
-def get_users(session, assignment_id, git_ids, course_id):
-    users = session.course.get_all_users(course_id = course_id)
-
-    result = []
-    for user in users:
-        if user.user.username in git_ids:
-            result.append({
-                'name': user.user.name,
-                'git_ids': [ git_ids[user.user.username] ],
-                'webhook': get_webhook(session, assignment_id, user.user.id)
-            })
-        time.sleep(0.1)
-        
-    return result
+def find_users(session, git_ids, course_id):
+    # Course members that are in the roster, each is their own group
+    users = session.get('/api/v1/courses/{}/users/'.format(course_id))
+    return [
+        {
+            'name': user['User']['name'],
+            'author': user['User']['id'],
+            'git_ids': [ git_ids[user['User']['username']] ],
+        }
+        for user in users if user['User']['username'] in git_ids
+    ]
+
+def with_webhooks(session, assignment_id, groups, workers):
+    webhooks = get_webhooks(session, assignment_id, [ group['author'] for group in groups ], workers)
+    return [ dict(group, webhook=webhook) for group, webhook in zip(groups, webhooks) ]
+
+def get_nonempty_groups(session, assignment_id, git_ids, access, workers):
+    return with_webhooks(session, assignment_id, find_nonempty_groups(session, assignment_id, git_ids), workers)
+
+def get_users(session, assignment_id, git_ids, course_id, workers):
+    return with_webhooks(session, assignment_id, find_users(session, git_ids, course_id), workers)
+
+def roster_row(session, group_data):
+    # One row of webhooks.csv, as read back by 3_installKeysAndHooks.py
+    webhook = group_data['webhook']
+    return {
+        'name': group_data['name'],
+        'git_ids': ' '.join(group_data['git_ids']),
+        'payload_url': '{}/api/v1/webhooks/{}'.format(session.base_url, webhook['id']),
+        'secret': webhook['secret'],
+        'public_key': webhook['public_key'],
+    }
+
+def write_webhooks(out_file, rows):
+    roster.write_roster(out_file, roster.GITLAB_WEBHOOKS, rows)
 
 def read_gitlab_ids(in_file):
-    gitlab_ids = {}
-    with open(in_file, 'r') as f:
-        for row in csv.reader(f, delimiter=','):
-            gitlab_ids[row[1]] = row[3]
-    return gitlab_ids
+    # CodeGrade username -> GitLab username, students without a GitLab user are left out
+    return roster.read_id_map(in_file, roster.GITLAB_USERNAMES, 'cg_user', 'gl_user')
 
 
 def get_user(groups, username):
@@ -64,56 +86,50 @@ def get_user(groups, username):
     return None
     
 
-def init_roster(access, organization, in_file, out_file, individual=False):
+def init_roster(access, organization, in_file, out_file, individual=False, workers=8, rate=10, report=None):
     print('Reading roster ...', end=' ', flush=True)
 
     gitlab_ids = read_gitlab_ids(in_file)
     print('done')
 
-    print('Retrieving CodeGrade data ...', end=' ', flush=True)
+    print('Retrieving CodeGrade data ...')
 
-    with codegrade.login(
+    # Shared by all workers: at most `rate` CodeGrade calls per second, less when CodeGrade asks for it,
+    # and transient errors are retried with backoff
+    policy = RetryPolicy(limiter=TokenBucket(rate=rate))
+    session = cgclient.login(
         username=access['codegrade']['username'],
         password=access['codegrade']['password'],
         tenant=access['codegrade']['tenant'],
-        host=access['codegrade']['host']
-    ) as session:
-        
-        #pass
-    
-        if individual:
-            groups = get_users(session=session,
-                assignment_id=organization['assignment-id'],
-                git_ids=gitlab_ids,
-                course_id=organization['codegrade-id'])
-        else:
-            groups = get_nonempty_groups(
-                session=session,
-                assignment_id=organization['assignment-id'],
-                git_ids=gitlab_ids,
-                access=access
-            )
-
-        print('done')
-
-        print('Writing', out_file, '...', end=' ', flush=True)
-
-        with open(out_file, mode='w', newline='') as out:
-            writer = csv.writer(out)
-            writer.writerow(['name', 'git_ids', 'payload_url', 'secret', 'public_key'])
-            for group_data in groups:
-                webhook = group_data['webhook']
-                ids = group_data['git_ids']
-
-                writer.writerow([
-                    group_data['name'],
-                    ' '.join(group_data['git_ids']),
-                    '{}/api/v1/webhooks/{}'.format(session.base_url, webhook['id']),
-                    webhook['secret'],
-                    webhook['public_key'],
-                ])
-
-        print('done')
+        host=access['codegrade']['host'],
+        policy=policy,
+        pool_size=workers
+    )
+
+    if individual:
+        groups = get_users(session=session,
+            assignment_id=organization['assignment-id'],
+            git_ids=gitlab_ids,
+            course_id=organization['codegrade-id'],
+            workers=workers)
+    else:
+        groups = get_nonempty_groups(
+            session=session,
+            assignment_id=organization['assignment-id'],
+            git_ids=gitlab_ids,
+            access=access,
+            workers=workers
+        )
+
+
+    print('Writing', out_file, '...', end=' ', flush=True)
+
+    write_webhooks(out_file, [ roster_row(session, group_data) for group_data in groups ])
+
+    print('done')
+    policy.report()
+    if report:
+        policy.write_report(report)
 
 
 def main():
@@ -121,23 +137,29 @@ def main():
     with open("secrets.txt", "r") as secretfile:
         secrets = secretfile.read().splitlines()
         
-    init_roster(
-        access={
-            'codegrade': {
-                'host': "https://wur.codegra.de",
-                'tenant': "Wageningen University",
-                'username': secrets[0],
-                'password': secrets[1],
+    try:
+        init_roster(
+            access={
+                'codegrade': {
+                    'host': "https://wur.codegra.de",
+                    'tenant': "Wageningen University",
+                    'username': secrets[0],
+                    'password': secrets[1],
+                },
             },
-        },
-        organization={
-            'assignment-id': '281210',
-            'codegrade-id': 13231,
-        },
-        in_file='usernames.csv',
-        out_file='webhooks.csv',
-        individual=False
-    )
+            organization={
+                'assignment-id': '281210',
+                'codegrade-id': 13231,
+            },
+            in_file='usernames.csv',
+            out_file='webhooks.csv',
+            individual=False,
+            workers=8,                                     # <-------------------------------------- concurrent requests
+            rate=10,                                       # <-------------------------------------- max requests per second
+            report=None                                    # <-------------------------------------- e.g. 'webhooks_report.json' for call timings
+        )
+    except (cgclient.CodeGradeError, roster.RosterError) as error:
+        sys.exit(str(error))
 
 
 if __name__ == '__main__':
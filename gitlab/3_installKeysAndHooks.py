@@ -1,17 +1,31 @@
-import csv
+import argparse
+import concurrent.futures
 import gitlab
-import codegrade
+import itertools
+import json
+import os
 import re
 import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.forks import await_fork, await_forks
+from common.instrument import Progress
+from common.retry import RetryPolicy, mount_retries
+from common.roster import GITLAB_USERNAMES, GITLAB_WEBHOOKS, RosterError, read_id_map, read_roster
+from common.syncstate import SyncState, fingerprint
+from common.usercache import UserCache
+
+# Groups that are read, forked and configured together: enough to keep the workers and GitLab's
+# fork queue busy, few enough that the first groups are done early and memory use stays flat
+BATCH_SIZE = 200
 
 def load_user_data(filename='webhooks.csv'):
-    with open(filename) as user_data:
-        reader = csv.DictReader(user_data)
-        try:
-            data = [ line for line in reader]
-        except csv.Error as e:
-            sys.exit('file {}, line {}: {}'.format(filename, reader.line_num, e))
-    return data
+    # The groups of the roster one at a time, so a large roster is never held in memory as a whole
+    try:
+        yield from read_roster(filename, GITLAB_WEBHOOKS)
+    except RosterError as e:
+        sys.exit(e)
 
 def sanitise_reponame(reponame):
     # Replace all special characters with underscores
@@ -22,150 +36,498 @@ def sanitise_reponame(reponame):
     result = re.sub(r'(^_|_$)', '', result, flags=re.ASCII)
     return result
 
-def sync(access, organization, roster, assignment, student_readable=False):
-    print('Connecting to the group',organization['gitlab-group'],'...', end=' ', flush=True)
+def build_project_index(g, staff_group, student_group, assignment):
+    # List the staff and student groups once per run, so that every per-group check
+    # is a dict lookup instead of a full paginated listing. Keyed by project path.
+    index = {
+        'staff': { proj.path: proj for proj in staff_group.projects.list(all=True) },
+        'students': { proj.path: proj for proj in student_group.projects.list(all=True) },
+        'template': None,
+    }
+    # The template normally lives in the staff group itself, only walk the subtree if not
+    template = index['staff'].get(assignment["gitlab-name"])
+    if template is None:
+        for proj in staff_group.projects.list(include_subgroups=True, all=True):
+            if proj.path == assignment["gitlab-name"]:
+                template = proj
+                break
+    if template is not None:
+        index['template'] = g.projects.get(template.id, lazy=False)
+    return index
+
+def read_repo_state(ctx, reponame):
+    # Current state of one repository, with one (paginated) read per kind of setting.
+    # Repositories that do not exist yet get an empty state.
+    proj = ctx['index']['staff'].get(reponame)
+    if proj is None:
+        return {'repo': None, 'protected': [], 'members': set(), 'keys': [], 'hooks': [], 'shared': False}
+    repo = ctx['g'].projects.get(proj.id, lazy=True)
+    return {
+        'repo': repo,
+        'protected': [ branch.name for branch in repo.protectedbranches.list(get_all=True) ],
+        'members': { member.username for member in repo.members_all.list(get_all=True) },
+        'keys': repo.keys.list(get_all=True),
+        'hooks': repo.hooks.list(get_all=True),
+        'shared': reponame in ctx['index']['students'],
+    }
+
+def plan_group(state, group, student_readable):
+    # Changes needed to get from the current state to the desired state, as (action, argument) pairs
+    actions = []
+    if state['repo'] is None:
+        actions.append(('fork', None))
+    for branch in state['protected']:
+        actions.append(('unprotect', branch))
+    for member in group["git_ids"].split():
+        if member not in state['members']:
+            actions.append(('add_member', member))
+    if student_readable and not state['shared']:
+        actions.append(('share', None))
+    if not student_readable and state['shared']:
+        actions.append(('unshare', None))
+    actions.extend(plan_key(state['keys'], group['public_key']))
+    actions.extend(plan_hooks(state['hooks'], group['payload_url'], state.get('hook_id')))
+    return actions
+
+def same_key(a, b):
+    # Compare deploy keys by type and key material, GitLab may drop or change the comment
+    return a.split()[:2] == b.split()[:2]
+
+def plan_key(keys, public_key):
+    # Keep one codegrade-key with the right key, delete the other ones. The key material of
+    # a deploy key cannot be edited, so a wrong key is replaced.
+    ours = [ key for key in keys if key.title == 'codegrade-key' ]
+    keep = next(( key for key in ours if same_key(key.key, public_key) ), None)
+    actions = [ ('delete_key', key) for key in ours if key is not keep ]
+    if keep is None:
+        actions.append(('add_key', public_key))
+    return actions
+
+def is_codegrade_hook(hook):
+    return '/api/v1/webhooks/' in hook.url
+
+def plan_hooks(hooks, payload_url, hook_id=None):
+    # Keep one CodeGrade webhook pointing at payload_url and delete stale duplicates; webhooks of
+    # other services are left alone. GitLab does not return the secret token of a webhook, but the
+    # secret belongs to the CodeGrade webhook in payload_url, so a webhook with that url and push
+    # events is up to date. Otherwise it is updated in place, as is a stale one that can be reused.
+    # The webhook recorded by the last sync (hook_id) is the one kept when there are several.
+    ours = [ hook for hook in hooks if is_codegrade_hook(hook) ]
+    matching = [ hook for hook in ours if hook.url == payload_url ]
+    keep = next(( hook for hook in matching if hook.id == hook_id ), matching[0] if matching else None)
+    up_to_date = keep is not None and getattr(keep, 'push_events', True)
+    stale = [ hook for hook in ours if hook is not keep ]
+    actions = []
+    if keep is None and stale:
+        keep = stale.pop(0)
+    if keep is None:
+        actions.append(('add_hook', payload_url))
+    elif not up_to_date:
+        actions.append(('update_hook', keep))
+    actions.extend(('delete_hook', hook) for hook in stale)
+    return actions
+
+def describe(action):
+    kind, arg = action
+    return {
+        'fork': '+ repository (fork of the template)',
+        'unprotect': '- protection of branch {}',
+        'add_member': '+ collaborator {}',
+        'share': '+ read access for students',
+        'unshare': '- read access for students',
+        'add_key': '+ deploy key codegrade-key',
+        'delete_key': '- deploy key {} (wrong key)',
+        'delete_hook': '- webhook {}',
+        'update_hook': '~ webhook {} (url and token)',
+        'add_hook': '+ webhook {}',
+    }[kind].format(describe_arg(arg))
+
+def describe_arg(arg):
+    # Hooks and keys are GitLab objects, the other arguments plain values (a str has a title() method too)
+    if isinstance(arg, str) or arg is None:
+        return arg
+    if hasattr(arg, 'url'):
+        return arg.url
+    if hasattr(arg, 'title'):
+        return arg.title
+    return arg
+
+def apply_action(ctx, reponame, repo, action, group):
+    g = ctx['g']
+    index = ctx['index']
+    kind, arg = action
+    if kind == 'fork':
+        template = index['template']
+        if template is None:
+            raise LookupError("Did not find the template to clone, please check the spelling of assignment.gitlab-name!")
+        fork = template.forks.create({'name': reponame, 'path': reponame, 'namespace': ctx['staff_group'].full_path})
+        index['staff'][reponame] = fork
+        return fork
+    if kind == 'unprotect':
+        repo.protectedbranches.delete(arg)
+    elif kind == 'add_member':
+        # Find the user by id
+        member_id = ctx['users'].lookup(g, arg)
+        repo.members.create({'user_id': member_id, 'access_level': gitlab.const.AccessLevel.DEVELOPER})
+    elif kind == 'share':
+        repo.share(ctx['student_group'].id, gitlab.const.AccessLevel.REPORTER)
+        index['students'][reponame] = repo
+    elif kind == 'unshare':
+        repo.unshare(ctx['student_group'].id)
+        del index['students'][reponame]
+    elif kind == 'add_key':
+        return repo.keys.create({'title': 'codegrade-key', 'key': arg})
+    elif kind == 'delete_key':
+        repo.keys.delete(arg.id)
+    elif kind == 'delete_hook':
+        arg.delete()
+    elif kind == 'update_hook':
+        arg.url = group['payload_url']
+        arg.token = group['secret']
+        arg.push_events = True
+        arg.save()
+        return arg
+    elif kind == 'add_hook':
+        return repo.hooks.create({'url': arg, 'token': group['secret'], 'push_events': 1})
+    return None
+
+def repo_name(ctx, group):
+    return sanitise_reponame(ctx['assignment']['gitlab-name'] + '-' + group['name'])
+
+def group_key(ctx, group):
+    # Key of a group in the sync state file
+    return ctx['staff_group'].full_path + '/' + repo_name(ctx, group)
+
+def group_inputs(ctx, group):
+    # Everything the desired state of a group depends on
+    return fingerprint(group, ctx['student_readable'], ctx['assignment']['gitlab-name'])
+
+def is_converged(ctx, group):
+    # Unchanged since the last successful sync, and the repository was not replaced since
+    proj = ctx['index']['staff'].get(repo_name(ctx, group))
+    return proj is not None and ctx['synced'].is_converged(group_key(ctx, group), group_inputs(ctx, group), proj.id)
+
+def record_sync(ctx, group, reponame, state, created):
+    # Remember the inputs and the resulting ids of a group that was synced without errors
+    key = created.get('add_key') or next(( key for key in state['keys']
+                                           if key.title == 'codegrade-key' and same_key(key.key, group['public_key']) ), None)
+    # Without a hook change, the hook is the one recorded by the previous sync (see plan_hooks)
+    hook = created.get('add_hook') or created.get('update_hook') or next((
+        hook for hook in state['hooks'] if hook.id == state.get('hook_id') ), None)
+    ctx['synced'].record(group_key(ctx, group), group_inputs(ctx, group),
+        repo_id=ctx['index']['staff'][reponame].id,
+        key_id=key.id if key is not None else None,
+        hook_id=hook.id if hook is not None else None)
+
+def plan_sync_group(ctx, group):
+    # Phase 1: read the state of the group's repository and work out what has to change.
+    # Runs in a worker thread; errors are returned instead of raised.
+    reponame = repo_name(ctx, group)
+    try:
+        state = read_repo_state(ctx, reponame)
+        # The webhook that the last sync with the same roster row created or checked, if any
+        recorded = ctx['synced'].recorded(group_key(ctx, group), group_inputs(ctx, group)) or {}
+        state['hook_id'] = recorded.get('hook_id')
+        return reponame, state, plan_group(state, group, ctx['student_readable']), None
+    except Exception as exception:
+        return reponame, None, None, exception
+
+def sync_group(ctx, group, planned):
+    # Phase 2: apply the planned changes of a single group. Runs in a worker thread, so output is
+    # collected in a log instead of printed directly, and errors never propagate to the other groups.
+    log = []
+    def say(*args):
+        log.append(' '.join(str(arg) for arg in args))
+
+    reponame, state, actions, exception = planned
+    no_errors = 0
+    say('Processing', reponame,'...')
+    try:
+        if exception is not None:
+            raise exception
+        if actions and actions[0][0] == 'fork':
+            say(">", "Repository", reponame, "does not exist yet, cloning...")
+            start = time.monotonic()
+            fork = apply_action(ctx, reponame, None, actions[0], group)
+            status, seconds = await_new_fork(ctx, fork, start)
+            say(">", "Repository", fork.path_with_namespace, "created successfully in {:.0f}s".format(seconds))
+            # The fork comes with the settings of the template, e.g. its protected branches
+            state = read_repo_state(ctx, reponame)
+            actions = plan_group(state, group, ctx['student_readable'])
+        if not actions:
+            say('>', 'Repository is up to date')
+        created = {}
+        for action in actions:
+            say('>', describe(action))
+            try:
+                created[action[0]] = apply_action(ctx, reponame, state['repo'], action, group)
+            except:
+                if action[0] != 'add_member':
+                    raise
+                e = sys.exc_info()[0]
+                say('>','Error:', e)
+                # The cached id may be stale, look the user up again next time
+                ctx['users'].invalidate([action[1]])
+                no_errors += 1
+        if no_errors == 0:
+            record_sync(ctx, group, reponame, state, created)
+        else:
+            ctx['synced'].forget(group_key(ctx, group))
+        return 1, no_errors, log
+    except Exception as exception:
+        e = sys.exc_info()[0]
+        say('>','Error:', e)
+        say("Exception message: {}".format(exception))
+        ctx['synced'].forget(group_key(ctx, group))
+        return 0, no_errors + 1, log
+
+def await_new_fork(ctx, fork, start):
+    # Wait until GitLab has finished copying a single fork, configuring it earlier fails or hits an empty repository
+    # One project read per polling round; the group-wide listing is for the batch of fork_missing only
+    status, seconds = await_fork(ctx['g'], fork.id, start)
+    if status != 'finished':
+        raise RuntimeError('Fork {} {} after {:.0f}s'.format(fork.path_with_namespace, status, seconds))
+    return status, seconds
+
+def fork_missing(pool, jobs, plans):
+    # Create the repositories of all groups that have none yet in one go, wait for GitLab to finish
+    # copying them together, and plan those groups again. The other plans are returned as they are;
+    # groups whose fork failed or did not finish in time get an error instead of a plan.
+    missing = [ i for i, (reponame, state, actions, exception) in enumerate(plans) if actions and actions[0][0] == 'fork' ]
+    if not missing:
+        return plans
+    plans = list(plans)
+
+    def fork(i):
+        ctx, group = jobs[i]
+        start = time.monotonic()
+        try:
+            return apply_action(ctx, plans[i][0], None, plans[i][2][0], group), start, None
+        except Exception as exception:
+            return None, start, exception
+
+    print('Forking', len(missing), 'repositories ...', end=' ', flush=True)
+    forks = dict(zip(missing, pool.map(fork, missing)))
+    print('done')
+
+    # Forks are awaited per staff group, with one listing of the group per polling round
+    started = {}
+    for i, (proj, start, exception) in forks.items():
+        if exception is None:
+            ctx = jobs[i][0]
+            started.setdefault(ctx['staff_group'].id, (ctx, {}))[1][proj.id] = start
+    print('Waiting for GitLab to finish', sum(len(ids) for ctx, ids in started.values()), 'fork(s) ...', end=' ', flush=True)
+    results = {}
+    for ctx, ids in started.values():
+        results.update(await_forks(ctx['g'], ctx['staff_group'], ids))
+    print('done')
+
+    ready = []
+    for i, (proj, start, exception) in forks.items():
+        reponame = plans[i][0]
+        if exception is None:
+            status, seconds = results[proj.id]
+            if status == 'finished':
+                print('>', reponame, 'forked in {:.0f}s'.format(seconds))
+                ready.append(i)
+                continue
+            exception = RuntimeError('Fork {} after {:.0f}s, not configured'.format(status, seconds))
+        plans[i] = (reponame, None, None, exception)
+    # The forks come with the settings of the template, e.g. its protected branches
+    for i, planned in zip(ready, pool.map(lambda i: plan_sync_group(*jobs[i]), ready)):
+        plans[i] = planned
+    return plans
+
+def connect_gitlab(access, workers=8, user_cache='gitlab_users.json', state_file='sync_state.json', metrics=None):
+    # Log into GitLab. The result is shared by all assignments of a run: one connection pool,
+    # one retry policy, one user-id cache, one sync state and the groups resolved so far.
     g = gitlab.Gitlab(access["gitlab"]["host"], private_token=access["gitlab"]["token"])
+    # Retry transient errors of every GitLab call, and let every worker keep its own connection open
+    policy = RetryPolicy(metrics=metrics)
+    mount_retries(g.session, policy, pool_size=workers)
     g.auth()
-    me = g.users.get(g.user.id)
-    #groups = g.groups.list(search=organization["gitlab-group"], order_by="similarity", get_all=True)
-    root_group = g.groups.get(organization["gitlab-group"]) #groups[0]
+    return {
+        'g': g,
+        'policy': policy,
+        'users': UserCache(access["gitlab"]["host"], user_cache),
+        'synced': SyncState(state_file),
+        'groups': {},
+    }
+
+def get_group(base, path):
+    # Each group is looked up once per run
+    if path not in base['groups']:
+        base['groups'][path] = base['g'].groups.get(path)
+    return base['groups'][path]
+
+def assignment_context(base, organization, assignment, student_readable=False):
+    # Resolve the groups of the assignment and index their projects.
+    # Returns the context that the per-group functions work with.
+    print('Connecting to the group',organization['gitlab-group'],'...', end=' ', flush=True)
+    root_group = get_group(base, organization["gitlab-group"])
     print("Using root group: " + root_group.web_url)
-    student_group = None
-    staff_group = None
-    #for subgroup in root_group.descendant_groups.list(all=True):
-    #    if subgroup.full_path == organization["gitlab-group"] + '/' + organization["subgroup-staff"] + '/' + assignment["subgroup"]:
-    #        staff_group = g.groups.get(subgroup.id)
-    staff_group = g.groups.get(organization["gitlab-group"] + '/' + organization["subgroup-staff"] + '/' + assignment["subgroup"])
+    staff_group = get_group(base, organization["gitlab-group"] + '/' + organization["subgroup-staff"] + '/' + assignment["subgroup"])
     print("Using staff group: " + staff_group.web_url)
-    #    if subgroup.full_path == organization["gitlab-group"] + '/' + organization["subgroup-students"]:
-    #        root_student_group = g.groups.get(subgroup.id)
-    root_student_group = g.groups.get(organization["gitlab-group"] + '/' + organization["subgroup-students"])
+    root_student_group = get_group(base, organization["gitlab-group"] + '/' + organization["subgroup-students"])
     print("Using root student group: " + root_student_group.web_url)
-    #    if subgroup.full_path == organization["gitlab-group"] + '/' + organization["subgroup-students"] + '/' + assignment["subgroup"]:
-    #        student_group = g.groups.get(subgroup.id)
-    student_group = g.groups.get(organization["gitlab-group"] + '/' + organization["subgroup-students"] + '/' + assignment["subgroup"])
+    student_group = get_group(base, organization["gitlab-group"] + '/' + organization["subgroup-students"] + '/' + assignment["subgroup"])
     print("Using student group: " + student_group.web_url)
     if student_group is None:
         raise LookupError("Could not find the student group, check organization dict entries and assignment.subgroup spelling!")
     if staff_group is None:
         raise LookupError("Could not find the staff group, check organization dict entries and assignment.subgroup spelling!")
-    #g.groups.get(root_group.subgroups.list(search=organization["subgroup-students"] + '/' + assignment["subgroup"], order_by="similarity")[0].id, lazy=False) 
-    
     print('done')
     #print('Inviting students to the student group...')
-    #invite_users(g, root_student_group)
-    print('Loading the roster ...', end=' ', flush=True)
-    group_info = load_user_data(roster)
+    #invite_users(base['g'], root_student_group)
+    print('Indexing projects ...', end=' ', flush=True)
+    index = build_project_index(base['g'], staff_group, student_group, assignment)
     print('done')
+    return dict(base,
+        index=index,
+        staff_group=staff_group,
+        student_group=student_group,
+        assignment=assignment,
+        student_readable=student_readable,
+    )
+
+def connect(access, organization, assignment, student_readable=False, workers=8, user_cache='gitlab_users.json',
+            state_file='sync_state.json', metrics=None):
+    # Log in and prepare a single assignment. `metrics` lets the GitLab calls be timed together with other calls of the run.
+    base = connect_gitlab(access, workers, user_cache, state_file, metrics)
+    return assignment_context(base, organization, assignment, student_readable)
+
+def load_assignments(filename):
+    # JSON file with a list of assignments, each like the `assignment` dict in main() plus the
+    # 'roster' (webhooks CSV) to use and optionally its own 'student_readable'
+    with open(filename) as config:
+        assignments = json.load(config)
+    if isinstance(assignments, dict):
+        assignments = assignments['assignments']
+    for assignment in assignments:
+        missing = [ key for key in ('gitlab-name', 'subgroup') if key not in assignment ]
+        if missing:
+            sys.exit('file {}: assignment {} misses {}'.format(filename, assignment, ', '.join(missing)))
+    return assignments
+
+def provision_group(ctx, group, full_verify=False):
+    # Plan and apply a single group in one go, for callers that stream groups in one by one
+    if not full_verify and is_converged(ctx, group):
+        return 1, 0, ['Processing ' + repo_name(ctx, group) + ' ...', '> Unchanged since the last run, skipped']
+    return sync_group(ctx, group, plan_sync_group(ctx, group))
+
+def save_state(ctx):
+    ctx['users'].save()
+    ctx['synced'].save()
+
+def roster_jobs(base, organization, roster, assignments, student_readable, full_verify):
+    # (ctx, group) of every group of every assignment that needs work, read lazily from the rosters.
+    # Groups that converged in an earlier run and whose roster row did not change need no reads at all.
+    for assignment in assignments:
+        ctx = assignment_context(base, organization, assignment, assignment.get('student_readable', student_readable))
+        skipped = 0
+        for group in load_user_data(assignment.get('roster', roster)):
+            if not full_verify and is_converged(ctx, group):
+                skipped += 1
+            else:
+                yield ctx, group
+        if skipped:
+            print('Skipping', skipped, 'group(s) that did not change since the last run (use --full-verify to check them anyway)')
+
+def batches(iterable, size):
+    # Lists of up to `size` items, taken from `iterable` only when the previous list is done
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def sync(access, organization, roster, assignment, student_readable=False, workers=8, user_cache='gitlab_users.json', plan=False,
+         state_file='sync_state.json', full_verify=False, report=None, batch_size=BATCH_SIZE):
+    # `assignment` is one assignment dict, or a list of them (see load_assignments) that are all
+    # provisioned in this run through the same worker pool. The rosters are read and provisioned
+    # `batch_size` groups at a time, so a large roster is never held in memory as a whole and the
+    # first groups are done before the last ones are read.
+    assignments = assignment if isinstance(assignment, list) else [assignment]
+    base = connect_gitlab(access, workers, user_cache, state_file)
     no_groups = 0
     no_errors = 0
-    for group in group_info:
-        reponame = assignment['gitlab-name'] + '-' + group['name']
-        reponame = sanitise_reponame(reponame)
-        group_members = group["git_ids"].split()
-        print('Processing', reponame,'...')
-        try:
-            if reponame not in [ repo.path for repo in staff_group.projects.list(all=True) ]:
-                print(">", "Repository", reponame, "does not exist yet, cloning...")
-                template = None
-                for repo in staff_group.projects.list(include_subgroups=True, all=True):
-                    if repo.path == assignment["gitlab-name"]:
-                        template = g.projects.get(repo.id, lazy=False)
-                        break
-                print(">", "Using template", template.path_with_namespace)
-                if template is None:
-                    raise LookupError("Did not find the template to clone, please check the spelling of assignment.gitlab-name!")
-                fork = template.forks.create({'name': reponame, 'path': reponame, 'namespace': staff_group.full_path})
-                print(">", "Repository", fork.path_with_namespace, "created successfully")
-            repo = None
-            for proj in staff_group.projects.list(all=True):
-                if proj.path == reponame:
-                    repo = g.projects.get(proj.id, lazy=False)
-                    break
-            if repo is None:
-                raise LookupError("Did not find the template repository, check whether forking actually worked")
-            while len(repo.protectedbranches.list()) > 0:
-                def_branch = repo.protectedbranches.list()[0].name
-                print(">", "Removing protection from the", def_branch, "branch of repository", repo.path_with_namespace)
-                p_branch = repo.protectedbranches.get(def_branch)
-                p_branch.delete()
-            
-            for member in group_members:
-                print(">", "Processing collaborators:", member)
-                if member in [ members.username for members in repo.members_all.list(get_all=True) ]:
-                    print('>', 'Collaborator', member, 'already present')
-                else:
-                    print('>', 'Adding collaborator', member)
-                    try:
-                        # Find the user by id
-                        member_id = g.users.list(username=member)[0].id
-                        repo.members.create({'user_id': member_id, 'access_level': gitlab.const.AccessLevel.DEVELOPER})
-                        print('>', 'Collaborator', member, 'added to the repository')
-                    except:
-                        e = sys.exc_info()[0]
-                        print('>','Error:', e)
-                        no_errors += 1
-            #if repo.path in [ projects.path for projects in staff_group.projects.list(all=True) ]:
-            #    print(">", "Staff already owns", reponame)
-            #else:
-            #    print(">", "Adding staff permission to maintain", reponame)
-            #    repo.share(staff_group.id, gitlab.MAINTAINER_ACCESS)
-            #    print(">", "Staff can now maintain", reponame)
-            if student_readable:
-                print(">","Checking if students can read the repo")
-                if repo.path in [ projects.path for projects in student_group.projects.list(all=True) ]:
-                    print(">", "Students can already see", reponame)
-                else:
-                    print(">", "Adding students permission to read", reponame)
-                    repo.share(student_group.id, gitlab.const.AccessLevel.REPORTER)
-                    print(">", "Students can now read", reponame)
-            else:
-                if repo.path in [ projects.path for projects in student_group.projects.list(all=True) ]:
-                    print("> Students can read the repo, removing their access")
-                    repo.unshare(student_group.id)
-            
-            if 'codegrade-key' not in [ key.title for key in repo.keys.list() ]:
-                print('>','Adding deploy key for', group['name'])
-                repo.keys.create({'title': 'codegrade-key', 'key': group['public_key']})
-            else:
-                print('>','Deploy key found for', group['name'])
-            hooks = repo.hooks.list(get_all=True)
-            if len(hooks) > 1:
-                for hook in hooks:
-                    print('>', "Multiple webhooks found, webhook deleted fopr group", group['name'])
-                    hook.delete()
-            if group['payload_url'] not in [ hook.url for hook in repo.hooks.list() ]:
-                print('>','Adding webhook for', group['name'])
-                repo.hooks.create({'url': group['payload_url'], 'token': group['secret'], 'push_events': 1})
-            else:
-                print('>','Webhook found for', group['name'])
-            no_groups += 1
-        except Exception as exception:
-            e = sys.exc_info()[0]
-            print('>','Error:', e)
-            print("Exception message: {}".format(exception))
-            no_errors += 1
+    no_changes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for jobs in batches(roster_jobs(base, organization, roster, assignments, student_readable, full_verify), batch_size):
+            # Read the state of the repositories first, and work out what has to change
+            print('Reading', len(jobs), 'repositories with', workers, 'worker(s) ...')
+            with Progress(len(jobs), 'Reading') as progress:
+                plans = list(pool.map(progress.track(lambda job: plan_sync_group(*job)), jobs))
+            if plan:
+                changes, errors = print_plan(plans)
+                no_groups += len(plans)
+                no_changes += changes
+                no_errors += errors
+                continue
+
+            # Create the missing repositories up front, and configure them only once GitLab has copied them
+            plans = fork_missing(pool, jobs, plans)
+
+            # Then apply only the changes, groups concurrently but their logs are printed in roster order
+            with Progress(len(jobs), 'Applying') as progress:
+                results = pool.map(progress.track(lambda args: sync_group(*args[0], args[1])), zip(jobs, plans))
+                for processed, errors, log in results:
+                    progress.write('\n'.join(log))
+                    no_groups += processed
+                    no_errors += errors
+            # A run that is stopped halfway keeps what the finished batches did
+            save_state(base)
+    if plan:
+        print('\nPlan:', no_changes, 'of', no_groups, 'group(s) need changes;', no_errors, 'error(s). Nothing was changed.')
+        return
+    save_state(base)
     print('\nProcessed',no_groups,'group(s);',no_errors,'error(s).')
+    base['policy'].report()
+    if report:
+        base['policy'].write_report(report)
+
+def print_plan(plans):
+    # Show the difference between the current and the desired state, without changing anything.
+    # Returns the number of groups that need changes and that could not be read.
+    no_changes = 0
+    no_errors = 0
+    for reponame, state, actions, exception in plans:
+        if exception is not None:
+            print(reponame + ':', 'could not be read:', exception)
+            no_errors += 1
+        elif actions:
+            print(reponame + ':')
+            for action in actions:
+                print('   ', describe(action))
+            no_changes += 1
+    return no_changes, no_errors
 
 def read_gitlab_ids(in_file):
-    gitlab_ids = {}
-    with open(in_file, 'r') as f:
-        for row in csv.reader(f, delimiter=','):
-            gitlab_ids[row[1]] = row[3]
-    return gitlab_ids
+    return read_id_map(in_file, GITLAB_USERNAMES, 'cg_user', 'gl_user')
 
-def invite_users(g, student_group):
+def invite_users(g, student_group, user_cache='gitlab_users.json'):
     gl_users = read_gitlab_ids("usernames.csv")
     gl_users = list(gl_users.values())
-    gl_users = gl_users[1:]
+    users = UserCache(g.url, user_cache)
 
+    present = [ members.username for members in student_group.members_all.list(get_all=True) ]
     for member in gl_users:
-        if member != "" and member not in [ members.username for members in student_group.members_all.list(get_all=True) ]:
+        if member != "" and member not in present:
             print("inviting", member, "to the student group")
-            member_id = g.users.list(username=member)[0].id
+            member_id = users.lookup(g, member)
             student_group.members.create({'user_id': member_id, 'access_level': gitlab.const.AccessLevel.REPORTER})
+    users.save()
 
 def main():
+    parser = argparse.ArgumentParser(description='Create and configure the GitLab repositories of an assignment')
+    parser.add_argument('--plan', action='store_true', help='only show what would change, do not change anything')
+    parser.add_argument('--workers', type=int, default=8, help='number of groups to process at the same time')
+    parser.add_argument('--full-verify', action='store_true', help='also check groups that did not change since the last run')
+    parser.add_argument('--assignments', metavar='FILE', help='JSON file with the assignments to provision, instead of the one below')
+    parser.add_argument('--report', metavar='FILE', help='write a JSON report with the timings of all GitLab calls')
+    args = parser.parse_args()
+
     with open("secrets.txt", "r") as secretfile:
         secrets = secretfile.read().splitlines()
     sync(
@@ -188,12 +550,16 @@ def main():
             'subgroup-students': 'students'
         },
         roster='webhooks.csv',
-        assignment={
+        assignment=load_assignments(args.assignments) if args.assignments else {
             'codegrade-id': 281210,
             'gitlab-name': 'exercise-02-starter',
             'subgroup': 'exercise-02'
         },
-        student_readable=True
+        student_readable=True,
+        workers=args.workers,
+        plan=args.plan,
+        full_verify=args.full_verify,
+        report=args.report
     )
 
     
@@ -0,0 +1,161 @@
+# Roll out an assignment in one go: roster -> CodeGrade webhooks -> GitLab repositories.
+# This does the same as running 1_get_usernames.py (optional), 2_get_webhooks.py and
+# 3_installKeysAndHooks.py one after the other, but in one process: CodeGrade and GitLab
+# are logged into once, and every group is provisioned as soon as its webhook is fetched
+# instead of after the whole webhooks.csv is ready. webhooks.csv is still written for reference.
+
+import argparse
+import concurrent.futures
+import importlib.util
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import cgclient
+from common.instrument import Progress
+from common.ratelimit import TokenBucket
+from common.retry import RetryPolicy
+from common.roster import RosterError
+
+def load_script(filename):
+    # The numbered scripts cannot be imported by name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0].lstrip('0123456789_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+usernames = load_script('1_get_usernames.py')
+webhooks = load_script('2_get_webhooks.py')
+provisioning = load_script('3_installKeysAndHooks.py')
+
+def rollout(access, organization, assignment, roster='usernames.csv', out_file='webhooks.csv', individual=False,
+            student_readable=False, workers=8, rate=10, full_verify=False, report=None):
+    print('Reading roster ...', end=' ', flush=True)
+    git_ids = webhooks.read_gitlab_ids(roster)
+    print('done')
+
+    print('Connecting to CodeGrade ...', end=' ', flush=True)
+    policy = RetryPolicy(limiter=TokenBucket(rate=rate))
+    session = cgclient.login(
+        username=access['codegrade']['username'],
+        password=access['codegrade']['password'],
+        tenant=access['codegrade']['tenant'],
+        host=access['codegrade']['host'],
+        policy=policy,
+        pool_size=workers
+    )
+    if individual:
+        groups = webhooks.find_users(session, git_ids, organization['codegrade-id'])
+    else:
+        groups = webhooks.find_nonempty_groups(session, assignment['codegrade-id'], git_ids)
+    print('done')
+
+    # CodeGrade and GitLab calls are timed together, their labels tell them apart
+    ctx = provisioning.connect(access, organization, assignment, student_readable, workers, metrics=policy.metrics)
+
+    print('Rolling out', len(groups), 'group(s) with', workers, 'worker(s)')
+    no_groups = 0
+    no_errors = 0
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as fetch_pool, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=workers) as provision_pool, \
+         Progress(len(groups), 'Rolling out') as progress:
+        def fetch(group):
+            # Stage 1: fetch the webhook, then hand the group straight to stage 2
+            webhook = webhooks.get_webhook(session, assignment['codegrade-id'], group['author'])
+            row = webhooks.roster_row(session, dict(group, webhook=webhook))
+            return row, provision_pool.submit(provisioning.provision_group, ctx, row, full_verify)
+
+        # Logs are printed in roster order, while later groups are already being processed
+        for group, future in [ (group, fetch_pool.submit(fetch, group)) for group in groups ]:
+            try:
+                row, provisioned = future.result()
+            except Exception as exception:
+                progress.write('Processing {} ...\n> Error: could not get the webhook: {}'.format(group['name'], exception))
+                progress.advance()
+                no_errors += 1
+                continue
+            rows.append(row)
+            processed, errors, log = provisioned.result()
+            progress.write('\n'.join(log))
+            progress.advance()
+            no_groups += processed
+            no_errors += errors
+
+    print('Writing', out_file, '...', end=' ', flush=True)
+    webhooks.write_webhooks(out_file, rows)
+    print('done')
+    provisioning.save_state(ctx)
+    print('\nProcessed',no_groups,'group(s);',no_errors,'error(s).')
+    policy.metrics.report()
+    print('CodeGrade:', end=' ')
+    policy.report(timings=False)
+    print('GitLab:', end=' ')
+    ctx['policy'].report(timings=False)
+    if report:
+        policy.metrics.write(report, retried=dict(policy.retried + ctx['policy'].retried),
+                             retry_waited=round(policy.waited + ctx['policy'].waited, 3))
+        print('Run report written to', report)
+
+def main():
+    parser = argparse.ArgumentParser(description='Roll out an assignment: roster, webhooks and repositories in one run')
+    parser.add_argument('--usernames', action='store_true', help='create usernames.csv with 1_get_usernames.py first')
+    parser.add_argument('--workers', type=int, default=8, help='number of groups to process at the same time')
+    parser.add_argument('--full-verify', action='store_true', help='also check groups that did not change since the last run')
+    parser.add_argument('--report', metavar='FILE', help='write a JSON report with the timings of all CodeGrade and GitLab calls')
+    args = parser.parse_args()
+
+    with open("secrets.txt", "r") as secretfile:
+        secrets = secretfile.read().splitlines()
+    access = {
+        'codegrade': {
+            'host': "https://wur.codegra.de",
+            'tenant': "Wageningen University",
+            'username': secrets[0],
+            'password': secrets[1],
+        },
+        'gitlab': {
+            'host': "https://git.wur.nl",
+            'token': secrets[2]
+        }
+    }
+    organization = {
+        'codegrade-id': 13231,
+        'gitlab-group': 'geoscripting-2025',
+        'subgroup-staff': 'staff',
+        'subgroup-students': 'students'
+    }
+    if args.usernames:
+        usernames.init_roster(
+            secrets_file = "secrets.txt",
+            codegrade_tenant = access['codegrade']['tenant'],
+            codegrade_host = access['codegrade']['host'],
+            codegrade_course = organization['codegrade-id'],
+            gitlab_host = access['gitlab']['host'],
+            output_file = "usernames.csv",
+            gitlab_group = organization['gitlab-group']
+        )
+    try:
+        rollout(
+            access=access,
+            organization=organization,
+            assignment={
+                'codegrade-id': 281210,
+                'gitlab-name': 'exercise-02-starter',
+                'subgroup': 'exercise-02'
+            },
+            roster='usernames.csv',
+            out_file='webhooks.csv',
+            individual=False,
+            student_readable=True,
+            workers=args.workers,
+            full_verify=args.full_verify,
+            report=args.report
+        )
+    except (cgclient.CodeGradeError, RosterError) as error:
+        sys.exit(str(error))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Shared fixtures: the fake GitLab and CodeGrade servers of bench/fake_server.py, run in a thread,
+# and a working directory of its own for the CSV files, user cache and sync state of a test.
+#
+#   python -m pytest tests
+
+import importlib.util
+import os
+import sys
+import threading
+
+import pytest
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.join(REPO, 'bench'))
+
+import fake_server
+
+
+def load_script(path):
+    # The numbered scripts cannot be imported by name
+    name = os.path.splitext(os.path.basename(path))[0].lstrip('0123456789_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Also keeps the CodeGrade token cache in $HOME out of the real one
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def server():
+    server = fake_server.make_server(groups=4, page_size=5, fork_time=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = 'http://{}:{}'.format(*server.server_address)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def course(server):
+    # The configuration dicts of the scripts for the course of the fake servers
+    access = {
+        'codegrade': {'host': server.url, 'tenant': fake_server.TENANT, 'username': 'test', 'password': 'test'},
+        'gitlab': {'host': server.url, 'token': 'test'},
+    }
+    organization = {
+        'assignment-id': fake_server.ASSIGNMENT_ID,
+        'codegrade-id': fake_server.COURSE_ID,
+        'gitlab-group': fake_server.ROOT_GROUP,
+        'subgroup-staff': 'staff',
+        'subgroup-students': 'students',
+    }
+    assignment = {
+        'codegrade-id': fake_server.ASSIGNMENT_ID,
+        'gitlab-name': fake_server.TEMPLATE,
+        'subgroup': fake_server.SUBGROUP,
+    }
+    return access, organization, assignment
+
+
+def write_usernames(filename, groups):
+    # The roster that 1_get_usernames.py would have written for the fake course
+    with open(filename, 'w', newline='') as out:
+        out.write('cg_name,cg_user,gl_name,gl_user\n')
+        for i in range(2 * groups):
+            out.write('Student {0},{1},Student {0},{2}\n'.format(i, fake_server.cg_username(i), fake_server.gl_username(i)))
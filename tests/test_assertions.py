@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+import shapely
+
+from autotest import assertions
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # 3 rows of 10 cells at a time, so the arrays below are compared in several chunks
+    monkeypatch.setattr(assertions, 'CHUNK_CELLS', 30)
+
+
+def test_array_diff_adds_up_the_chunks(small_chunks):
+    expected = np.zeros((10, 10))
+    actual = expected.copy()
+    actual[1, 2] = 0.5
+    actual[7, 3] = -2.0
+    actual[9, 9] = 1e-9
+    assert assertions.chunk_rows(expected.shape) == 3
+    diff = assertions.array_diff(expected, actual, atol=1e-6)
+    assert (diff.cells, diff.different, diff.largest, diff.first) == (100, 2, 2.0, (1, 2))
+    assert diff.summary()['mean'] == pytest.approx((0.5 + 2.0 + 1e-9) / 100)
+    assert diff.summary()['rmse'] == pytest.approx(np.sqrt((0.25 + 4.0) / 100))
+
+
+def test_nodata_must_be_missing_in_both(small_chunks):
+    expected = np.arange(100, dtype='float64').reshape(10, 10)
+    actual = expected.copy()
+    expected[0, 0] = actual[0, 0] = -9999
+    expected[4, 4] = np.nan
+    actual[4, 4] = np.nan
+    actual[8, 1] = -9999
+    diff = assertions.array_diff(expected, actual, expected_nodata=-9999, actual_nodata=-9999)
+    assert (diff.different, diff.nodata, diff.first) == (1, 1, (8, 1))
+    with pytest.raises(AssertionError, match=r'1 of 100 values \(1.00%\) differ .* 1 of them no data in only one of the two, first at row 8, column 1'):
+        assertions.assert_arrays_close(expected, actual, nodata=-9999)
+
+
+def test_max_fraction(small_chunks):
+    expected = np.ones((10, 10))
+    actual = expected.copy()
+    actual[0, :3] = 2
+    with pytest.raises(AssertionError, match='The result: 3 of 100 values'):
+        assertions.assert_arrays_close(expected, actual, max_fraction=0.02)
+    assert assertions.assert_arrays_close(expected, actual, max_fraction=0.03).different == 3
+
+
+def test_shape_must_match():
+    with pytest.raises(AssertionError, match=r'ndvi: expected an array of shape \(2, 3\), got \(3, 2\)'):
+        assertions.assert_arrays_close(np.zeros((2, 3)), np.zeros((3, 2)), label='ndvi')
+
+
+def test_geometries_in_any_order():
+    expected = [shapely.box(0, 0, 1, 1), shapely.Point(5, 5), shapely.box(10, 0, 12, 3)]
+    actual = [shapely.box(10, 0, 12, 3 + 1e-9), shapely.box(0, 0, 1, 1), shapely.Point(5, 5)]
+    distance = assertions.assert_geometries_close(expected, actual, tolerance=1e-6, ordered=False)
+    assert distance.max() <= 1e-6
+    with pytest.raises(AssertionError, match='3 of 3 geometries differ'):
+        assertions.assert_geometries_close(expected, actual, ordered=True)
+
+    actual[0] = shapely.box(10, 0, 12, 4)
+    with pytest.raises(AssertionError, match=r'fields: 1 of 3 geometries differ from the expected result \(largest distance 1'):
+        assertions.assert_geometries_close(expected, actual, ordered=False, label='fields')
+    with pytest.raises(AssertionError, match='expected 3 feature'):
+        assertions.assert_geometries_close(expected, actual[:2], ordered=False)
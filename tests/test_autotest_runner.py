@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+from conftest import REPO
+
+TEST_SCRIPT = '''
+import os, sys
+sys.path.insert(0, {repo!r})
+from autotest import runner
+args = runner.parse_args()
+import main
+
+def test_output():
+    main.plot()
+    assert os.path.exists(os.path.join(args.student_path, 'output', 'plot.png')), 'No plot'
+
+def test_value():
+    assert main.VALUE == 2, 'VALUE is not 2'
+
+runner.run_tests({{1: test_output, 2: test_value}}, args)
+'''
+
+STUDENT = '''
+import os
+print('student code imported')
+VALUE = 1
+
+def plot():
+    os.makedirs(os.path.join(os.path.dirname(__file__), 'output'), exist_ok=True)
+    with open(os.path.join(os.path.dirname(__file__), 'output', 'plot.png'), 'w') as f:
+        f.write(str(os.getpid()))
+'''
+
+
+def run_cell(tmp_path, test):
+    return subprocess.run([sys.executable, str(tmp_path / 'test_exc.py'), '--student_path', str(tmp_path / 'student'),
+                           '--results', str(tmp_path / 'results.json'), '--test', str(test)],
+                          capture_output=True, text=True)
+
+
+def test_later_cells_use_the_results_of_the_first(tmp_path):
+    (tmp_path / 'student').mkdir()
+    (tmp_path / 'student' / 'main.py').write_text(STUDENT)
+    (tmp_path / 'test_exc.py').write_text(TEST_SCRIPT.format(repo=REPO))
+
+    first = run_cell(tmp_path, 1)
+    assert first.returncode == 0
+    assert 'student code imported' in first.stdout
+
+    # The first run wrote output/plot.png into the student folder, the cache still holds
+    second = run_cell(tmp_path, 2)
+    assert second.returncode == 1
+    assert second.stdout == 'VALUE is not 2\n'
+
+    # A changed submission is run again
+    (tmp_path / 'student' / 'main.py').write_text(STUDENT.replace('VALUE = 1', 'VALUE = 2'))
+    third = run_cell(tmp_path, 2)
+    assert third.returncode == 0
+    assert 'student code imported' in third.stdout
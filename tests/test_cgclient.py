@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+import pytest
+
+import fake_server
+from common import cgclient
+from common.ratelimit import TokenBucket
+from common.retry import RetryPolicy
+
+
+def async_session(server, policy):
+    return cgclient.async_login('test', 'test', host=server.url, tenant=fake_server.TENANT, policy=policy)
+
+
+def test_async_session_retries(workdir, server):
+    server.failures['GET /api/v1/courses/:id/users/'] = 1
+    server.failures['POST /api/v1/assignments/:id/webhook_settings'] = 1
+    server.failures['PUT /api/v1/courses/:id/group_sets/'] = 1
+    policy = RetryPolicy(base_delay=0)
+
+    async def run():
+        async with await async_session(server, policy) as session:
+            users = await session.get('/api/v1/courses/{}/users/'.format(fake_server.COURSE_ID))
+            webhook = await session.post('/api/v1/assignments/{}/webhook_settings'.format(fake_server.ASSIGNMENT_ID),
+                                         params={'webhook_type': 'git', 'author_id': 10})
+            # Creates a group set, so it is not sent again after a server error
+            with pytest.raises(cgclient.CodeGradeError):
+                await session.put('/api/v1/courses/{}/group_sets/'.format(fake_server.COURSE_ID),
+                                  json={'minimum_size': 1, 'maximum_size': 2})
+            return users, webhook
+
+    users, webhook = asyncio.run(run())
+    assert len(users) == 9
+    assert webhook['secret']
+    requests = server.stats.json()['requests']
+    assert requests['GET /api/v1/courses/:id/users/'] == 2
+    assert requests['POST /api/v1/assignments/:id/webhook_settings'] == 2
+    assert requests['PUT /api/v1/courses/:id/group_sets/'] == 1
+    assert dict(policy.retried) == {'GET /api/v1/courses/:id/users/': 1, 'POST /api/v1/assignments/:id/webhook_settings': 1}
+
+
+def test_async_session_is_rate_limited(workdir, server):
+    policy = RetryPolicy(limiter=TokenBucket(rate=20, burst=1))
+
+    async def run():
+        async with await async_session(server, policy) as session:
+            start = time.monotonic()
+            await asyncio.gather(*[ session.get('/api/v1/assignments/{}'.format(fake_server.ASSIGNMENT_ID)) for i in range(10) ])
+            return time.monotonic() - start
+
+    # The login used up the burst, so the 10 calls go at 20 per second
+    assert asyncio.run(run()) >= 0.4
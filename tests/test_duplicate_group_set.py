@@ -0,0 +1,30 @@
+import fake_server
+from conftest import load_script
+from common import cgclient
+from common.retry import RetryPolicy
+
+duplicate_group_set = load_script('duplicate-group-set.py')
+
+
+def test_group_set_is_created_once_after_a_server_error(workdir, server, capsys):
+    # The first PUT creates the set but is answered with 503: sending it again would create a second set,
+    # the script continues with the set that was created
+    server.failures['PUT /api/v1/courses/:id/group_sets/'] = 1
+    session = cgclient.login('test', 'test', host=server.url, tenant=fake_server.TENANT, policy=RetryPolicy(base_delay=0))
+    failed = duplicate_group_set.duplicate(session, fake_server.COURSE_ID, workers=2)
+
+    assert failed == 0
+    assert 'could not create' not in capsys.readouterr().out
+    assert server.stats.json()['requests']['PUT /api/v1/courses/:id/group_sets/'] == 1
+    assert len(server.world.group_sets) == 2
+    target = [ group_set for id, group_set in server.world.group_sets.items() if id != fake_server.GROUP_SET_ID ][0]
+    assert len(target['groups']) == 4
+
+
+def test_copy_all_groups(workdir, server):
+    session = cgclient.login('test', 'test', host=server.url, tenant=fake_server.TENANT)
+    assert duplicate_group_set.duplicate(session, fake_server.COURSE_ID, workers=2) == 0
+    assert len(server.world.group_sets) == 2
+    target = [ group_set for id, group_set in server.world.group_sets.items() if id != fake_server.GROUP_SET_ID ][0]
+    assert [ group['name'] for group in sorted(target['groups'], key=lambda group: group['name']) ] == \
+        [ 'Team {:04d}'.format(i) for i in range(4) ]
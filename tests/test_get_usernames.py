@@ -0,0 +1,47 @@
+import csv
+
+import pytest
+
+from conftest import load_script
+import fake_server
+
+usernames = load_script('gitlab/1_get_usernames.py')
+
+
+def run(server, **kwargs):
+    usernames.init_roster(server.url, fake_server.TENANT, server.url, fake_server.COURSE_ID, **kwargs)
+    with open('usernames.csv', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.fixture
+def secrets(workdir):
+    with open('secrets.txt', 'w') as f:
+        f.write('test\ntest\ntest\n')
+
+
+@pytest.mark.parametrize('match_mode', ['bulk', 'all-users', 'search'])
+def test_second_run_makes_no_user_searches(secrets, server, match_mode):
+    first = run(server, match_mode=match_mode, gitlab_group=fake_server.ROOT_GROUP)
+    assert len(first) == 8
+    assert all(row['gl_user'] == fake_server.gl_username(i) for i, row in enumerate(first))
+    assert server.stats.json()['requests'].get('GET /api/v4/users', 0) > 0
+
+    server.stats.reset()
+    assert run(server, match_mode=match_mode, gitlab_group=fake_server.ROOT_GROUP) == first
+    assert server.stats.json()['requests'].get('GET /api/v4/users', 0) == 0
+
+
+def test_bulk_matches_against_the_course_group(secrets, server, capsys):
+    rows = run(server, gitlab_group=fake_server.ROOT_GROUP)
+    assert [ row['gl_user'] for row in rows ] == [ fake_server.gl_username(i) for i in range(8) ]
+    assert 'Matching against 8 GitLab user(s)' in capsys.readouterr().out
+    # One search, for the student that did not join the group, instead of listing all users
+    requests = server.stats.json()['requests']
+    assert requests['GET /api/v4/users'] == 1
+    assert requests['GET /api/v4/groups/:group/members/all'] == 1
+
+
+def test_bulk_needs_the_course_group(secrets, server):
+    with pytest.raises(SystemExit, match='gitlab_group'):
+        run(server)
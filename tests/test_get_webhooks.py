@@ -0,0 +1,40 @@
+import csv
+import socket
+import threading
+
+import pytest
+import requests
+
+from conftest import load_script, write_usernames
+from common import cgclient
+from common.retry import RetryPolicy
+
+webhooks = load_script('gitlab/2_get_webhooks.py')
+
+
+def test_webhook_settings_are_requested_again_after_a_server_error(workdir, server, course):
+    # The POST only gets (or the first time creates) the webhook of the author, so it is retried
+    access, organization, assignment = course
+    write_usernames('usernames.csv', 4)
+    server.failures['POST /api/v1/assignments/:id/webhook_settings'] = 1
+    webhooks.init_roster(access, organization, 'usernames.csv', 'webhooks.csv', workers=2)
+
+    with open('webhooks.csv', newline='') as f:
+        assert len(list(csv.DictReader(f))) == 4
+    assert server.stats.json()['requests']['POST /api/v1/assignments/:id/webhook_settings'] == 5
+
+
+def test_codegrade_requests_time_out(workdir):
+    # A server that accepts the connection but never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    accepted = []
+    threading.Thread(target=lambda: accepted.append(listener.accept()), daemon=True).start()
+    session = cgclient.CGSession('http://127.0.0.1:{}'.format(listener.getsockname()[1]), 'token',
+                                 policy=RetryPolicy(attempts=1), timeout=0.2)
+    try:
+        with pytest.raises(requests.Timeout):
+            session.get('/api/v1/login')
+    finally:
+        listener.close()
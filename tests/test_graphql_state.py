@@ -0,0 +1,102 @@
+# fetch_state against a stub of the GitHub GraphQL API that knows the queries of graphql_state.py
+
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+
+import pytest
+
+from conftest import REPO
+
+sys.path.insert(0, os.path.join(REPO, 'github'))
+from common.retry import RetryPolicy
+from graphql_state import GraphQLClient, fetch_state
+
+ORG = 'course-2025'
+PREFIX = 'exercise-01-'
+
+
+def page(items, variables, size):
+    start = int(variables.get('cursor') or 0)
+    return {
+        'pageInfo': {'hasNextPage': start + size < len(items), 'endCursor': str(start + size)},
+        'items': items[start:start + size],
+    }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        query, variables = request['query'], request['variables']
+        github = self.server.github
+        github['queries'] += 1
+        assert variables['org'] == ORG
+        if 'search(' in query:
+            data = {'errors': [{'message': 'search is not stubbed'}]}
+        elif 'team(slug' in query:
+            result = page(github['teams'][variables['team']], variables, 100)
+            edges = [ {'permission': 'ADMIN', 'node': {'name': name}} for name in result.pop('items') ]
+            data = {'data': {'organization': {'team': {'repositories': dict(result, edges=edges)}}}}
+        elif 'repository(owner' in query:
+            data = {'data': {}}
+            for alias, name in re.findall(r'(\w+): repository\(owner: \$org, name: ("(?:[^"\\]|\\.)*")\)', query):
+                repo = github['repos'].get(json.loads(name))
+                data['data'][alias] = None if repo is None else {
+                    'name': json.loads(name),
+                    'collaborators': {'pageInfo': {'hasNextPage': len(repo['collaborators']) > 100},
+                                      'nodes': [ {'login': login} for login in repo['collaborators'][:100] ]},
+                    'deployKeys': {'pageInfo': {'hasNextPage': False}, 'nodes': [ {'title': t} for t in repo['keys'] ]},
+                }
+        else:
+            result = page(sorted(github['repos']), variables, 100)
+            nodes = [ {'name': name} for name in result.pop('items') ]
+            data = {'data': {'organization': {'repositories': dict(result, nodes=nodes)}}}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def github():
+    # 130 repositories of the assignment, more than a page, between repositories of other assignments
+    # whose names share words with the prefix
+    repos = {}
+    for i in range(130):
+        repos['{}team-{:03d}'.format(PREFIX, i)] = {'collaborators': ['Student{}'.format(i)], 'keys': ['codegrade-key']}
+    for name in ('exercise-010-team-000', 'old-exercise-01-team-000', 'exercise-01', 'exercise-02-team-000'):
+        repos[name] = {'collaborators': [], 'keys': []}
+    repos[PREFIX + 'big'] = {'collaborators': [ 'user{}'.format(i) for i in range(150) ], 'keys': []}
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.github = {
+        'repos': repos,
+        'teams': {'staff': sorted(repos), 'students': [PREFIX + 'team-007', 'exercise-02-team-000']},
+        'queries': 0,
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_state_lists_every_repository_of_the_assignment(github):
+    client = GraphQLClient('token', RetryPolicy(), url='http://{}:{}/graphql'.format(*github.server_address))
+    state = fetch_state(client, ORG, PREFIX)
+
+    expected = { name for name in github.github['repos'] if name.startswith(PREFIX) }
+    assert set(state['repos']) == expected
+    assert state['repos'][PREFIX + 'team-042'] == {'collaborators': {'student42'}, 'keys': ['codegrade-key']}
+    # More than one page of collaborators is left to REST
+    assert state['repos'][PREFIX + 'big']['collaborators'] is None
+    assert state['staff'] == expected
+    assert state['students'] == {PREFIX + 'team-007'}
+    # 2 pages of names, 3 batches of details and 3 pages of team repositories
+    assert github.github['queries'] == 8
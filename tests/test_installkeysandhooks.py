@@ -0,0 +1,109 @@
+import os
+
+import fake_server
+from conftest import load_script, write_usernames
+
+webhooks = load_script('gitlab/2_get_webhooks.py')
+provisioning = load_script('gitlab/3_installKeysAndHooks.py')
+
+
+def test_plan_names_every_change(workdir, server, course, capsys):
+    access, organization, assignment = course
+    write_usernames('usernames.csv', 4)
+    webhooks.init_roster(access, organization, 'usernames.csv', 'webhooks.csv', workers=2)
+    provisioning.sync(access, organization, 'webhooks.csv', assignment, workers=2, plan=True)
+    output = capsys.readouterr().out
+
+    assert 'built-in method' not in output
+    for i in range(8):
+        assert '+ collaborator ' + fake_server.gl_username(i) + '\n' in output
+    assert output.count('+ webhook ' + server.url + '/api/v1/webhooks/') == 4
+    assert 'Plan: 4 of 4 group(s) need changes; 0 error(s).' in output
+
+
+def test_describe():
+    class Hook:
+        url = 'https://codegrade.example/api/v1/webhooks/1'
+
+    class Key:
+        title = 'codegrade-key'
+
+    assert provisioning.describe(('unprotect', 'main')) == '- protection of branch main'
+    assert provisioning.describe(('add_member', 'student0001')) == '+ collaborator student0001'
+    assert provisioning.describe(('add_hook', Hook.url)) == '+ webhook ' + Hook.url
+    assert provisioning.describe(('update_hook', Hook())) == '~ webhook {} (url and token)'.format(Hook.url)
+    assert provisioning.describe(('delete_key', Key())) == '- deploy key codegrade-key (wrong key)'
+    assert provisioning.describe(('fork', None)) == '+ repository (fork of the template)'
+
+
+def test_rollout_waits_for_forks_without_listing_the_group(workdir, server, course, capsys):
+    access, organization, assignment = course
+    rollout = load_script('gitlab/rollout.py')
+    write_usernames('usernames.csv', 4)
+    rollout.rollout(access, organization, assignment, 'usernames.csv', 'webhooks.csv', workers=4, rate=1000)
+    assert 'Processed 4 group(s); 0 error(s).' in capsys.readouterr().out
+
+    requests = server.stats.json()['requests']
+    assert requests['POST /api/v4/projects/:project/fork'] == 4
+    # Only the project index of the staff and student group, however many forks were awaited
+    assert requests['GET /api/v4/groups/:group/projects'] == 2
+
+
+def test_sync_provisions_the_roster_in_batches(workdir, server, course, monkeypatch, capsys):
+    access, organization, assignment = course
+    write_usernames('usernames.csv', 4)
+    webhooks.init_roster(access, organization, 'usernames.csv', 'webhooks.csv', workers=2)
+
+    read = []
+    load_user_data = provisioning.load_user_data
+    def counting_load_user_data(filename):
+        for group in load_user_data(filename):
+            read.append(group['name'])
+            yield group
+    applied = []
+    sync_group = provisioning.sync_group
+    def recording_sync_group(ctx, group, planned):
+        applied.append((group['name'], len(read)))
+        return sync_group(ctx, group, planned)
+    monkeypatch.setattr(provisioning, 'load_user_data', counting_load_user_data)
+    monkeypatch.setattr(provisioning, 'sync_group', recording_sync_group)
+
+    provisioning.sync(access, organization, 'webhooks.csv', assignment, workers=2, batch_size=3)
+    assert 'Processed 4 group(s); 0 error(s).' in capsys.readouterr().out
+    # The first batch was done before the rest of the roster was read
+    assert sorted(applied) == [ (name, 3 if name in read[:3] else 4) for name in sorted(read) ]
+    assert server.stats.json()['requests']['POST /api/v4/projects/:project/fork'] == 4
+
+
+class Hook:
+    def __init__(self, id, url, push_events=True):
+        self.id = id
+        self.url = url
+        self.push_events = push_events
+
+
+def test_plan_hooks_without_recorded_state():
+    url = 'https://codegrade.example/api/v1/webhooks/1'
+    other = 'https://ci.example/hook'
+    # No state recorded: a webhook with the right url and events is left alone
+    assert provisioning.plan_hooks([Hook(1, other), Hook(2, url)], url) == []
+    disabled = Hook(2, url, push_events=False)
+    assert provisioning.plan_hooks([disabled], url) == [('update_hook', disabled)]
+    old = Hook(3, 'https://codegrade.example/api/v1/webhooks/2')
+    assert provisioning.plan_hooks([old], url) == [('update_hook', old)]
+    # Of two matching webhooks the recorded one is kept
+    first, second = Hook(4, url), Hook(5, url)
+    assert provisioning.plan_hooks([first, second], url, hook_id=5) == [('delete_hook', first)]
+
+
+def test_rerun_without_state_makes_no_writes(workdir, server, course, capsys):
+    access, organization, assignment = course
+    write_usernames('usernames.csv', 4)
+    webhooks.init_roster(access, organization, 'usernames.csv', 'webhooks.csv', workers=2)
+    provisioning.sync(access, organization, 'webhooks.csv', assignment, workers=2)
+    os.remove('sync_state.json')
+
+    server.stats.reset()
+    provisioning.sync(access, organization, 'webhooks.csv', assignment, workers=2)
+    assert 'Processed 4 group(s); 0 error(s).' in capsys.readouterr().out
+    assert server.stats.json()['writes'] == 0
@@ -0,0 +1,97 @@
+import http.server
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import REPO
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hits += 1
+        body = ('x' * 10000).encode() if self.path.startswith('/download') else b'{"lat": 51.97}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def web():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.hits = 0
+    server.url = 'http://{}:{}'.format(*server.server_address)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run(tmp_path, code, mode):
+    # A fresh interpreter per run, install() patches requests for the whole process
+    script = 'import sys\nsys.path.insert(0, {!r})\nfrom autotest import netcache\nnetcache.install({!r}, {!r})\n'.format(
+        REPO, str(tmp_path / 'netcache'), mode) + code
+    return subprocess.run([sys.executable, '-c', script], capture_output=True, text=True)
+
+
+STREAM = '''
+import requests
+response = requests.get(URL + '/download', stream=True)
+print(sum(len(chunk) for chunk in response.iter_content(1024)))
+response = requests.get(URL + '/download', stream=True)
+print(len(response.raw.read()))
+'''
+
+
+def test_streamed_downloads_are_recorded_and_replayed(tmp_path, web):
+    code = 'URL = {!r}\n'.format(web.url) + STREAM
+    recorded = run(tmp_path, code, 'auto')
+    assert recorded.returncode == 0, recorded.stderr
+    assert recorded.stdout == '10000\n10000\n'
+    hits = web.hits
+
+    replayed = run(tmp_path, code, 'replay')
+    assert replayed.returncode == 0, replayed.stderr
+    assert replayed.stdout == '10000\n10000\n'
+    assert web.hits == hits
+
+
+TEST_SCRIPT = '''
+import os, sys
+sys.path.insert(0, {repo!r})
+from autotest import netcache, runner
+netcache.install({cache!r})
+args = runner.parse_args()
+import requests
+
+def test_geocode():
+    assert requests.get({url!r} + '/geocode').json()['lat'] == 51.97, 'Wrong location'
+
+def test_offline():
+    try:
+        requests.get({url!r} + '/not-recorded')
+    except requests.ConnectionError:
+        pass
+
+runner.run_tests({{1: test_geocode, 2: test_offline}}, args)
+'''
+
+
+def test_runner_reports_the_requests_of_its_workers(tmp_path, web):
+    (tmp_path / 'student').mkdir()
+    (tmp_path / 'test_exc.py').write_text(TEST_SCRIPT.format(repo=REPO, cache=str(tmp_path / 'netcache'), url=web.url))
+    # Record the geocoder only, the second test then misses when replaying
+    assert run(tmp_path, 'import requests\nrequests.get({!r})\n'.format(web.url + '/geocode'), 'auto').returncode == 0
+
+    result = subprocess.run([sys.executable, str(tmp_path / 'test_exc.py'), '--student_path', str(tmp_path / 'student'),
+                             '--results', str(tmp_path / 'results.json')],
+                            capture_output=True, text=True, env=dict(os.environ, AUTOTEST_NET='replay'))
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert '> 1 request(s) replayed, 0 recorded, 1 not recorded\n' in result.stdout
+    assert web.url + '/not-recorded' in result.stdout
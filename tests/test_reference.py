@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+
+from autotest import reference
+
+
+def write_outputs(folder, offset=0.0):
+    # The outputs of a solution: a raster, vector data, a plot, an array and a text file
+    import geopandas
+    import rasterio
+    import shapely
+    from PIL import Image
+    os.makedirs(os.path.join(folder, 'output'), exist_ok=True)
+    values = np.arange(200, dtype='float32').reshape(10, 20) / 10 + offset
+    with rasterio.open(os.path.join(folder, 'output', 'ndvi.tif'), 'w', driver='GTiff', width=20, height=10, count=1,
+                       dtype='float32', crs='EPSG:28992', transform=rasterio.Affine(10, 0, 170000, 0, -10, 445000),
+                       nodata=-9999) as dst:
+        dst.write(values, 1)
+    fields = geopandas.GeoDataFrame({'name': ['a', 'b']}, geometry=[shapely.box(0, 0, 10, 10), shapely.box(20, 0, 30, 5 + offset)],
+                                    crs='EPSG:28992')
+    fields.to_file(os.path.join(folder, 'output', 'fields.geojson'), driver='GeoJSON')
+    gradient = np.tile(np.linspace(0, 255, 64, dtype='uint8'), (32, 1))
+    Image.fromarray(gradient).save(os.path.join(folder, 'output', 'plot.png'))
+    np.save(os.path.join(folder, 'output', 'result.npy'), values * 2)
+    with open(os.path.join(folder, 'output', 'answer.txt'), 'w') as f:
+        f.write('42\n')
+
+
+OUTPUTS = ['output/ndvi.tif', 'output/fields.geojson', 'output/plot.png', 'output/result.npy', 'output/answer.txt']
+
+
+@pytest.fixture
+def ref(tmp_path):
+    write_outputs(str(tmp_path / 'solution'))
+    reference.build(str(tmp_path / 'solution'), OUTPUTS, directory=str(tmp_path / 'reference'))
+    return reference.load(str(tmp_path / 'reference'))
+
+
+def test_the_solution_matches_its_references(tmp_path, ref):
+    assert {name: ref.entries[name]['kind'] for name in OUTPUTS} == {
+        'output/ndvi.tif': 'raster', 'output/fields.geojson': 'vector', 'output/plot.png': 'image',
+        'output/result.npy': 'array', 'output/answer.txt': 'file'}
+    solution = str(tmp_path / 'solution')
+    reference.assert_raster_close(ref, 'output/ndvi.tif', solution + '/output/ndvi.tif')
+    reference.assert_vector_close(ref, 'output/fields.geojson', solution + '/output/fields.geojson', ordered=False)
+    reference.assert_image_matches(ref, 'output/plot.png', solution + '/output/plot.png')
+    reference.assert_image_similar(ref, 'output/plot.png', solution + '/output/plot.png')
+    reference.assert_array_close(ref, 'output/result.npy', np.load(solution + '/output/result.npy'))
+    reference.assert_file_matches(ref, 'output/answer.txt', solution + '/output/answer.txt')
+    assert isinstance(ref.band('output/ndvi.tif'), np.memmap)
+
+
+def test_a_different_result_fails_with_a_message(tmp_path, ref):
+    student = str(tmp_path / 'student')
+    write_outputs(student, offset=1.0)
+    with pytest.raises(AssertionError, match='output/ndvi.tif: 200 of 200 values'):
+        reference.assert_raster_close(ref, 'output/ndvi.tif', student + '/output/ndvi.tif')
+    with pytest.raises(AssertionError, match='output/fields.geojson: 1 of 2 geometries differ'):
+        reference.assert_vector_close(ref, 'output/fields.geojson', student + '/output/fields.geojson')
+    with pytest.raises(AssertionError, match='output/result.npy: 200 of 200 values'):
+        reference.assert_array_close(ref, 'output/result.npy', np.load(student + '/output/result.npy'))
+
+
+def test_a_file_that_is_not_an_image(tmp_path, ref):
+    path = tmp_path / 'plot.png'
+    path.write_text('not a png')
+    with pytest.raises(AssertionError, match='output/plot.png: plot.png is not an image that can be read'):
+        reference.assert_image_matches(ref, 'output/plot.png', str(path))
+    with pytest.raises(AssertionError, match='is not an image that can be read'):
+        reference.assert_image_similar(ref, 'output/plot.png', str(path))
@@ -0,0 +1,80 @@
+import collections
+import http.server
+import socket
+import threading
+
+import pytest
+import requests
+
+from common.retry import IDEMPOTENT_METHODS, RetryPolicy, mount_retries
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Answers every request with the next status of its path, then 200
+    def answer(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.server.seen[self.command] += 1
+        statuses = self.server.statuses.get(self.path, [])
+        status = statuses.pop(0) if statuses else 200
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = do_PUT = answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def web():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.seen = collections.Counter()
+    server.statuses = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def session(**kwargs):
+    return mount_retries(requests.Session(), RetryPolicy(base_delay=0), **kwargs)
+
+
+def test_post_is_not_retried_after_a_server_error(web):
+    web.statuses = {'/fork': [502]}
+    assert session().post(web.url + '/fork').status_code == 502
+    assert web.seen['POST'] == 1
+
+
+def test_post_is_retried_when_rate_limited(web):
+    web.statuses = {'/fork': [429, 429]}
+    assert session().post(web.url + '/fork').status_code == 200
+    assert web.seen['POST'] == 3
+
+
+def test_idempotent_requests_are_retried(web):
+    web.statuses = {'/projects': [502, 503], '/member': [500]}
+    assert session().get(web.url + '/projects').status_code == 200
+    assert session().put(web.url + '/member').status_code == 200
+    assert web.seen == {'GET': 3, 'PUT': 2}
+
+
+def test_queries_sent_as_post_can_be_retried(web):
+    web.statuses = {'/graphql': [502]}
+    assert session(idempotent=IDEMPOTENT_METHODS | {'POST'}).post(web.url + '/graphql').status_code == 200
+    assert web.seen['POST'] == 2
+
+
+def test_post_is_retried_when_it_could_not_connect():
+    # A port that nothing listens on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    policy = RetryPolicy(attempts=3, base_delay=0)
+    with pytest.raises(requests.ConnectionError):
+        mount_retries(requests.Session(), policy).post('http://127.0.0.1:{}/fork'.format(port))
+    assert sum(policy.retried.values()) == 2
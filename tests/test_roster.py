@@ -0,0 +1,23 @@
+import types
+
+from conftest import load_script
+from common.roster import GITLAB_USERNAMES, read_id_map, read_roster
+
+
+def test_excel_byte_order_mark(tmp_path):
+    # Excel's "CSV UTF-8" starts the file with a byte order mark
+    path = tmp_path / 'usernames.csv'
+    path.write_bytes('cg_name,cg_user,gl_name,gl_user\r\nJosé,jose@example.com,José,jose\r\n'.encode('utf-8-sig'))
+    assert list(read_roster(str(path), GITLAB_USERNAMES)) == [
+        {'cg_name': 'José', 'cg_user': 'jose@example.com', 'gl_name': 'José', 'gl_user': 'jose'}]
+    assert read_id_map(str(path), GITLAB_USERNAMES, 'cg_user', 'gl_user') == {'jose@example.com': 'jose'}
+
+
+def test_provisioning_streams_the_roster(tmp_path):
+    path = tmp_path / 'webhooks.csv'
+    path.write_text('name,git_ids,payload_url,secret,public_key\n'
+                    'Group 1,student0000,https://hook/1,s1,ssh-ed25519 AAAA1\n'
+                    'Group 2,student0001,https://hook/2,s2,ssh-ed25519 AAAA2\n')
+    groups = load_script('gitlab/3_installKeysAndHooks.py').load_user_data(str(path))
+    assert isinstance(groups, types.GeneratorType)
+    assert [ group['name'] for group in groups ] == ['Group 1', 'Group 2']